@@ -8,21 +8,34 @@ __email__ = "avkrasnov@salutedevices.com"
 __copyright__ = "Copyright (c) 2024, SaluteDevices"
 __version__ = '0.0.1'
 
+import array
 import logging
 import time
+import weakref
 
 from enum import IntEnum
-from types import DynamicClassAttribute
 
 import usb.core
 import usb.util
 
+from pyamlboot.checksum import addsum
+from pyamlboot import metrics
+from pyamlboot.hotplug import wait_for
+from pyamlboot.stages import Stage
+from pyamlboot.stream import open_stream
+from pyamlboot.timeouts import AdaptiveTimeout, is_stall, retry_transfer
+from pyamlboot.topology import port_match
+
 ADNL_REPLY_OKAY = 'OKAY'
 ADNL_REPLY_FAIL = 'FAIL'
 ADNL_REPLY_INFO = 'INFO'
 ADNL_REPLY_DATA = 'DATA'
 
 USB_IO_TIMEOUT_MS = 5000
+
+CHECKSUM_RETRIES = 5
+# Restarts of one data step whose transfer stalled, with restart_data
+DATA_RESTARTS = 10
 USB_BULK_SIZE = 16384
 USB_READ_LEN = 512
 
@@ -38,34 +51,15 @@ TPL_BURNSTEPS_0 = 0xC0041030
 TPL_BURNSTEPS_1 = 0xC0041031
 TPL_BURNSTEPS_2 = 0xC0041032
 
+# Commands after which the device answers from another stage
+STAGE_CHANGING_CMDS = ('boot', 'reboot', 'reboot-romusb')
 
-class Stage(IntEnum):
-    """
-    Enum with boot stages of Amlogic SoC.
-    """
-    ROM = 0
-    SPL = 8
-    TPL = 16
-
-    @DynamicClassAttribute
-    def name(self):
-        """
-        Method provides custom mapping between Enum member and
-        user-friendly name of the boot stage in terms of Amlogic.
-        """
-        name = {
-            self.ROM: "BootROM",
-            self.SPL: "BL2",
-            self.TPL: "U-Boot",
-        }.get(self)
-
-        if name:
-            return name
-
-        # If self (i.e. Enum member) is not found in the dict, then
-        # get() would return None by default. Hence return default name
-        # of Enum member in such case.
-        return super().name
+# Per connection, keyed by its usb.core.Device as get_device_eps() returns
+# new endpoints on every call: the identify stage and the chipinfo pages,
+# until a stage changing command
+_session_cache = weakref.WeakKeyDictionary()
+# Per connection, keyed by its usb.core.Device: the transfer timeouts
+_timeouts_cache = weakref.WeakKeyDictionary()
 
 
 class SocFamily(IntEnum):
@@ -120,11 +114,60 @@ def adnl_get_prefix(msg):
     return msg[:4].tobytes().decode()
 
 
-def adnl_checksum(buf):
-    # This checksum is used to verify part of image, transmitted by
-    # USB. It is not for verifying entire partition image.
-    return sum(int.from_bytes(buf[i:i + 4], 'little')
-               for i in range(0, len(buf), 4)) & 0xffffffff
+class _Timeouts:
+    '''
+    Transfer timeouts of a connection, following its link. USB_IO_TIMEOUT_MS
+    is the ceiling.
+    '''
+    def __init__(self):
+        self.cmd = AdaptiveTimeout(USB_IO_TIMEOUT_MS)
+        # Replies to commands always get the ceiling: the time to process
+        # one depends on the command, oem disk_initial or erasing may take
+        # seconds, not on its length
+        self.cmd_reply = AdaptiveTimeout(USB_IO_TIMEOUT_MS,
+                                         floor_ms=USB_IO_TIMEOUT_MS)
+        # Replies to data payloads, which take longer for more data
+        self.data_reply = AdaptiveTimeout(USB_IO_TIMEOUT_MS, floor_ms=500)
+        self.data = AdaptiveTimeout(USB_IO_TIMEOUT_MS)
+
+
+def _connection(epout):
+    """Return the usb.core.Device an endpoint belongs to"""
+    return epout.device
+
+
+def _timeouts(epout):
+    dev = _connection(epout)
+    timeouts = _timeouts_cache.get(dev)
+    if timeouts is None:
+        timeouts = _timeouts_cache[dev] = _Timeouts()
+    return timeouts
+
+
+def _write_cmd(epout, cmd):
+    timeouts = _timeouts(epout)
+    if len(cmd) <= epout.wMaxPacketSize:
+        # A single packet is taken whole or not at all, resending a
+        # stalled one never duplicates anything
+        retry_transfer(lambda timeout: epout.write(cmd, timeout), epout,
+                       len(cmd), timeouts.cmd, kind='adnl_cmd')
+        return
+
+    start = time.perf_counter()
+    epout.write(cmd, timeouts.data.for_length(len(cmd)))
+    timeouts.data.record(len(cmd), time.perf_counter() - start)
+
+
+def _read_reply(epout, epin, cmd):
+    timeouts = _timeouts(epout)
+    if isinstance(cmd, str) or len(cmd) <= epout.wMaxPacketSize:
+        reply_timeout = timeouts.cmd_reply
+    else:
+        reply_timeout = timeouts.data_reply
+
+    # A reply is read whole, reading it again never skips anything
+    return retry_transfer(lambda timeout: epin.read(USB_READ_LEN, timeout),
+                          epin, len(cmd), reply_timeout, kind='adnl_reply')
 
 
 def send_cmd(epout, epin, cmd, expected_res=ADNL_REPLY_OKAY):
@@ -134,8 +177,16 @@ def send_cmd(epout, epin, cmd, expected_res=ADNL_REPLY_OKAY):
     * header is a kind of ack for cmd, with values: OKAY, FAIL, INFO or DATA
     * payload depends on the cmd type
     '''
-    epout.write(cmd, USB_IO_TIMEOUT_MS)
-    msg = epin.read(USB_READ_LEN, USB_IO_TIMEOUT_MS)
+    if metrics.collector is not None:
+        start = time.perf_counter()
+
+    _write_cmd(epout, cmd)
+    msg = _read_reply(epout, epin, cmd)
+
+    if metrics.collector is not None:
+        kind = cmd.split(':', 1)[0] if isinstance(cmd, str) else 'data'
+        metrics.record(f'adnl:{kind}', len(cmd),
+                       time.perf_counter() - start)
 
     if len(msg) < 4:
         raise RuntimeError(f'Too short reply: {len(msg)}')
@@ -145,9 +196,20 @@ def send_cmd(epout, epin, cmd, expected_res=ADNL_REPLY_OKAY):
     if header != expected_res:
         raise RuntimeError(f'Unexpected reply:{header} to cmd:{cmd}')
 
+    if isinstance(cmd, str) and cmd in STAGE_CHANGING_CMDS:
+        _session_cache.pop(_connection(epout), None)
+
     return msg
 
 
+def _session(epout):
+    dev = _connection(epout)
+    cache = _session_cache.get(dev)
+    if cache is None:
+        cache = _session_cache[dev] = {}
+    return cache
+
+
 def send_cmd_identify(epout, epin):
     '''
     Identify command reply:
@@ -155,13 +217,18 @@ def send_cmd_identify(epout, epin):
     * msg[5]  - minor version
     * msg[7]  - stage of bootstrap, see stages dict
     * msg[11] - pages map
+
+    The stage is cached for the connection until a stage changing command.
     '''
-    msg = send_cmd(epout, epin, 'getvar:identify')
-    # extra checks for this type of command
-    if msg[4] != 0x5:
-        raise RuntimeError('Unexpected data in reply to "identify"')
+    cache = _session(epout)
+    if 'stage' not in cache:
+        msg = send_cmd(epout, epin, 'getvar:identify')
+        # extra checks for this type of command
+        if msg[4] != 0x5:
+            raise RuntimeError('Unexpected data in reply to "identify"')
+        cache['stage'] = Stage(msg[7])
 
-    return Stage(msg[7])
+    return cache['stage']
 
 
 def get_chipinfo(epout, epin, page, offset=None, nbytes=None):
@@ -183,8 +250,13 @@ def get_chipinfo(epout, epin, page, offset=None, nbytes=None):
     if not 0 <= page <= 7:
         raise RuntimeError(f"page index:{page} is out of range [0, 7]")
 
-    # Cut off header of reply msg
-    msg = send_cmd(epout, epin, f"getvar:getchipinfo-{page}")[4:]
+    # Pages do not change within a stage
+    cache = _session(epout)
+    key = f'getchipinfo-{page}'
+    if key not in cache:
+        # Cut off header of reply msg
+        cache[key] = send_cmd(epout, epin, f"getvar:{key}")[4:]
+    msg = cache[key]
     if offset is None:
         offset = 0
     if nbytes is None:
@@ -236,14 +308,71 @@ def send_burnsteps(epout, epin, burnstep):
     # 'burnsteps' needs extra argument
     send_cmd(epout, epin, burnstep.to_bytes(4, 'little'))
 
-def tpl_burn_partition(part_item, aml_img, epout, epin):
-    part_name = part_item.sub_type()
-    logging.info('Burning partition "%s"', part_name)
-    # To burn partition, first send the following command:
-    # 'oem mwrite <partition size> normal store <partition name>'
-    # Reply must be 'OKAY'.
-    oem_cmd = f'oem mwrite 0x{part_item.size():x} normal store {part_name}'
-    send_cmd(epout, epin, oem_cmd)
+class DataTransferError(RuntimeError):
+    '''A data step still stalled after DATA_RESTARTS restarts'''
+
+
+class _StepRetries:
+    '''
+    After a failed step checksum, or a step aborted on a data stall, the
+    device asks for the same offset again: the step is sent again from its
+    mwrite or CBW, up to CHECKSUM_RETRIES times after checksum errors and
+    DATA_RESTARTS times after stalls.
+
+    Restarting a stalled step relies on the device dropping the bytes of a
+    step it got part of when the host clears the OUT endpoint halt, then
+    asking for the same offset again. This is what the simulator does, it
+    was not checked on hardware: restart_data is off by default, and a
+    stall then fails the burn like it always did.
+    '''
+    def __init__(self):
+        self._offs = None
+        self._failures = {}
+
+    def failed(self, offs, size, e, reason='checksum'):
+        if offs != self._offs:
+            self._failures = {}
+        self._offs = offs
+        failures = self._failures[reason] = self._failures.get(reason, 0) + 1
+        if reason == 'checksum':
+            if failures > CHECKSUM_RETRIES:
+                raise RuntimeError('CRC error during tx') from e
+        elif failures > DATA_RESTARTS:
+            raise DataTransferError(
+                f'{reason} at offset 0x{offs:x} still stalled after '
+                f'{DATA_RESTARTS} restarts') from e
+
+        logging.warning('%s error at offset 0x%x, resending', reason, offs)
+        metrics.record(f'retry:{reason}', size, 0.0, True)
+
+
+def _stage_chunk(chunk, staging):
+    # pyusb converts a memoryview byte by byte, an array is sent as is
+    if len(chunk) != len(staging):
+        return array.array('B', chunk.tobytes())
+    memoryview(staging)[:] = chunk
+    return staging
+
+
+def _send_dataout(epout, stream, buf, staging, timeout):
+    chunks = (buf[i:i + USB_BULK_SIZE]
+              for i in range(0, len(buf), USB_BULK_SIZE))
+
+    if stream is not None:
+        metrics.timed_call('bulk_out_stream', len(buf), stream.write, chunks,
+                           timeout(len(buf)))
+        return
+
+    for chunk in chunks:
+        chunk = _stage_chunk(chunk, staging)
+        epout.write(chunk, timeout(len(chunk)))
+
+
+def _tpl_send_dataout_steps(part_item, epout, epin, stream, restart_data=False):
+    data_timeout = _timeouts(epout).data
+    retries = _StepRetries()
+    staging = array.array('B', bytes(USB_BULK_SIZE))
+    resend = False
 
     while True:
         # Partition is sent step by step, each step starts from
@@ -264,9 +393,9 @@ def tpl_burn_partition(part_item, aml_img, epout, epin):
         # is supported). In case of successful verification,
         # device replies 'OKAY'.
 
-        epout.write('mwrite:verify=addsum', USB_IO_TIMEOUT_MS)
-        msg = epin.read(USB_READ_LEN, USB_IO_TIMEOUT_MS)
-        strmsg = msg.tobytes().decode()
+        cmd = 'mwrite:verify=addsum'
+        _write_cmd(epout, cmd)
+        strmsg = _read_reply(epout, epin, cmd).tobytes().decode()
 
         if strmsg.startswith(ADNL_REPLY_OKAY):
             logging.info('Burning is done')
@@ -280,23 +409,56 @@ def tpl_burn_partition(part_item, aml_img, epout, epin):
         size = int(size_offs[0], 16)
         offs = int(size_offs[1], 16)
 
+        # Without a copy when the image is mapped
         part_item.seek(offs)
-        buf = part_item.read(size)
-        sum_res = adnl_checksum(buf)
-        buf_offs = 0
+        buf = part_item.read_view(size)
+        sum_res = metrics.timed_call('checksum', size, addsum, buf)
 
-        while size > 0:
-            to_send = min(size, USB_BULK_SIZE)
-            epout.write(buf[buf_offs:buf_offs + to_send], USB_IO_TIMEOUT_MS)
-            size -= to_send
-            buf_offs += to_send
+        # After an aborted step, the ceiling timeout until a step succeeds
+        timeout = (lambda length: data_timeout.ceiling_ms) if resend \
+            else data_timeout.for_length
+        start = time.perf_counter()
+        try:
+            _send_dataout(epout, stream, buf, staging, timeout)
+        except usb.core.USBError as e:
+            if not restart_data or not is_stall(e):
+                raise
+            # The device counts the bytes of the step, part of a chunk may
+            # have reached it: the halt clearing resets the endpoint, which
+            # drops the step, and the device is asked for it again
+            epout.clear_halt()
+            resend = True
+            retries.failed(offs, size, e, 'dataout')
+            continue
+        data_timeout.record(size, time.perf_counter() - start)
+        resend = False
 
         bytes_sum = [(sum_res >> i) & 0xff for i in range(0, 32, 8)]
 
         try:
             send_cmd(epout, epin, bytes_sum)
         except RuntimeError as e:
-            raise RuntimeError('CRC error during tx') from e
+            retries.failed(offs, size, e)
+
+
+def tpl_burn_partition(part_item, aml_img, epout, epin, restart_data=False):
+    part_name = part_item.sub_type()
+    logging.info('Burning partition "%s"', part_name)
+    # To burn partition, first send the following command:
+    # 'oem mwrite <partition size> normal store <partition name>'
+    # Reply must be 'OKAY'.
+    oem_cmd = f'oem mwrite 0x{part_item.size():x} normal store {part_name}'
+    send_cmd(epout, epin, oem_cmd)
+
+    part_item.advise()
+
+    # DATAOUT blocks are not acked one by one, keep several in flight
+    stream = open_stream(epout.device, metrics.unwrap_endpoint(epout))
+    try:
+        _tpl_send_dataout_steps(part_item, epout, epin, stream, restart_data)
+    finally:
+        if stream is not None:
+            stream.close()
 
     # get 'VERIFY' entry for this partition
     verify_item = aml_img.item_get('VERIFY', part_name)
@@ -305,6 +467,7 @@ def tpl_burn_partition(part_item, aml_img, epout, epin):
     epout.write(sha1sum_str)
 
     strmsg = ''
+    busy_time = time.perf_counter()
 
     while strmsg != ADNL_REPLY_OKAY:
         logging.info('Waiting reply...')
@@ -319,6 +482,7 @@ def tpl_burn_partition(part_item, aml_img, epout, epin):
         if strmsg != ADNL_REPLY_OKAY:
             raise RuntimeError('CRC error for partition')
 
+    metrics.record('ack_wait:INFO', 0, time.perf_counter() - busy_time)
     logging.info('OK')
 
 
@@ -378,7 +542,7 @@ def run_bootrom_stage(epout, epin, aml_img, has_secureboot):
     send_cmd(epout, epin, 'boot')
 
 
-def run_bl2_stage(epout, epin, aml_img, has_secureboot):
+def run_bl2_stage(epout, epin, aml_img, has_secureboot, restart_data=False):
     # This stage writes to sticky register, then sends U-boot image
     # to the device and runs it. U-boot sees value in this sticky reg
     # and enters USB gadget mode to continue ADNL burning process.
@@ -398,6 +562,7 @@ def run_bl2_stage(epout, epin, aml_img, has_secureboot):
 
     sub_type = 'UBOOT_ENC' if has_secureboot else 'UBOOT'
     item = aml_img.item_get('USB', sub_type)
+    retries = _StepRetries()
 
     while True:
         # request cbw
@@ -414,18 +579,28 @@ def run_bl2_stage(epout, epin, aml_img, has_secureboot):
         buf_offs = 0
         cur_sum = 0
 
-        while size > 0:
-            to_send = min(size, USB_BULK_SIZE)
-            send_cmd(epout, epin, f'download:{to_send:08x}', ADNL_REPLY_DATA)
-
-            try:
-                send_cmd(epout, epin, buf[buf_offs:buf_offs + to_send])
-            except RuntimeError as e:
-                raise RuntimeError('Data tx failed') from e
-
-            cur_sum += adnl_checksum(buf[buf_offs:buf_offs + to_send])
-            size -= to_send
-            buf_offs += to_send
+        try:
+            while size > 0:
+                to_send = min(size, USB_BULK_SIZE)
+                send_cmd(epout, epin, f'download:{to_send:08x}',
+                         ADNL_REPLY_DATA)
+
+                try:
+                    send_cmd(epout, epin, buf[buf_offs:buf_offs + to_send])
+                except RuntimeError as e:
+                    raise RuntimeError('Data tx failed') from e
+
+                cur_sum += addsum(buf[buf_offs:buf_offs + to_send])
+                size -= to_send
+                buf_offs += to_send
+        except usb.core.USBError as e:
+            if not restart_data or not is_stall(e):
+                raise
+            # Part of the chunk may have reached the device: reset the
+            # endpoint to drop it, the next CBW asks for the step again
+            epout.clear_halt()
+            retries.failed(cbw.offset(), cbw.size(), e, 'download')
+            continue
 
         send_cmd(epout, epin, 'setvar:checksum', ADNL_REPLY_DATA)
 
@@ -434,7 +609,7 @@ def run_bl2_stage(epout, epin, aml_img, has_secureboot):
         try:
             send_cmd(epout, epin, bytes_sum)
         except RuntimeError as e:
-            raise RuntimeError('CRC error during tx') from e
+            retries.failed(cbw.offset(), cbw.size(), e)
 
         logging.info('Sending CRC done')
 
@@ -456,33 +631,39 @@ def get_device_eps(dev):
                                     direction(e.bEndpointAddress) ==
                                     usb.util.ENDPOINT_IN)
 
-    return [epout, epin]
+    return [metrics.instrument_endpoint(epout),
+            metrics.instrument_endpoint(epin)]
 
 
-def wait_for_device(last_dev_addr):
-    while True:
+def wait_for_device(last_dev_addr, port=None, backend=None):
+    def find_device():
         dev = usb.core.find(idVendor=AMLOGIC_VENDOR_ID,
-                            idProduct=AMLOGIC_PRODUCT_ID, backend=None)
+                            idProduct=AMLOGIC_PRODUCT_ID, backend=backend,
+                            custom_match=port_match(port))
 
         # Uboot reenables USB on the device and enters gadget mode
         # again, so wait until device appears on the USB bus with
         # another address.
-        if dev is not None:
-            if dev.address != last_dev_addr:
-                logging.info('Device found')
-                return dev
+        if dev is not None and dev.address != last_dev_addr:
+            return dev
+
+        return None
+
+    logging.info('Waiting for the device...')
+    dev = wait_for(find_device)
+    logging.info('Device found')
 
-        logging.info('Waiting for the device...')
-        time.sleep(1)
+    return dev
 
 
-def run_tpl_stage(reset, erase_code, aml_img, dev_addr_rom_stage):
+def run_tpl_stage(reset, erase_code, aml_img, dev_addr_rom_stage, port=None,
+                  backend=None, restart_data=False):
     # This stage runs, when Uboot is executed on the device.
     # It burns partitions (rom and spl doesn't touch storage)
     # and verifies them.
     logging.info('Running TPL stage...')
 
-    dev = wait_for_device(dev_addr_rom_stage)
+    dev = wait_for_device(dev_addr_rom_stage, port, backend)
 
     epout, epin = get_device_eps(dev)
 
@@ -497,21 +678,23 @@ def run_tpl_stage(reset, erase_code, aml_img, dev_addr_rom_stage):
 
     for item in aml_img.items():
         if item.main_type() == 'PARTITION':
-            tpl_burn_partition(item, aml_img, epout, epin)
+            tpl_burn_partition(item, aml_img, epout, epin, restart_data)
 
     if reset:
         logging.info('Reset')
         send_cmd(epout, epin, 'reboot')
 
 
-def do_adnl_burn(reset, erase_code, aml_img):
+def do_adnl_burn(reset, erase_code, aml_img, port=None, backend=None,
+                 restart_data=False):
     logging.basicConfig(level=logging.INFO,
                         format='[ANDL] %(message)s')
     logging.info('Looking for USB device...')
 
     try:
         dev = usb.core.find(idVendor=AMLOGIC_VENDOR_ID,
-                            idProduct=AMLOGIC_PRODUCT_ID, backend=None)
+                            idProduct=AMLOGIC_PRODUCT_ID, backend=backend,
+                            custom_match=port_match(port))
     except usb.core.NoBackendError:
         logging.error('Please install libusb')
         raise
@@ -530,7 +713,7 @@ def do_adnl_burn(reset, erase_code, aml_img):
     if stage == Stage.TPL:
         send_cmd(epout, epin, 'reboot-romusb')
 
-        dev = wait_for_device(dev_addr_rom_stage)
+        dev = wait_for_device(dev_addr_rom_stage, port, backend)
     elif stage != Stage.ROM:
         raise RuntimeError(f'Unknown stage: {stage.name}')
 
@@ -540,7 +723,8 @@ def do_adnl_burn(reset, erase_code, aml_img):
     has_secureboot = is_secureboot_enabled(epout, epin)
 
     run_bootrom_stage(epout, epin, aml_img, has_secureboot)
-    run_bl2_stage(epout, epin, aml_img, has_secureboot)
-    run_tpl_stage(reset, erase_code, aml_img, dev_addr_rom_stage)
+    run_bl2_stage(epout, epin, aml_img, has_secureboot, restart_data)
+    run_tpl_stage(reset, erase_code, aml_img, dev_addr_rom_stage, port,
+                  backend, restart_data)
 
     logging.info('Done, amazing!')
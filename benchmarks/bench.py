@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-2.0 OR MIT
+# -*- coding: utf-8 -*-
+"""
+Host side throughput benchmarks
+
+Times the real transfer paths against pyamlboot.simulator boards:
+  * boot:     boot.py BootUSB.load_uboot() then a ramdisk write_file()
+  * amlc:     boot-g12.py load_uboot(), with its AMLC streaming loop
+  * media:    optimus BurnStepDownloadMedia._download_media()
+  * adnl-bl2: adnl run_bl2_stage()
+  * adnl-tpl: adnl tpl_burn_partition()
+
+Every case and size runs in a fresh process on synthetic, sparse images,
+reporting the achieved MiB/s against the simulated link rate, the host
+CPU time per MiB and the peak RSS. Results can be saved as a baseline
+and later runs compared against it, exiting with 1 on regressions.
+"""
+
+import argparse
+import hashlib
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from ctypes import sizeof
+
+import usb.core
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+import adnl  # noqa: E402
+from pyamlboot import optimus, pyamlboot, simulator  # noqa: E402
+from pyamlboot.amlimage import (AmlImagePack, AmlImgHead,  # noqa: E402
+                                AmlImgItemInfoV2)
+
+MiB = 1 << 20
+
+DEFAULT_SIZES = '16M,256M'
+DEFAULT_LINK = 40.0
+DEFAULT_LATENCY = 0.125
+DEFAULT_TOLERANCE = 0.15
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                'baseline.json')
+
+BOOT_BOARD = 'libretech-s905x-cc'
+BOOT_DTB_SIZE = 0x10000
+
+PLATFORM_CONF = b'''Platform:0x0811
+DDRLoad:0xd9000000
+DDRRun:0xd9000000
+UbootLoad:0x200c000
+UbootRun:0xd9000000
+Control0=0xc1104174:0x5183
+Control1=0xc110419c:0xb1
+bl2ParaAddr=0xd900c000
+DDRSize:0xc000
+'''
+
+
+def parse_size(text):
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    text = text.strip().upper()
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text, 0)
+
+
+def format_size(size):
+    for unit, shift in (('G', 30), ('M', 20), ('K', 10)):
+        if size >= 1 << shift and size % (1 << shift) == 0:
+            return f'{size >> shift}{unit}'
+    return str(size)
+
+
+def zeros_sha1(size):
+    """Return the hex sha1 of size zero bytes, like the sparse payloads"""
+    digest = hashlib.sha1()
+    chunk = bytes(min(size, MiB))
+    while size > 0:
+        digest.update(chunk[:size])
+        size -= len(chunk)
+    return digest.hexdigest().encode()
+
+
+def make_image(path, partition_size=0, uboot_size=0x100000, adnl_flow=False):
+    """Write a burning image whose payloads are sparse zero holes"""
+    items = [(b'conf', b'platform', PLATFORM_CONF),
+             (b'USB', b'DDR', 0xc000),
+             (b'USB', b'UBOOT', uboot_size),
+             (b'PARTITION', b'data', partition_size),
+             (b'VERIFY', b'data', b'sha1sum ' + zeros_sha1(partition_size))]
+    if adnl_flow:
+        items.append((b'aml', b'usb_flow', b'[usb_flow]\n'))
+
+    head = AmlImgHead()
+    head.vh.version = 2
+    head.magic = 0x27B51956
+    head.item_num = len(items)
+    offset = sizeof(head) + len(items) * sizeof(AmlImgItemInfoV2)
+
+    with open(path, 'wb') as f:
+        f.write(bytes(head))
+        contents = []
+        for i, (main_type, sub_type, data) in enumerate(items):
+            size = data if isinstance(data, int) else len(data)
+            f.write(bytes(AmlImgItemInfoV2(id=i, offset_in_img=offset,
+                                           size=size, main_type=main_type,
+                                           sub_type=sub_type)))
+            if not isinstance(data, int):
+                contents.append((offset, data))
+            offset += size
+
+        for pos, data in contents:
+            f.seek(pos)
+            f.write(data)
+        f.truncate(offset)
+
+    return AmlImagePack(path, use_mmap=True)
+
+
+def make_file(path, size):
+    with open(path, 'wb') as f:
+        f.truncate(size)
+    return path
+
+
+def simulated(link, **kwargs):
+    """Return a backend of one board, quiet enough to be measured"""
+    return simulator.SimulatorBackend(simulator.SimulatedDevice(
+        bandwidth=link['bandwidth'], latency=link['latency'], verify=False,
+        keep_memory=False, reenumerate_delay=0, **kwargs))
+
+
+def bench_boot(workdir, size, link):
+    boot = importlib.import_module('boot')
+    fpath = os.path.join(ROOT, 'files')
+    ramfs = make_file(os.path.join(workdir, 'ramfs'), size)
+    dtb = make_file(os.path.join(workdir, 'dtb'), BOOT_DTB_SIZE)
+
+    usb = boot.BootUSB(BOOT_BOARD, fpath, None, usb_backend=simulated(link))
+
+    def run():
+        usb.load_uboot()
+        usb.write_file(ramfs, usb.UBOOT_INITRDADDR, 512, True)
+        # Written through writeMemory, which must have probed its way to
+        # large memory requests
+        usb.write_file(dtb, usb.UBOOT_DTBADDR)
+        if not usb.dev._routedBlockLengths(write=True):
+            raise RuntimeError('boot.py writeMemory did not take the bulk path')
+        usb.run_uboot()
+
+    return run, size
+
+
+def bench_amlc(workdir, size, link):
+    boot_g12 = importlib.import_module('boot-g12')
+    path = make_file(os.path.join(workdir, 'u-boot.bin'), size)
+    dev = pyamlboot.AmlogicSoC(usb_backend=simulated(link, soc='g12',
+                                                     tpl_size=size))
+
+    def run():
+        with open(path, 'rb') as f:
+            boot_g12.load_uboot(dev, memoryview(f.read()), path)
+
+    return run, size
+
+
+def bench_media(workdir, size, link):
+    img = make_image(os.path.join(workdir, 'media.img'), partition_size=size)
+    item = img.item_get('PARTITION', 'data')
+    dev = optimus.wait_device(backend=simulated(link,
+                                                stage=simulator.STAGE_TPL))
+
+    step = optimus.BurnStepDownloadMedia(optimus.SharedData(),
+                                         images={('PARTITION', 'data'): item},
+                                         verify_images={},
+                                         path='PARTITION', part='data')
+    step._dev = dev
+    step._send_download()
+
+    return step._download_media, size
+
+
+def _adnl_eps(link, **kwargs):
+    backend = simulated(link, protocol='adnl', **kwargs)
+    dev = usb.core.find(idVendor=adnl.AMLOGIC_VENDOR_ID,
+                        idProduct=adnl.AMLOGIC_PRODUCT_ID, backend=backend)
+    return adnl.get_device_eps(dev)
+
+
+def bench_adnl_bl2(workdir, size, link):
+    img = make_image(os.path.join(workdir, 'adnl.img'), uboot_size=size,
+                     adnl_flow=True)
+    epout, epin = _adnl_eps(link, stage=simulator.STAGE_SPL, tpl_size=size)
+
+    return lambda: adnl.run_bl2_stage(epout, epin, img, False), size
+
+
+def bench_adnl_tpl(workdir, size, link):
+    img = make_image(os.path.join(workdir, 'adnl.img'), partition_size=size,
+                     adnl_flow=True)
+    item = img.item_get('PARTITION', 'data')
+    epout, epin = _adnl_eps(link, stage=simulator.STAGE_TPL)
+
+    return lambda: adnl.tpl_burn_partition(item, img, epout, epin), size
+
+
+# name: (setup, largest size the flow can carry)
+CASES = {
+    'boot': (bench_boot, 2 << 30),
+    'amlc': (bench_amlc, 256 * MiB),
+    'media': (bench_media, None),
+    'adnl-bl2': (bench_adnl_bl2, 256 * MiB),
+    'adnl-tpl': (bench_adnl_tpl, None),
+}
+
+
+def run_case(name, size, link, workdir):
+    """Run one case, meant to be called in a fresh process"""
+    logging.disable(logging.CRITICAL)
+    sys.stdout = open(os.devnull, 'w')
+
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+        run, nbytes = CASES[name][0](tmp, size, link)
+
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        run()
+        cpu = time.process_time() - cpu
+        wall = time.perf_counter() - wall
+
+    # ru_maxrss is in KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss = rss / MiB if sys.platform == 'darwin' else rss / 1024
+
+    mib = nbytes / MiB
+    link_mib_s = link['bandwidth'] / MiB if link['bandwidth'] else None
+    return {
+        'case': name,
+        'size': size,
+        'wall_s': wall,
+        'cpu_s': cpu,
+        'mib_s': mib / wall,
+        'link_ratio': mib / wall / link_mib_s if link_mib_s else None,
+        'cpu_s_per_mib': cpu / mib,
+        'peak_rss_mib': rss,
+    }
+
+
+def compare(result, base, tolerance):
+    """Return the list of regressions of result against base"""
+    checks = (('cpu_s_per_mib', 1), ('mib_s', -1), ('peak_rss_mib', 1))
+    regressions = []
+
+    for key, sign in checks:
+        value, ref = result[key], base.get(key)
+        if not ref:
+            continue
+        change = (value - ref) / ref
+        if change * sign > tolerance:
+            regressions.append(f'{key} {ref:.4g} -> {value:.4g} '
+                               f'({change:+.0%})')
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Host side transfer benchmarks on simulated boards',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--cases', default=','.join(CASES),
+                        help='Comma separated cases to run')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help='Comma separated payload sizes, like 16M,8G')
+    parser.add_argument('--link', type=float, default=DEFAULT_LINK,
+                        help='Simulated link rate in MiB/s, 0 for unlimited')
+    parser.add_argument('--latency', type=float, default=DEFAULT_LATENCY,
+                        help='Simulated latency per transfer in milliseconds')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='Baseline file to compare against')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Relative change reported as a regression')
+    parser.add_argument('--workdir', default=None,
+                        help='Directory for the synthetic images')
+    parser.add_argument('--json', metavar='FILE',
+                        help='Write the results as JSON to FILE')
+    args = parser.parse_args()
+
+    cases = args.cases.split(',')
+    for name in cases:
+        if name not in CASES:
+            parser.error(f'Unknown case {name}, choose from {", ".join(CASES)}')
+    sizes = [parse_size(s) for s in args.sizes.split(',')]
+    link = {'bandwidth': int(args.link * MiB) or None,
+            'latency': args.latency / 1000}
+
+    baseline = None
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if (baseline['link_mib_s'], baseline['latency_ms']) != \
+                (args.link, args.latency):
+            print(f'Ignoring {args.baseline}: recorded with a '
+                  f'{baseline["link_mib_s"]} MiB/s, '
+                  f'{baseline["latency_ms"]} ms link')
+            baseline = None
+
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    failed = 0
+
+    print(f'{"CASE":<9} {"SIZE":>5} {"MiB/s":>8} {"LINK%":>6} '
+          f'{"CPU ms/MiB":>10} {"RSS MiB":>8}')
+    for name in cases:
+        for size in sizes:
+            limit = CASES[name][1]
+            if limit is not None and size > limit:
+                print(f'{name:<9} {format_size(size):>5} skipped, '
+                      f'over {format_size(limit)}')
+                continue
+
+            with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+                r = pool.submit(run_case, name, size, link,
+                                args.workdir).result()
+            results.append(r)
+
+            ratio = f'{r["link_ratio"]:.0%}' if r['link_ratio'] else '-'
+            line = (f'{name:<9} {format_size(size):>5} {r["mib_s"]:8.1f} '
+                    f'{ratio:>6} {r["cpu_s_per_mib"] * 1000:10.2f} '
+                    f'{r["peak_rss_mib"]:8.1f}')
+
+            key = f'{name}@{format_size(size)}'
+            base = baseline and baseline['results'].get(key)
+            if base:
+                regressions = compare(r, base, args.tolerance)
+                if regressions:
+                    failed += 1
+                    line += '  REGRESSION: ' + ', '.join(regressions)
+            print(line, flush=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({
+                'link_mib_s': args.link,
+                'latency_ms': args.latency,
+                'results': {f'{r["case"]}@{format_size(r["size"])}': r
+                            for r in results},
+            }, f, indent=2)
+            f.write('\n')
+        print(f'Baseline written to {args.baseline}')
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
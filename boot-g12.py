@@ -3,10 +3,11 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-import time
 import os
 import pkg_resources
 from pyamlboot import pyamlboot
+from pyamlboot.socid import SocId
+from pyamlboot.stages import StageTimeout, in_stage, wait_stage
 
 def list_boards(p):
     return [ d for d in os.listdir(p) if os.path.isdir(os.path.join(p, d)) and os.path.isfile(os.path.join(p, d, "u-boot.bin")) ]
@@ -33,6 +34,44 @@ def parse_cmdline(fpath):
 
     return args
 
+LOAD_ADDR = 0xfffa0000
+
+def load_uboot(dev, data, name="u-boot"):
+    seq = 0
+
+    print("Writing %s at 0x%x..." % (name, LOAD_ADDR))
+    dev.writeLargeMemory(LOAD_ADDR, data[0:0x10000],
+                         dev.tunedBlockLength('write_large', 4096))
+    print("[DONE]")
+
+    print("Running at 0x%x..." % LOAD_ADDR)
+    dev.run(LOAD_ADDR)
+    print("[DONE]")
+
+    # BL2 answers AMLC requests once it took over
+    try:
+        wait_stage(dev, in_stage(SocId.STAGE_MINOR_SPL), 2, 'BL2')
+    except StageTimeout:
+        pass
+
+    prevLength = -1
+    prevOffset = -1
+    while True:
+        (length, offset) = dev.getBootAMLC()
+
+        if length == prevLength and offset == prevOffset:
+            print("[BL2 END]")
+            break
+
+        prevLength = length
+        prevOffset = offset
+
+        print("AMLC dataSize=%d, offset=%d, seq=%d..." % (length, offset, seq))
+        dev.writeAMLCData(seq, offset, data[offset:offset+length])
+        print("[DONE]")
+
+        seq = seq + 1
+
 if __name__ == '__main__':
     try:
         dist = pkg_resources.get_distribution('pyamlboot')
@@ -58,35 +97,5 @@ if __name__ == '__main__':
     print("ROM: %d.%d Stage: %d.%d" % (ord(socid[0]), ord(socid[1]), ord(socid[2]), ord(socid[3])))
     print("Need Password: %d Password OK: %d" % (ord(socid[4]), ord(socid[5])))
 
-    loadAddr = 0xfffa0000
     with open(bpath, "rb") as f:
-        seq = 0
-        data = f.read()
-
-        print("Writing %s at 0x%x..." % (bpath, loadAddr))
-        dev.writeLargeMemory(0xfffa0000, data[0:0x10000], 4096)
-        print("[DONE]")
-
-        print("Running at 0x%x..." % loadAddr)
-        dev.run(0xfffa0000)
-        print("[DONE]")
-
-        time.sleep(2)
-
-        prevLength = -1
-        prevOffset = -1
-        while True:
-            (length, offset) = dev.getBootAMLC()
-
-            if length == prevLength and offset == prevOffset:
-                print("[BL2 END]")
-                break
-
-            prevLength = length
-            prevOffset = offset
-
-            print("AMLC dataSize=%d, offset=%d, seq=%d..." % (length, offset, seq))
-            dev.writeAMLCData(seq, offset, data[offset:offset+length])
-            print("[DONE]")
-
-            seq = seq + 1
+        load_uboot(dev, memoryview(f.read()), bpath)
@@ -3,17 +3,20 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-import time
 import sys
 import os
 import pkg_resources
-from pyamlboot import pyamlboot
+from struct import unpack
+from pyamlboot import metrics, pyamlboot
+from pyamlboot.socid import SocId
+from pyamlboot.stages import PARA_DONE_MAGIC, StageTimeout, wait_stage
 
 gx_boards = {"libretech-s905x-cc", "libretech-s805x-ac", "khadas-vim", "khadas-vim2", "odroid-c2", "nanopi-k2", "p212", "p230", "p231", "q200", "q201", "p281", "p241", "libretech-s912-pc", "libretech-s905d-pc"}
 axg_boards = {"s400", "s420", "apollo" }
 
 class BootUSB:
-    def __init__(self, board, fpath, upath):
+    def __init__(self, board, fpath, upath, timeout=0, usb_backend=None,
+                 fill_zeros=False):
         self.UBOOT_SCRIPTADDR = 0x8000000
         self.UBOOT_IMAGEADDR = 0x8080000
         self.UBOOT_DTBADDR = 0x8008000
@@ -39,19 +42,33 @@ class BootUSB:
             sys.stderr.write('Unsupported board %s, please fill boot parameters\n' % board)
             sys.exit(1)
 
-        if args.timeout is None or args.timeout > 0:
+        if timeout is None or timeout > 0:
             print("Waiting for device to enumerate...")
 
-        self.dev = pyamlboot.AmlogicSoC(timeout=args.timeout)
+        self.dev = pyamlboot.AmlogicSoC(timeout=timeout, usb_backend=usb_backend)
         self.fpath = fpath
+        self.fill_zeros = fill_zeros
         if upath:
             self.bpath = upath
         else:
             self.bpath = os.path.join(fpath, board)
 
-    def wait(self, t):
+    def para_done(self):
+        return unpack('<I', self.dev.readSimpleMemory(self.BL2_PARAMS, 4))[0] == PARA_DONE_MAGIC
+
+    def wait(self, ready, t, required=False):
+        """Wait up to t seconds for BL2 to be ready
+
+        If it is not observed, carry on like after a fixed delay unless
+        it is required.
+        """
         print("Waiting...");
-        time.sleep(t)
+        try:
+            wait_stage(self.dev, ready, t, 'BL2')
+        except StageTimeout as e:
+            if required:
+                raise
+            sys.stderr.write('%s, carrying on\n' % e)
         print("[DONE]")
 
     def soc_id(self):
@@ -62,11 +79,11 @@ class BootUSB:
     def write_file(self, path, addr, large = None, fill = False):
         print("Writing %s at 0x%x..." % (path, addr))
         with open(path, "rb") as f:
-            b = f.read()
-        if large is not None:
-            self.dev.writeLargeMemory(addr, b, large, fill)
-        else:
-            self.dev.writeMemory(addr, b)
+            if large is not None:
+                # Streamed from the file with bounded memory
+                self.dev.writeLargeMemory(addr, f, large, fill, self.fill_zeros)
+            else:
+                self.dev.writeMemory(addr, f.read())
         print("[DONE]")
 
     def run(self, addr):
@@ -79,21 +96,24 @@ class BootUSB:
         self.write_file(os.path.join(self.bpath, self.BL2_FILE), self.DDR_LOAD)
         self.write_file(os.path.join(self.fpath, self.DDR_FILE), self.BL2_PARAMS, large = 32)
         self.run(self.DDR_LOAD)
-        self.wait(1)
+        # BL2 waits to be run with its parameters, or runs them right away
+        self.wait(lambda socid: socid.stage_minor == SocId.STAGE_MINOR_SPL or
+                  self.para_done(), 1)
 
         self.soc_id()
-        if ord(self.socid[3]) == 8:
+        if ord(self.socid[3]) == SocId.STAGE_MINOR_SPL:
             self.run(self.BL2_PARAMS)
-            self.wait(1)
+            # DDR init is not done until BL2 marked its parameters
+            self.wait(lambda socid: self.para_done(), 1, required=True)
 
     def load_uboot(self):
         self.init_ddr()
         self.write_file(os.path.join(self.bpath, self.BL2_FILE), self.DDR_LOAD, large = 64)
         self.write_file(os.path.join(self.fpath, self.FIP_FILE), self.BL2_PARAMS, large = 48)
-        self.write_file(os.path.join(self.bpath, self.TPL_FILE), self.UBOOT_LOAD, large = 64, fill = True)
+        self.write_file(os.path.join(self.bpath, self.TPL_FILE), self.UBOOT_LOAD, large = self.dev.tunedBlockLength('write_large', 64), fill = True)
 
     def run_uboot(self):
-        if ord(self.socid[3]) == 8:
+        if ord(self.socid[3]) == SocId.STAGE_MINOR_SPL:
             self.run(self.BL2_PARAMS)
         else:
             self.run(self.DDR_LOAD)
@@ -126,6 +146,10 @@ def parse_cmdline(boards):
                         help="ramfs file to load")
     parser.add_argument('--timeout', type=parse_wait, action='store', default=0,
                         help="Timeout in seconds for device to enumerate")
+    parser.add_argument('--metrics', dest='metricsfile', action='store',
+                        help="Dump transfer metrics as JSON to this file")
+    parser.add_argument('--fill-zeros', action='store_true',
+                        help="Write large zero runs with fill requests instead of data")
 
     args = parser.parse_args()
 
@@ -140,12 +164,15 @@ if __name__ == '__main__':
         fpath = os.path.join(os.path.dirname(os.path.realpath(__file__)), "files")
     boards = list_boards(fpath)
     args = parse_cmdline(boards)
-    usb = BootUSB(args.board, fpath, args.upath)
+    if args.metricsfile is not None:
+        metrics.enable()
+    usb = BootUSB(args.board, fpath, args.upath, args.timeout,
+                  fill_zeros=args.fill_zeros)
 
     usb.load_uboot()
 
     if args.imagefile is not None:
-        usb.write_file(args.imagefile, usb.UBOOT_IMAGEADDR, 512, True)
+        usb.write_file(args.imagefile, usb.UBOOT_IMAGEADDR, usb.dev.tunedBlockLength('write_large', 512), True)
 
     if args.dtbfile is not None:
         usb.write_file(args.dtbfile, usb.UBOOT_DTBADDR)
@@ -154,6 +181,9 @@ if __name__ == '__main__':
         usb.write_file(args.scriptfile, usb.UBOOT_SCRIPTADDR)
 
     if args.ramfsfile is not None:
-        usb.write_file(args.ramfsfile, usb.UBOOT_INITRDADDR, 512, True)
+        usb.write_file(args.ramfsfile, usb.UBOOT_INITRDADDR, usb.dev.tunedBlockLength('write_large', 512), True)
 
     usb.run_uboot()
+
+    if args.metricsfile is not None:
+        metrics.collector.dump(args.metricsfile)
@@ -21,8 +21,7 @@ if __name__ == '__main__':
 
     print("Writing u-boot.bin...")
     with open(sys.argv[1], "rb") as f:
-            b = f.read()
-    dev.writeLargeMemory(UBOOT_ADDR, b, 512, True)
+        dev.writeLargeMemory(UBOOT_ADDR, f, 512, True)
 
     print("Running go...")
     dev.tplCommand(1, "go 0x%x" % (UBOOT_ADDR))
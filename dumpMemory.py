@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: Apache-2.0 OR MIT
+# -*- coding: utf-8 -*-
+
+#
+# Command to dump a memory range of a board in USB boot mode, from the ROM,
+# BL2 or U-Boot, to a file
+#
+
+import argparse
+import sys
+
+from pyamlboot import dump, metrics, pyamlboot
+
+def parse_int(value):
+    return int(value, 0)
+
+def show_progress(done, length, rate):
+    sys.stdout.write("\r%d/%d MiB %.1f MiB/s" % (done >> 20, length >> 20, rate))
+    sys.stdout.flush()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Dump Amlogic SoC memory to a file, resuming interrupted dumps")
+    parser.add_argument('address', type=parse_int,
+                        help="start address")
+    parser.add_argument('length', type=parse_int,
+                        help="length in bytes")
+    parser.add_argument('output',
+                        help="output file, with a .ckpt checkpoint next to it")
+    parser.add_argument('--block-length', type=parse_int,
+                        help="bulk block length for ROM and BL2 reads, autotuned by default")
+    parser.add_argument('--timeout', type=int,
+                        help="per transfer timeout in milliseconds, adaptive by default")
+    parser.add_argument('--hash', dest='algorithm', default='sha256',
+                        help="hashlib algorithm of the reported digest")
+    parser.add_argument('--restart', action='store_true',
+                        help="ignore the checkpoint and dump from the start")
+    parser.add_argument('--metrics', dest='metricsfile', action='store',
+                        help="Dump transfer metrics as JSON to this file")
+
+    args = parser.parse_args()
+
+    if args.metricsfile is not None:
+        metrics.enable()
+
+    dev = pyamlboot.AmlogicSoC()
+
+    print("Dumping 0x%x bytes at 0x%x to %s..." % (args.length, args.address, args.output))
+    try:
+        ret = dump.dump_memory(dev, args.address, args.length, args.output,
+                               args.block_length, args.timeout, args.algorithm,
+                               resume=not args.restart, progress=show_progress)
+    except KeyboardInterrupt:
+        print("\nInterrupted, run again to resume")
+        sys.exit(1)
+    print()
+
+    if ret.resumed:
+        print("Resumed at offset 0x%x" % ret.resumed)
+    print("%s  %s" % (ret.digest, args.output))
+    print("%.1f MiB/s" % ret.mib_per_s)
+
+    if args.metricsfile is not None:
+        metrics.collector.dump(args.metricsfile)
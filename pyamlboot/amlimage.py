@@ -13,12 +13,32 @@ Amlogic Burning Image manipulation Library
 
 import hashlib
 import io
+import logging
+import mmap
 import os
 import sys
 from ctypes import (LittleEndianStructure, c_byte, c_char, c_uint16, c_uint32,
                     c_uint64, sizeof)
 
 
+# Readahead started when an item transfer begins, the kernel sequential
+# readahead keeps ahead of it from there
+ADVISE_WINDOW = 0x1000000
+
+_logger = logging.getLogger(__name__)
+
+
+def _map_file(f):
+    """Return a read-only memoryview of a whole file, None if not mappable"""
+    try:
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    except (AttributeError, OSError, ValueError, OverflowError) as e:
+        # Special files, empty files and images larger than the address space
+        _logger.debug('Reading %s instead of mapping it: %s',
+                      getattr(f, 'name', f), e)
+        return None
+
+
 class AmlImgVersionHead(LittleEndianStructure):
     _pack_ = 1
     _fields_ = [
@@ -78,9 +98,11 @@ class AmlImgItemInfoV2(AmlImgItemInfo):
 
 
 class AmlImageItem:
-    def __init__(self, f, info: AmlImgItemInfo):
+    def __init__(self, f, info: AmlImgItemInfo, mapping=None):
         self._f = f
         self._info = info
+        # memoryview of the whole mapped file holding the item, if any
+        self._map = mapping
         self._main_type = info.main_type.decode('utf-8')
         self._sub_type = info.sub_type.decode('utf-8')
 
@@ -95,6 +117,53 @@ class AmlImageItem:
 
         return ret
 
+    def read_view(self, size=-1):
+        """Read like read(), but return a memoryview
+
+        When the image is mapped, the view points into the mapping and
+        nothing is copied. It stays valid as long as the pack.
+        """
+        if self._map is None:
+            return memoryview(self.read(size))
+
+        offset = self.tell()
+        if size == -1 or (offset + size) > self.size():
+            size = self.size() - offset
+
+        start = self._info.offset_in_img + offset
+        self._info.cur_offset += size
+        return self._map[start:start + size]
+
+    def advise(self):
+        """Hint the page cache that the item is about to be read in order
+
+        The whole item is marked sequential and its first ADVISE_WINDOW
+        bytes are read ahead, with madvise() when the image is mapped, else
+        posix_fadvise(). A no-op where neither is available.
+        """
+        start = self._info.offset_in_img
+        length = self.size()
+        if not length:
+            return
+
+        try:
+            if self._map is not None:
+                mapping = self._map.obj
+                # madvise() ranges start on a page boundary
+                aligned = start - start % mmap.PAGESIZE
+                length = length + start - aligned
+                mapping.madvise(mmap.MADV_SEQUENTIAL, aligned, length)
+                mapping.madvise(mmap.MADV_WILLNEED, aligned,
+                                min(length, ADVISE_WINDOW))
+            else:
+                fd = self._f.fileno()
+                os.posix_fadvise(fd, start, length,
+                                 os.POSIX_FADV_SEQUENTIAL)
+                os.posix_fadvise(fd, start, min(length, ADVISE_WINDOW),
+                                 os.POSIX_FADV_WILLNEED)
+        except (AttributeError, OSError) as e:
+            _logger.debug('No readahead hint for %s: %s', self._sub_type, e)
+
     def seek(self, pos, whence=0):
         if whence == 0:
             if pos < 0:
@@ -138,8 +207,15 @@ class AmlImageItem:
 
 
 class AmlImagePack:
-    def __init__(self, name, is_cfg=False):
+    """Amlogic burning image, or the files listed by an image.cfg
+
+    With use_mmap, the image files are mapped read-only instead of being
+    read, and read_view() on its items returns views into the mapping.
+    """
+
+    def __init__(self, name, is_cfg=False, use_mmap=False):
         self._iscfg = False
+        self._use_mmap = use_mmap
         if is_cfg:
             self._opendir(name)
         else:
@@ -185,12 +261,14 @@ class AmlImagePack:
         else:
             raise NotImplementedError(f'Unknown version {version}')
 
+        mapping = _map_file(f) if self._use_mmap else None
+
         self._items = []
         for i in range(self._head.item_num):
             item = item_info_v()
             read = f.readinto(item)
             assert read == sizeof(item)
-            self._items.append(AmlImageItem(f, item))
+            self._items.append(AmlImageItem(f, item, mapping))
 
         self._f = f
 
@@ -239,7 +317,8 @@ class AmlImagePack:
                 _id += 1
 
                 f = open(full_file_path, "rb")
-                newitem = AmlImageItem(f, info)
+                mapping = _map_file(f) if self._use_mmap else None
+                newitem = AmlImageItem(f, info, mapping)
                 self._items.append(newitem)
                 if info.verify:
                     info_verify = AmlImgItemInfoV2(
@@ -0,0 +1,194 @@
+# SPDX-License-Identifier: GPL-2.0 OR MIT
+# -*- coding: utf-8 -*-
+"""
+Transfer block length autotuning
+
+The fastest large memory block length depends on the SoC, the boot stage
+answering and the host controller. autotune() sweeps the allowed block
+lengths of each transfer kind on the connected board, through a scratch
+memory area, and stores the fastest one that read back correctly in a
+profile. Profiles are kept on disk, in
+$XDG_CACHE_HOME/pyamlboot/transfers.json, per SoC and stage (USB device
+descriptor and identify() bytes) and per host (host name, USB bus and
+backend).
+
+AmlogicSoC large memory transfers called without a block length use the
+profile of their board, or their former default when it was not tuned.
+
+Run as a module to tune the connected board:
+
+    python3 -m pyamlboot.autotune 0x1000000
+"""
+
+import json
+import logging
+import os
+import platform
+import time
+
+from .capabilities import cache_dir
+from .socid import SocId
+from .usb_backend import backend_name
+
+__all__ = ['autotune', 'get_profile', 'profile_key', 'profile_path',
+           'clear_profiles', 'TRANSFER_KINDS', 'TUNED_BLOCK_LENGTHS']
+
+# Large memory writes and reads
+TRANSFER_KINDS = ('write_large', 'read_large')
+# Swept smallest first: the sweep of a kind stops at the first failure,
+# a board left waiting for the blocks it did not get
+TUNED_BLOCK_LENGTHS = (64, 512, 4096, 16384)
+TUNE_LENGTH = 0x40000
+
+PROFILES_VERSION = 1
+
+_logger = logging.getLogger(__name__)
+
+# Profiles file contents, loaded once per process
+_profiles = None
+
+
+def profile_path():
+    return os.path.join(cache_dir(), 'transfers.json')
+
+
+def _load_profiles():
+    global _profiles
+
+    if _profiles is None:
+        try:
+            with open(profile_path()) as f:
+                _profiles = json.load(f)
+            if _profiles.get('version') != PROFILES_VERSION:
+                _profiles = None
+        except (OSError, ValueError) as e:
+            _logger.debug('No transfer profiles: %s', e)
+        if _profiles is None:
+            _profiles = {'version': PROFILES_VERSION, 'profiles': {}}
+
+    return _profiles
+
+
+def _save_profiles():
+    path = profile_path()
+    tmp = path + '.tmp'
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp, 'w') as f:
+            json.dump(_profiles, f, indent=1, sort_keys=True)
+        os.replace(tmp, path)
+    except OSError as e:
+        _logger.warning('Can not save transfer profiles: %s', e)
+
+
+def clear_profiles():
+    global _profiles
+
+    _profiles = None
+    try:
+        os.remove(profile_path())
+    except FileNotFoundError:
+        pass
+
+
+def profile_key(dev):
+    """Return the profile key of an AmlogicSoC: its SoC, stage and host"""
+    desc = dev.dev
+    raw = dev.identify().encode('latin-1')
+    return (f'{desc.idVendor:04x}:{desc.idProduct:04x}:{desc.bcdDevice:04x}:'
+            f'{raw.hex()}@{platform.node()}:{desc.bus}:{backend_name(desc)}')
+
+
+def get_profile(dev):
+    """Return the stored profile of dev, None if it was never tuned"""
+    return _load_profiles()['profiles'].get(profile_key(dev))
+
+
+def _pattern(length, seed):
+    return (bytes(range(seed, 256)) + bytes(range(seed))) * (length // 256)
+
+
+def _sweep(dev, address, length, kind):
+    """Return {block length: MiB/s} of the block lengths which worked"""
+    rates = {}
+    readback = bytearray(length)
+
+    for seed, block_length in enumerate(TUNED_BLOCK_LENGTHS):
+        data = _pattern(length, seed + 1)
+        # The other direction uses the smallest block length, the former
+        # default
+        write_length = (block_length if kind == 'write_large'
+                        else TUNED_BLOCK_LENGTHS[0])
+        read_length = (block_length if kind == 'read_large'
+                       else TUNED_BLOCK_LENGTHS[0])
+        try:
+            start = time.perf_counter()
+            dev.writeLargeMemory(address, data, write_length)
+            written = time.perf_counter()
+            dev.readLargeMemoryInto(address, readback, read_length)
+            read = time.perf_counter()
+        except Exception as e:
+            _logger.warning('%s with %d byte blocks failed: %s', kind,
+                            block_length, e)
+            break
+
+        if readback != data:
+            _logger.warning('%s with %d byte blocks read back wrong data',
+                            kind, block_length)
+            break
+
+        seconds = written - start if kind == 'write_large' else read - written
+        rates[block_length] = length / seconds / (1 << 20)
+        _logger.info('%s with %d byte blocks: %.1f MiB/s', kind,
+                     block_length, rates[block_length])
+
+    return rates
+
+
+def autotune(dev, address, length=TUNE_LENGTH, save=True):
+    """Sweep the block lengths of every transfer kind, return the profile
+
+    address is a scratch memory area of length bytes, which is
+    overwritten. Large memory requests are only served by the ROM and BL2.
+    The profile maps 'block_lengths' to the fastest block length of each
+    kind, and 'rates' to the MiB/s measured for each kind and block length.
+    """
+    if SocId(dev.identify()).stage_minor == SocId.STAGE_MINOR_TPL:
+        raise RuntimeError('Large memory transfers can not be tuned in U-Boot')
+
+    profile = {'block_lengths': {}, 'rates': {}}
+    for kind in TRANSFER_KINDS:
+        rates = _sweep(dev, address, length, kind)
+        if not rates:
+            raise RuntimeError(f'No block length works for {kind}')
+        profile['block_lengths'][kind] = max(rates, key=rates.get)
+        profile['rates'][kind] = {str(k): v for k, v in rates.items()}
+
+    if save:
+        _load_profiles()['profiles'][profile_key(dev)] = profile
+        _save_profiles()
+        dev.transferProfile(refresh=True)
+
+    return profile
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from .pyamlboot import AmlogicSoC
+
+    parser = argparse.ArgumentParser(
+        description="Tune the transfer block lengths of the connected board")
+    parser.add_argument('address', type=lambda v: int(v, 0),
+                        help="scratch memory address, overwritten")
+    parser.add_argument('--length', type=lambda v: int(v, 0),
+                        default=TUNE_LENGTH, help="scratch memory length")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    dev = AmlogicSoC()
+    profile = autotune(dev, args.address, args.length)
+    for kind, block_length in profile['block_lengths'].items():
+        print(f'{kind:<12} {block_length:6d} bytes '
+              f'{profile["rates"][kind][str(block_length)]:8.1f} MiB/s')
+    print(f'Saved to {profile_path()}')
@@ -0,0 +1,256 @@
+# SPDX-License-Identifier: GPL-2.0 OR MIT
+# -*- coding: utf-8 -*-
+"""
+Boot stage capabilities
+
+What a connected board can do depends on the SoC, its ROM version and the
+boot stage answering. probe() works it out once per connection from the
+identify() bytes and a few harmless requests: NOP, then when a readable
+probe address is known, simple and large memory reads with each block
+length. Nothing is written to the device, unless the caller hands a
+scratch address over: two blocks of each block length are then written
+back there and read again. The other requests and the checksums are the
+defaults of the stage, they are not probed.
+
+Results are cached on disk, keyed by the USB device descriptor and the
+identify() bytes, so later connections to the same SoC and firmware skip
+probing. Probes which timed out or came back short may be transient:
+their results are only kept for the connection, never cached. The cache
+lives in $XDG_CACHE_HOME/pyamlboot/capabilities.json.
+"""
+
+import errno
+import json
+import logging
+import os
+from dataclasses import asdict, dataclass, field
+
+import usb.core
+
+from .socid import SocId
+
+__all__ = ['Capabilities', 'probe', 'get_capabilities', 'cache_dir',
+           'cache_path', 'clear_cache']
+
+# Large memory block lengths tried, fastest first
+PROBE_BLOCK_LENGTHS = (4096, 512, 64)
+PROBE_TIMEOUT = 100
+# Bytes read, or written back, at most from the probe and scratch addresses
+PROBE_LENGTH = 2 * max(PROBE_BLOCK_LENGTHS)
+
+# Reads dropped at most after a probe which timed out
+PROBE_DRAIN_BLOCKS = 8
+
+CACHE_VERSION = 3
+
+_logger = logging.getLogger(__name__)
+
+# Cache file contents, loaded once per process
+_cache = None
+
+
+@dataclass
+class Capabilities:
+    """Features of the boot stage a board is currently in"""
+    identify: str
+    stage: tuple
+    # run() may ask the ROM to keep the power on
+    keep_power: bool
+    # BL2 loads the next stage through AMLC requests
+    amlc: bool
+    # Requests served: NOP and the memory ones are probed, the others are
+    # the defaults of the stage
+    requests: list = field(default_factory=list)
+    # Large memory block lengths answered by two block reads, fastest first
+    block_lengths: list = field(default_factory=list)
+    # Two block large writes of each block length read back right, only
+    # probed at a scratch address
+    multi_block_write: bool = False
+    # Checksums writeMedia() accepts by default in the stage, not probed
+    default_checksums: list = field(default_factory=list)
+    # Every probe was answered or refused: only then cached on disk
+    settled: bool = True
+
+    def supports(self, request):
+        return request in self.requests
+
+    @classmethod
+    def from_dict(cls, d):
+        d = dict(d)
+        d['stage'] = tuple(d['stage'])
+        return cls(**d)
+
+
+def cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'pyamlboot')
+
+
+def cache_path():
+    return os.path.join(cache_dir(), 'capabilities.json')
+
+
+def _load_cache():
+    global _cache
+
+    if _cache is None:
+        try:
+            with open(cache_path()) as f:
+                _cache = json.load(f)
+            if _cache.get('version') != CACHE_VERSION:
+                _cache = None
+        except (OSError, ValueError) as e:
+            _logger.debug('No capability cache: %s', e)
+        if _cache is None:
+            _cache = {'version': CACHE_VERSION, 'devices': {}}
+
+    return _cache
+
+
+def _save_cache():
+    path = cache_path()
+    tmp = path + '.tmp'
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp, 'w') as f:
+            json.dump(_cache, f, indent=1, sort_keys=True)
+        os.replace(tmp, path)
+    except OSError as e:
+        _logger.warning('Can not save capability cache: %s', e)
+
+
+def clear_cache():
+    global _cache
+
+    _cache = None
+    try:
+        os.remove(cache_path())
+    except FileNotFoundError:
+        pass
+
+
+def _cache_key(dev, raw, probe_address, scratch_address, length):
+    desc = dev.dev
+    addresses = ':'.join('none' if address is None else f'{address:x}'
+                         for address in (probe_address, scratch_address))
+    return (f'{desc.idVendor:04x}:{desc.idProduct:04x}:'
+            f'{desc.bcdDevice:04x}:{raw.hex()}:{addresses}:{length:x}')
+
+
+def _drain(dev):
+    """Drop the blocks a timed out probe may have left pending"""
+    ep, _ = dev._endpoints()
+    for _ in range(PROBE_DRAIN_BLOCKS):
+        try:
+            ep.read(max(PROBE_BLOCK_LENGTHS), PROBE_TIMEOUT)
+        except usb.core.USBError:
+            return
+
+
+def _answers(dev, caps, fn, *args):
+    """Return whether fn(*args) went through
+
+    A stall is a refusal. Anything else, a timeout or a short block, may be
+    transient: caps is marked unsettled and the device drained before the
+    next probe.
+    """
+    try:
+        fn(*args)
+    except (usb.core.USBError, ValueError) as e:
+        _logger.debug('Probe %s failed: %s', fn.__name__, e)
+        if getattr(e, 'errno', None) != errno.EPIPE:
+            caps.settled = False
+            _drain(dev)
+        return False
+    return True
+
+
+def _round_trip(dev, address, block_length):
+    """Write two blocks at address back as large blocks, check they read back"""
+    data = bytearray(2 * block_length)
+    dev.readLargeMemoryInto(address, data, block_length, PROBE_TIMEOUT)
+    dev.writeLargeMemory(address, data, block_length)
+    check = bytearray(len(data))
+    dev.readLargeMemoryInto(address, check, block_length, PROBE_TIMEOUT)
+    if check != data:
+        raise ValueError('Large write read back differs')
+
+
+def probe(dev, probe_address=None, raw=None, scratch_address=None,
+          length=PROBE_LENGTH):
+    """Probe the capabilities of the stage dev is in
+
+    dev is a pyamlboot.AmlogicSoC. probe_address, if given, must be a
+    readable memory address with length bytes behind it: only the block
+    lengths fitting twice are probed. scratch_address, if given, must be
+    memory with length bytes nothing uses, like the destination of a
+    download about to start: it is written back with its own contents.
+    """
+    if raw is None:
+        raw = dev.identify()
+    socid = SocId(raw)
+    stage = (socid.stage_major, socid.stage_minor)
+    tpl = socid.stage_minor == SocId.STAGE_MINOR_TPL
+
+    caps = Capabilities(
+        identify=raw.encode('latin-1').hex(),
+        stage=stage,
+        keep_power=(socid.major, socid.minor) + stage >= (0, 9, 0, 0),
+        amlc=stage == (1, SocId.STAGE_MINOR_SPL),
+        requests=['REQ_IDENTIFY_HOST'])
+
+    if _answers(dev, caps, dev.nop):
+        caps.requests.append('REQ_NOP')
+
+    if tpl:
+        caps.requests += ['REQ_TPL_CMD', 'REQ_TPL_STAT', 'REQ_WRITE_MEDIA',
+                          'REQ_READ_MEDIA', 'REQ_BULKCMD']
+        caps.default_checksums.append('addsum')
+    else:
+        caps.requests += ['REQ_WRITE_MEM', 'REQ_RUN_IN_ADDR']
+        if caps.amlc:
+            caps.requests += ['REQ_GET_AMLC', 'REQ_WRITE_AMLC']
+
+    if probe_address is not None:
+        if _answers(dev, caps, dev.readSimpleMemory, probe_address, 4):
+            caps.requests.append('REQ_READ_MEM')
+        for block_length in PROBE_BLOCK_LENGTHS:
+            if 2 * block_length <= length and \
+                    _answers(dev, caps, dev.readLargeMemoryInto, probe_address,
+                             bytearray(2 * block_length), block_length,
+                             PROBE_TIMEOUT):
+                caps.block_lengths.append(block_length)
+        if caps.block_lengths:
+            caps.requests.append('REQ_RD_LARGE_MEM')
+            if scratch_address is not None:
+                caps.multi_block_write = all(
+                    _answers(dev, caps, _round_trip, dev, scratch_address,
+                             block_length)
+                    for block_length in caps.block_lengths)
+            if caps.multi_block_write:
+                caps.requests.append('REQ_WR_LARGE_MEM')
+
+    _logger.info('Probed capabilities: %s', caps)
+    return caps
+
+
+def get_capabilities(dev, probe_address=None, cache=True,
+                     scratch_address=None, length=PROBE_LENGTH):
+    """Return the capabilities of dev, from the disk cache when possible"""
+    raw = dev.identify()
+    key = _cache_key(dev, raw.encode('latin-1'), probe_address,
+                     scratch_address, length)
+
+    if cache:
+        entry = _load_cache()['devices'].get(key)
+        if entry is not None:
+            return Capabilities.from_dict(entry)
+
+    caps = probe(dev, probe_address, raw, scratch_address, length)
+
+    if cache and caps.settled:
+        _load_cache()['devices'][key] = asdict(caps)
+        _save_cache()
+
+    return caps
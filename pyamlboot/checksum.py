@@ -0,0 +1,125 @@
+# SPDX-License-Identifier: GPL-2.0 OR MIT
+# -*- coding: utf-8 -*-
+"""
+Amlogic additive checksum
+
+The ROM AMLS trailer, the Optimus writeMedia header and the ADNL DATAOUT
+steps all protect data with the same checksum: the sum of the data taken
+as 32-bit little-endian words, modulo 2^32. A trailing 1 to 3 bytes word
+is zero padded.
+
+Several implementations are provided, the fastest one available is picked
+at import time and exported as addsum():
+  * numpy: numpy.frombuffer() sum, when NumPy is installed
+  * fold: the words spread to the 64-bit lanes of one big integer, summed
+    by folding its halves modulo 2^64 - 1, all in C loops
+  * python: struct.iter_unpack(), always available
+"""
+
+import struct
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = ['addsum', 'IMPLEMENTATION', 'IMPLEMENTATIONS', 'measure']
+
+_WORD = struct.Struct('<I')
+
+# Bytes folded at once: cache sized, and keeps the lane sums below 2^64 - 1
+_FOLD_CHUNK = 0x40000
+_FOLD_MODULUS = (1 << 64) - 1
+
+
+def _split(data):
+    """Return (word aligned body, tail value) of a buffer"""
+    view = memoryview(data).cast('B')
+    body = len(view) & ~3
+    return view[:body], int.from_bytes(view[body:], 'little')
+
+
+def _addsum_python(data):
+    body, tail = _split(data)
+    total = sum(word for (word,) in _WORD.iter_unpack(body))
+    return (total + tail) & 0xffffffff
+
+
+def _fold(lanes):
+    """Return the sum of the 64-bit lanes of an integer, modulo 2^64 - 1"""
+    # 2^64 = 1 modulo 2^64 - 1, so halves at a 64-bit boundary just add up
+    while lanes.bit_length() > 64:
+        shift = lanes.bit_length() // 128 * 64 or 64
+        lanes = (lanes >> shift) + (lanes & ((1 << shift) - 1))
+    return lanes % _FOLD_MODULUS
+
+
+def _addsum_fold(data):
+    body, tail = _split(data)
+    total = tail
+    lanes = bytearray()
+
+    for start in range(0, len(body), _FOLD_CHUNK):
+        words = bytes(body[start:start + _FOLD_CHUNK])
+        if len(lanes) != len(words) * 2:
+            lanes = bytearray(len(words) * 2)
+        # Every word lands in the low half of a zeroed 64-bit lane
+        for i in range(4):
+            lanes[i::8] = words[i::4]
+        total += _fold(int.from_bytes(lanes, 'little'))
+
+    return total & 0xffffffff
+
+
+def _addsum_numpy(data):
+    body, tail = _split(data)
+    total = int(numpy.frombuffer(body, dtype='<u4').sum(dtype=numpy.uint64))
+    return (total + tail) & 0xffffffff
+
+
+IMPLEMENTATIONS = {'python': _addsum_python, 'fold': _addsum_fold}
+
+if numpy is not None:
+    IMPLEMENTATIONS['numpy'] = _addsum_numpy
+
+if 'numpy' in IMPLEMENTATIONS:
+    IMPLEMENTATION = 'numpy'
+else:
+    IMPLEMENTATION = 'fold'
+
+addsum = IMPLEMENTATIONS[IMPLEMENTATION]
+
+
+def measure(size=0x10000, duration=0.2):
+    """Measure the throughput of every implementation
+
+    Returns a dict of implementation name to MiB/s, checksumming blocks of
+    size bytes for about duration seconds each.
+    """
+    block = bytes(range(256)) * (size // 256) + bytes(size % 256)
+    ref = _addsum_python(block)
+    results = {}
+
+    for name, fn in IMPLEMENTATIONS.items():
+        if fn(block) != ref:
+            raise RuntimeError(f'Checksum implementation {name} mismatch')
+
+        count = 0
+        start = time.perf_counter()
+        while True:
+            fn(block)
+            count += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= duration:
+                break
+
+        results[name] = count * size / elapsed / (1 << 20)
+
+    return results
+
+
+if __name__ == '__main__':
+    for name, rate in measure().items():
+        marker = '*' if name == IMPLEMENTATION else ' '
+        print(f'{marker} {name:<10} {rate:10.1f} MiB/s')
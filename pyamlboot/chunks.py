@@ -0,0 +1,126 @@
+# SPDX-License-Identifier: GPL-2.0 OR MIT
+# -*- coding: utf-8 -*-
+"""
+Chunked data sources
+
+writeLargeMemory() and writeAMLCData() take any buffer (bytes, bytearray,
+mmap...), sliced in place, but also file objects and iterables of chunks,
+which do not have to fit in memory. Those are streamed through a ring of
+fixed-size buffers: a reader thread fills the free buffers from the source
+while the filled ones are sent, so reading the source overlaps the USB
+transfers and memory use does not depend on the data length.
+"""
+
+import queue
+import threading
+
+__all__ = ['ChunkRing', 'is_buffer', 'RING_DEPTH']
+
+# Buffers of a ring: one being sent while the others are filled
+RING_DEPTH = 3
+
+
+def is_buffer(data):
+    """Return whether data exposes a buffer and can be sliced in place"""
+    try:
+        memoryview(data)
+    except TypeError:
+        return False
+    return True
+
+
+class ChunkRing:
+    """Iterate over a file object or an iterable in fixed-size chunks
+
+    Every chunk is a memoryview of chunk_length bytes, except the last one
+    which may be shorter. A chunk is only valid until the next one is
+    requested: its buffer is then handed back to the reader thread. The
+    number of bytes read so far is available as length.
+    """
+
+    def __init__(self, source, chunk_length, depth=RING_DEPTH):
+        if hasattr(source, 'readinto'):
+            self._read = source.readinto
+        elif hasattr(source, 'read'):
+            self._read = self._read_copy
+        else:
+            self._read = self._next_copy
+        self._source = source
+        self._pending = memoryview(b'')
+        self.chunk_length = chunk_length
+        self.length = 0
+        self._buffers = [bytearray(chunk_length) for _ in range(depth)]
+        self._free = queue.Queue()
+        self._filled = queue.Queue()
+        self._stop = threading.Event()
+
+    def _read_copy(self, view):
+        data = self._source.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def _next_copy(self, view):
+        if not self._pending:
+            # Skip empty chunks, StopIteration ends the source
+            while not self._pending:
+                self._pending = memoryview(next(self._source)).cast('B')
+        length = min(len(view), len(self._pending))
+        view[:length] = self._pending[:length]
+        self._pending = self._pending[length:]
+        return length
+
+    def _fill(self, buf):
+        view = memoryview(buf)
+        offset = 0
+        while offset < len(view):
+            try:
+                read = self._read(view[offset:])
+            except StopIteration:
+                break
+            if not read:
+                break
+            offset = offset + read
+        return offset
+
+    def _reader(self):
+        try:
+            while True:
+                slot = self._free.get()
+                if self._stop.is_set():
+                    return
+                length = self._fill(self._buffers[slot])
+                self._filled.put((slot, length, None))
+                if length < self.chunk_length:
+                    return
+        except BaseException as e:
+            self._filled.put((None, 0, e))
+
+    def __iter__(self):
+        if not hasattr(self._source, 'read'):
+            self._source = iter(self._source)
+        for slot in range(len(self._buffers)):
+            self._free.put(slot)
+
+        thread = threading.Thread(target=self._reader, name='pyamlboot-chunks',
+                                  daemon=True)
+        thread.start()
+        current = None
+
+        try:
+            while True:
+                slot, length, error = self._filled.get()
+                if error is not None:
+                    raise error
+                if current is not None:
+                    self._free.put(current)
+                current = slot
+                self.length = self.length + length
+                if length:
+                    yield memoryview(self._buffers[slot])[:length]
+                if length < self.chunk_length:
+                    return
+        finally:
+            self._stop.set()
+            # Wake up the reader if it waits for a free buffer
+            self._free.put(current if current is not None else 0)
+            thread.join()
@@ -0,0 +1,158 @@
+# SPDX-License-Identifier: GPL-2.0 OR MIT
+# -*- coding: utf-8 -*-
+"""
+Streaming memory dumps
+
+dump_memory() copies an address range to a file in bounded chunks and
+hashes the data while writing it. Progress is checkpointed next to the
+output file: when a dump is interrupted, calling dump_memory() again with
+the same range resumes after the last checkpoint. The hash of the part
+already on disk is then recomputed from the file.
+
+Boards in ROM or BL2 are read through large memory requests, boards in
+U-Boot through 'upload mem' bulk commands.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import namedtuple
+
+from .socid import SocId
+
+__all__ = ['DumpResult', 'dump_memory', 'checkpoint_path']
+
+CHUNK_LENGTH = 0x100000
+# readMedia() sends the transfer length in wValue
+UPLOAD_CHUNK_LENGTH = 0x8000
+CHECKPOINT_INTERVAL = 16 * CHUNK_LENGTH
+
+_logger = logging.getLogger(__name__)
+
+DumpResult = namedtuple('DumpResult',
+                        'address length resumed digest seconds mib_per_s')
+
+
+def checkpoint_path(path):
+    return path + '.ckpt'
+
+
+def _load_checkpoint(path, params):
+    try:
+        with open(checkpoint_path(path)) as f:
+            ckpt = json.load(f)
+    except (OSError, ValueError):
+        return 0
+
+    if ckpt.get('params') != params:
+        _logger.warning('Ignoring checkpoint of another dump')
+        return 0
+
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return 0
+
+    return min(ckpt.get('offset', 0), size)
+
+
+def _save_checkpoint(path, params, offset):
+    tmp = checkpoint_path(path) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'params': params, 'offset': offset}, f)
+    os.replace(tmp, checkpoint_path(path))
+
+
+def _rehash(f, h, length):
+    """Feed the first length bytes of f to h"""
+    f.seek(0)
+    buf = bytearray(CHUNK_LENGTH)
+    view = memoryview(buf)
+    while length:
+        n = f.readinto(view[:min(length, len(buf))])
+        if not n:
+            raise ValueError('Dump file shorter than its checkpoint')
+        h.update(view[:n])
+        length = length - n
+
+
+def _upload_chunks(dev, address, length, chunk_length, timeout):
+    """Read memory through U-Boot 'upload mem' bulk commands"""
+    offset = 0
+    while offset < length:
+        size = min(length - offset, chunk_length)
+        yield memoryview(dev.uploadMemory(address + offset, size, timeout))
+        offset = offset + size
+
+
+def _chunks(dev, address, length, block_length, timeout):
+    if SocId(dev.identify()).stage_minor == SocId.STAGE_MINOR_TPL:
+        return _upload_chunks(dev, address, length, UPLOAD_CHUNK_LENGTH,
+                              timeout)
+
+    return dev.iterLargeMemory(address, length, block_length, CHUNK_LENGTH,
+                               timeout)
+
+
+def dump_memory(dev, address, length, path, block_length=None,
+                timeout=None, algorithm='sha256', resume=True,
+                progress=None):
+    """Dump length bytes of memory at address to the file at path
+
+    dev is a pyamlboot.AmlogicSoC, block_length is autotuned or 4096 by
+    default, timeout is the per transfer timeout in milliseconds, adaptive
+    by default. progress, if given, is called as progress(done, length,
+    mib_per_s) after each chunk. The checkpoint is removed once the dump
+    is complete.
+    """
+    if block_length is None:
+        block_length = dev.tunedBlockLength('read_large', 4096)
+    params = {'address': address, 'length': length,
+              'algorithm': algorithm}
+    h = hashlib.new(algorithm)
+    offset = _load_checkpoint(path, params) if resume else 0
+
+    with open(path, 'r+b' if offset else 'wb') as f:
+        if offset:
+            _logger.info('Resuming dump at 0x%x', address + offset)
+            _rehash(f, h, offset)
+            f.truncate(offset)
+            f.seek(offset)
+
+        start = time.monotonic()
+        last_checkpoint = offset
+        done = offset
+        try:
+            for chunk in _chunks(dev, address + offset, length - offset,
+                                 block_length, timeout):
+                f.write(chunk)
+                h.update(chunk)
+                done = done + len(chunk)
+
+                if done - last_checkpoint >= CHECKPOINT_INTERVAL:
+                    f.flush()
+                    os.fsync(f.fileno())
+                    _save_checkpoint(path, params, done)
+                    last_checkpoint = done
+
+                if progress is not None:
+                    elapsed = time.monotonic() - start
+                    rate = ((done - offset) / elapsed / (1 << 20)
+                            if elapsed else 0.0)
+                    progress(done, length, rate)
+        except BaseException:
+            # Whole chunks were written so far, keep them for a resume
+            f.flush()
+            _save_checkpoint(path, params, done)
+            raise
+
+    seconds = time.monotonic() - start
+    try:
+        os.remove(checkpoint_path(path))
+    except FileNotFoundError:
+        pass
+
+    rate = (length - offset) / seconds / (1 << 20) if seconds else 0.0
+    return DumpResult(address, length, offset, h.hexdigest(), seconds, rate)
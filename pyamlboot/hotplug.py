@@ -0,0 +1,202 @@
+# SPDX-License-Identifier: GPL-2.0 OR MIT
+# -*- coding: utf-8 -*-
+"""
+USB device arrival watcher
+
+Every stage change (ROM -> SPL -> TPL, U-Boot reset, reboot-romusb) makes
+the board leave the bus and enumerate again. Instead of sleep-polling for
+it, wait_for() blocks on a shared DeviceWatcher which is woken up as soon
+as an Amlogic device arrives. Arrivals are reported by, in order of
+preference:
+  * libusb hotplug callbacks, on a private libusb 1.0 context
+  * kernel uevents read from a netlink socket, on Linux
+  * nothing: waiters fall back to polling every POLL_INTERVAL
+"""
+
+import ctypes
+import logging
+import socket
+import sys
+import threading
+import time
+
+from .topology import AMLOGIC_VENDOR_ID
+
+__all__ = ['DeviceWatcher', 'get_watcher', 'wait_for']
+
+POLL_INTERVAL = 0.1
+# Retry period when arrivals are notified, covers attempts failing
+# for another reason than a missing device
+RETRY_INTERVAL = 0.5
+
+LIBUSB_CAP_HAS_HOTPLUG = 0x0001
+LIBUSB_HOTPLUG_EVENT_DEVICE_ARRIVED = 0x01
+LIBUSB_HOTPLUG_MATCH_ANY = -1
+
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_KERNEL_GROUP = 1
+
+_logger = logging.getLogger(__name__)
+
+_hotplug_cb_fn_p = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p,
+                                    ctypes.c_void_p, ctypes.c_int,
+                                    ctypes.c_void_p)
+
+
+class _timeval(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_usec', ctypes.c_long)]
+
+
+class DeviceWatcher:
+    """Counts device arrivals and wakes up the threads waiting for one"""
+
+    def __init__(self, vendor_id=AMLOGIC_VENDOR_ID):
+        self._vendor_id = vendor_id
+        self._cond = threading.Condition()
+        self._arrivals = 0
+        self.method = 'poll'
+        self.interval = POLL_INTERVAL
+
+        for method, start in (('libusb', self._start_libusb),
+                              ('netlink', self._start_netlink)):
+            try:
+                start()
+            except Exception as e:
+                _logger.debug('%s hotplug unavailable: %s', method, e)
+            else:
+                self.method = method
+                self.interval = RETRY_INTERVAL
+                break
+
+        _logger.debug('Device arrival notified by %s', self.method)
+
+    def notify(self):
+        """Report a device arrival, also used by simulated devices"""
+        with self._cond:
+            self._arrivals += 1
+            self._cond.notify_all()
+
+    def _start_thread(self, target):
+        thread = threading.Thread(target=target, name='pyamlboot-hotplug',
+                                  daemon=True)
+        thread.start()
+
+    def _start_libusb(self):
+        import usb.backend.libusb1 as libusb1
+
+        if libusb1.get_backend() is None:
+            raise RuntimeError('libusb 1.0 not found')
+
+        lib = libusb1._lib
+        if not lib.libusb_has_capability(LIBUSB_CAP_HAS_HOTPLUG):
+            raise RuntimeError('libusb built without hotplug support')
+
+        # A private context keeps this event thread away from transfers
+        ctx = ctypes.c_void_p()
+        libusb1._check(lib.libusb_init(ctypes.byref(ctx)))
+
+        lib.libusb_hotplug_register_callback.argtypes = [
+            ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+            ctypes.c_int, ctypes.c_int, _hotplug_cb_fn_p, ctypes.c_void_p,
+            ctypes.POINTER(ctypes.c_int)]
+        lib.libusb_handle_events_timeout.argtypes = [
+            ctypes.c_void_p, ctypes.POINTER(_timeval)]
+
+        def callback(ctx, device, event, user_data):
+            self.notify()
+            return 0
+
+        self._libusb_callback = _hotplug_cb_fn_p(callback)
+        handle = ctypes.c_int()
+        libusb1._check(lib.libusb_hotplug_register_callback(
+            ctx, LIBUSB_HOTPLUG_EVENT_DEVICE_ARRIVED, 0, self._vendor_id,
+            LIBUSB_HOTPLUG_MATCH_ANY, LIBUSB_HOTPLUG_MATCH_ANY,
+            self._libusb_callback, None, ctypes.byref(handle)))
+
+        def run():
+            tv = _timeval(1, 0)
+            while True:
+                lib.libusb_handle_events_timeout(ctx, ctypes.byref(tv))
+
+        self._start_thread(run)
+
+    def _start_netlink(self):
+        if sys.platform != 'linux':
+            raise RuntimeError('netlink is Linux only')
+
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                             NETLINK_KOBJECT_UEVENT)
+        sock.bind((0, UEVENT_KERNEL_GROUP))
+        product = f'{self._vendor_id:x}/'
+
+        def run():
+            while True:
+                msg = sock.recv(8192).split(b'\0')
+                env = dict(f.decode(errors='replace').split('=', 1)
+                           for f in msg[1:] if b'=' in f)
+                if (env.get('ACTION') == 'add' and
+                        env.get('DEVTYPE') == 'usb_device' and
+                        env.get('PRODUCT', '').startswith(product)):
+                    self.notify()
+
+        self._netlink = sock
+        self._start_thread(run)
+
+    def arrivals(self):
+        """Return the number of arrivals seen so far"""
+        with self._cond:
+            return self._arrivals
+
+    def wait(self, arrivals, timeout):
+        """Wait up to timeout seconds for arrivals to be exceeded"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._arrivals != arrivals,
+                                       timeout)
+
+
+_watcher = None
+_watcher_lock = threading.Lock()
+
+
+def get_watcher(start=True):
+    """Return the process wide DeviceWatcher, started on first use
+
+    With start False, return None rather than starting it.
+    """
+    global _watcher
+
+    with _watcher_lock:
+        if _watcher is None and start:
+            _watcher = DeviceWatcher()
+        return _watcher
+
+
+def wait_for(find, timeout=None):
+    """Call find() until it returns something else than None
+
+    find() is called once, then again after every device arrival, or
+    after the watcher interval when no arrival is notified. Returns None
+    once timeout seconds have elapsed, waits forever if timeout is None.
+    The watcher is only started when there is something to wait for.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    found = find()
+    if found is not None or (timeout is not None and timeout <= 0):
+        return found
+
+    watcher = get_watcher()
+    while True:
+        arrivals = watcher.arrivals()
+        found = find()
+        if found is not None:
+            return found
+
+        wait = watcher.interval
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            wait = min(wait, remaining)
+
+        watcher.wait(arrivals, wait)
@@ -0,0 +1,205 @@
+# SPDX-License-Identifier: GPL-2.0 OR MIT
+# -*- coding: utf-8 -*-
+"""
+Opt-in transfer metrics
+
+Once enable() is called, devices opened afterwards get their control
+transfers and bulk endpoints wrapped with timing proxies, and the burn
+flows record ADNL command round trips, host checksum time and the time
+spent waiting for busy device acks. Per request kind, TransferMetrics
+keeps counts, bytes, errors and a log2 latency histogram.
+
+While disabled, the hot paths use the plain pyusb objects and every
+record() call is a single global lookup.
+"""
+
+import json
+import time
+
+__all__ = ['TransferMetrics', 'enable', 'disable', 'record',
+           'timed_call', 'instrument_ctrl', 'instrument_endpoint',
+           'unwrap_endpoint']
+
+collector = None
+
+
+class _Stat:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.bytes = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+        # bucket k counts latencies below 2^k microseconds
+        self.histogram = {}
+
+    def add(self, nbytes, seconds, error):
+        self.count += 1
+        self.errors += bool(error)
+        self.bytes += nbytes
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        bucket = int(seconds * 1e6).bit_length()
+        self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'bytes': self.bytes,
+            'total_s': self.total,
+            'min_s': self.min or 0.0,
+            'mean_s': self.total / self.count if self.count else 0.0,
+            'max_s': self.max,
+            'mib_per_s': (self.bytes / self.total / (1 << 20)
+                          if self.total else 0.0),
+            'histogram_us': {f'<{1 << k}': n
+                             for k, n in sorted(self.histogram.items())},
+        }
+
+
+class TransferMetrics:
+    """Per request kind transfer statistics"""
+
+    def __init__(self):
+        self._stats = {}
+        self.start = time.monotonic()
+
+    def record(self, kind, nbytes, seconds, error=False):
+        stat = self._stats.get(kind)
+        if stat is None:
+            stat = self._stats[kind] = _Stat()
+        stat.add(nbytes, seconds, error)
+
+    def kinds(self):
+        return sorted(self._stats)
+
+    def __getitem__(self, kind):
+        return self._stats[kind].as_dict()
+
+    def as_dict(self):
+        return {
+            'elapsed_s': time.monotonic() - self.start,
+            'requests': {k: self._stats[k].as_dict() for k in self.kinds()},
+        }
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), indent=2)
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            f.write(self.to_json())
+            f.write('\n')
+
+
+def enable():
+    """Start collecting, returns the TransferMetrics being filled"""
+    global collector
+
+    if collector is None:
+        collector = TransferMetrics()
+    return collector
+
+
+def disable():
+    global collector
+
+    collector = None
+
+
+def record(kind, nbytes, seconds, error=False):
+    if collector is not None:
+        collector.record(kind, nbytes, seconds, error)
+
+
+def timed_call(kind, nbytes, fn, *args):
+    """Return fn(*args), timed under kind when metrics are enabled"""
+    if collector is None:
+        return fn(*args)
+
+    start = time.perf_counter()
+    error = True
+    try:
+        ret = fn(*args)
+        error = False
+    finally:
+        collector.record(kind, nbytes, time.perf_counter() - start, error)
+
+    return ret
+
+
+def _length(ret):
+    return ret if isinstance(ret, int) else len(ret)
+
+
+def instrument_ctrl(ctrl_transfer, names):
+    """Return ctrl_transfer, timed per bRequest when metrics are enabled
+
+    names maps bRequest values to the kind names used in the metrics.
+    """
+    if collector is None:
+        return ctrl_transfer
+
+    def timed(bmRequestType, bRequest, wValue=0, wIndex=0,
+              data_or_wLength=None, timeout=None):
+        kind = 'ctrl:' + names.get(bRequest, f'0x{bRequest:02x}')
+        start = time.perf_counter()
+        ret = 0
+        error = True
+        try:
+            ret = ctrl_transfer(bmRequestType, bRequest, wValue, wIndex,
+                                data_or_wLength, timeout)
+            error = False
+        finally:
+            collector.record(kind, _length(ret) if ret is not None else 0,
+                             time.perf_counter() - start, error)
+        return ret
+
+    return timed
+
+
+class _TimedEndpoint:
+    """Endpoint proxy timing read() and write()"""
+
+    def __init__(self, ep, metrics):
+        self._ep = ep
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self._ep, name)
+
+    def _timed(self, kind, fn, *args):
+        start = time.perf_counter()
+        ret = 0
+        error = True
+        try:
+            ret = fn(*args)
+            error = False
+        finally:
+            self._metrics.record(kind, _length(ret),
+                                 time.perf_counter() - start, error)
+        return ret
+
+    def write(self, data, timeout=None):
+        return self._timed('bulk_out', self._ep.write, data, timeout)
+
+    def read(self, size_or_buffer, timeout=None):
+        return self._timed('bulk_in', self._ep.read, size_or_buffer, timeout)
+
+
+def instrument_endpoint(ep):
+    """Return ep, behind a timing proxy when metrics are enabled"""
+    if collector is None or ep is None:
+        return ep
+
+    return _TimedEndpoint(ep, collector)
+
+
+def unwrap_endpoint(ep):
+    """Return the pyusb endpoint behind a proxy of instrument_endpoint()"""
+    if isinstance(ep, _TimedEndpoint):
+        return ep._ep
+
+    return ep
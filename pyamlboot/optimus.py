@@ -28,27 +28,51 @@ from collections import OrderedDict
 from dataclasses import dataclass
 from struct import pack, unpack
 
-from . import usb_backend
+from . import metrics, usb_backend
+from .capabilities import PROBE_LENGTH
+from .checksum import addsum
+from .hotplug import wait_for
+from .stages import PARA_DONE_MAGIC, Stage, StageTimeout, wait_stage
+from .timeouts import is_stall
 
 USB_BACKEND = usb_backend.get_backend()
 
+# Deadlines of the stage transitions, in seconds: the fixed delays once
+# slept instead of watching for the transition
+DDR_INIT_TIMEOUT = 8.0
+DDR_UPDATE_TIMEOUT = 5.0
+PASSWORD_TIMEOUT = 2.0
 
-def wait_device(identify=True, timeout=10.0):
-    start_time = time.time()
-    while True:
+# Seconds slept after each clock control register write: the device keeps
+# answering before the new setting takes effect, which is not observable
+PLL_SETTLE_DELAY = 0.5
+
+# Seconds a media block ack is awaited before the block is resent
+MEDIA_ACK_DEADLINE = 10.0
+
+
+def wait_device(identify=True, timeout=10.0, port=None, backend=None,
+                stage=None):
+    """Open the board once it answers, in stage when not None"""
+    def open_device():
         try:
-            usbd = pyamlboot.AmlogicSoC(usb_backend=USB_BACKEND)
-            if identify:
+            usbd = pyamlboot.AmlogicSoC(usb_backend=backend or USB_BACKEND,
+                                        port=port)
+            if identify or stage is not None:
                 ident = usbd.identify()
         except Exception:
-            pass
-        else:
-            return usbd
+            return None
+        if stage is not None and SocId(ident).stage_minor != stage:
+            # Still the previous stage, before it leaves the bus
+            usbd.disposeDevice()
+            return None
+        return usbd
 
-        if (time.time() - start_time) >= timeout:
-            raise TimeoutError('Detect Device connect timeout')
+    usbd = wait_for(open_device, timeout)
+    if usbd is None:
+        raise TimeoutError('Detect Device connect timeout')
 
-        time.sleep(0.2)
+    return usbd
 
 
 class BulkCmdError(Exception):
@@ -61,6 +85,8 @@ class TplCmdError(Exception):
 
 class BurnStepBase:
     _dev = None
+    # Stage the board enumerates in after a step asking to reopen it
+    next_stage = None
 
     def __init__(self, shared_data):
         self._shared_data = shared_data
@@ -76,6 +102,7 @@ class BurnStepBase:
         self._dev.bulkCmd(cmd, read_status=False, timeout=timeout)
 
         start_time = time.time()
+        busy_time = None
         while True:
             exc = None
             try:
@@ -85,6 +112,8 @@ class BurnStepBase:
             else:
                 if not response.startswith(b'Continue:34'):
                     break
+                if busy_time is None:
+                    busy_time = time.perf_counter()
                 time.sleep(3)
 
             if int((time.time() - start_time) * 1000) > timeout:
@@ -93,6 +122,10 @@ class BurnStepBase:
 
                 raise exc
 
+        if busy_time is not None:
+            metrics.record('ack_wait:Continue:34', 0,
+                           time.perf_counter() - busy_time)
+
         if response.rstrip(b'\x00') != status:
             raise BulkCmdError(f'Command {cmd} status failed:{response}')
 
@@ -133,6 +166,8 @@ class BurnStepEraseBootloader(BurnStepBase):
         logging.info('Erase bootloader...')
 
         self._check_bulk_cmd('erase_bootloader')
+        # Without bootloader, the board comes back in the ROM
+        self.next_stage = Stage.ROM
         try:
             self._check_bulk_cmd('reset')
             self._dev.disposeDevice()
@@ -221,9 +256,10 @@ class BurnStepCheckPassword(BurnStepBase):
         self._password_fd.seek(0, 0)
         self._dev.sendPassword(self._password_fd.read())
 
-        time.sleep(2)
-        socid = SocId(self._dev.identify())
-        if not socid.password_ok:
+        try:
+            wait_stage(self._dev, lambda socid: socid.password_ok,
+                       PASSWORD_TIMEOUT, 'password check')
+        except StageTimeout:
             raise PermissionError('Check password failed')
 
         logging.info('Password ok')
@@ -253,6 +289,11 @@ class BurnStepDownloadBase(BurnStepBase):
                                        params,
                                        blockLength=len(params))
 
+    def _para_done(self):
+        """Return whether BL2 marked its parameter block as processed"""
+        data = self._dev.readLargeMemory(self._platform.bl2ParaAddr, 0x200, 0x200)
+        return unpack('<I', data[:4])[0] == PARA_DONE_MAGIC
+
     def _check_para(self, magic):
         if self._platform.bl2ParaAddr:
             data = self._dev.readLargeMemory(self._platform.bl2ParaAddr, 0x200, 0x200)
@@ -263,15 +304,12 @@ class BurnStepDownloadBase(BurnStepBase):
             return data
         return None
 
+    def _capabilities(self):
+        # BL2 parameters are readable from the ROM on
+        return self._dev.capabilities(self._platform.bl2ParaAddr or None)
+
     def _run_in_address(self, address):
-        keep_power = False
-        socid = SocId(self._dev.identify())
-        socid_cmp = (socid.major,
-                     socid.minor,
-                     socid.stage_major,
-                     socid.stage_minor)
-        if socid_cmp >= (0, 9, 0, 0):
-            keep_power = True
+        keep_power = self._capabilities().keep_power
 
         logging.info(f'Run at {address:x}')
         self._dev.run(address, keep_power=keep_power)
@@ -295,14 +333,16 @@ class BurnStepDownloadBase(BurnStepBase):
                             self._platform.Control0_val,
                             control0_reg_default,
                             control0_val_default)
-        time.sleep(0.5)
+        time.sleep(PLL_SETTLE_DELAY)
         self._write_regs_do(self._platform.Control1_reg,
                             self._platform.Control1_val,
                             control1_reg_default,
                             control1_val_default)
-        time.sleep(0.5)
+        time.sleep(PLL_SETTLE_DELAY)
 
-    def _download_file(self, img, address, size=0, block_length=0x1000):
+    def _download_file(self, img, address, size=0, block_length=None):
+        if block_length is None:
+            block_length = self._dev.tunedBlockLength('write_large', 0x1000)
         written = 0
         img.seek(0, 0)
 
@@ -312,6 +352,21 @@ class BurnStepDownloadBase(BurnStepBase):
         logging.info(
             f'Download file {img.sub_type()} ({size} bytes) at {address:x}')
 
+        # The destination is about to be overwritten, free to be probed
+        caps = self._dev.capabilities(address, scratchAddress=address,
+                                      probeLength=min(size, PROBE_LENGTH))
+        if caps.multi_block_write and block_length in caps.block_lengths:
+            # Whole blocks in large transfers, the tail as one short block,
+            # sliced from a view of the item instead of copies
+            whole = size - size % block_length
+            data = img.read_view(size)
+            if whole:
+                self._dev.writeLargeMemory(address, data[:whole], block_length)
+            if whole < len(data):
+                self._dev.writeLargeMemory(address + whole, data[whole:],
+                                           blockLength=len(data) - whole)
+            return
+
         while written < size:
             buf = img.read(block_length)
             if not buf:
@@ -399,9 +454,15 @@ class BurnStepDownloadSPL(BurnStepDownloadBase):
         self._write_para(self._params_buf)
         self._run_in_address(self._platform.DDRRun)
 
-        time.sleep(8)
+        try:
+            socid = wait_stage(self._dev, self._ddr_init_done,
+                               DDR_INIT_TIMEOUT, 'DDR init')
+        except StageTimeout as e:
+            # Without parameter block, a return to the ROM is not observable
+            if self._platform.bl2ParaAddr or e.socid is None:
+                raise
+            socid = e.socid
 
-        socid = SocId(self._dev.identify())
         if socid.stage_minor == SocId.STAGE_MINOR_IPL:
             logging.info('CheckFileRunState succeed')
         elif socid.stage_major == 1 and socid.stage_minor == SocId.STAGE_MINOR_SPL:
@@ -412,7 +473,14 @@ class BurnStepDownloadSPL(BurnStepDownloadBase):
         else:
             raise RuntimeError('')
 
-        self._check_para(0x7856efab)
+        self._check_para(PARA_DONE_MAGIC)
+
+    def _ddr_init_done(self, socid):
+        # DDR init either hands over to BL2, or returns to the ROM once it
+        # marked its parameter block processed
+        if socid.stage_minor != SocId.STAGE_MINOR_IPL:
+            return True
+        return bool(self._platform.bl2ParaAddr) and self._para_done()
 
 
 class BurnStepDownloadUboot(BurnStepDownloadBase):
@@ -434,30 +502,9 @@ class BurnStepDownloadUboot(BurnStepDownloadBase):
             addr = self._platform.bl2ParaAddr
             self._run_in_address(addr)
 
-    @staticmethod
-    def _chksum(data):
-        checksum = 0
-        offset = 0
-        uint32_max = (1 << 32)
-
-        while offset < len(data):
-            left = len(data) - offset
-            if left >= 4:
-                val = unpack('<I', data[offset:offset + 4])[0]
-            elif left >= 3:
-                val = unpack('<I', data[offset:offset + 4])[0] & 0xffffff
-            elif left >= 2:
-                val = unpack('<H', data[offset:offset + 2])[0]
-            else:
-                val = unpack('<B', data[offset])[0]
-            offset = offset + 4
-            checksum = (checksum + abs(val)) % uint32_max
-
-        return checksum
-
     def _update_ddr(self):
         self._cur_img.seek(0, 0)
-        chksum = self._chksum(self._cur_img.read())
+        chksum = addsum(self._cur_img.read())
         self._cur_img.seek(0, 0)
 
         buf = pack('<IIIIIIIII',
@@ -469,9 +516,10 @@ class BurnStepDownloadUboot(BurnStepDownloadBase):
         self._write_para(buf)
 
         self._run()
-        time.sleep(5)
+        wait_stage(self._dev, lambda socid: self._para_done(),
+                   DDR_UPDATE_TIMEOUT, 'DDR parameters')
 
-        self._check_para(0x7856efab)
+        self._check_para(PARA_DONE_MAGIC)
         socid = SocId(self._dev.identify())
         if socid.stage_minor == SocId.STAGE_MINOR_IPL:
             self._ddr_img.seek(0, 0)
@@ -498,7 +546,7 @@ class BurnStepDownloadUboot(BurnStepDownloadBase):
                 socid.stage_major != 1 and socid.stage_minor != SocId.STAGE_MINOR_SPL):
             raise NotImplementedError()
 
-        if socid.stage_major == 1 and socid.stage_minor == 8:
+        if self._capabilities().amlc:
             # Seems G12A/G12B/SM1 use this mode (tested: SM1)
             self._download_amlc_data(self._cur_img, self._platform.UbootLoad)
             logging.debug('BurnStepDownloadUboot: do: DownloadAMLC UBOOT done')
@@ -506,8 +554,7 @@ class BurnStepDownloadUboot(BurnStepDownloadBase):
             # Other SoC use this mode (tested: AXG, GXL)
             self._download_file(self._cur_img, self._platform.UbootLoad)
             logging.debug('BurnStepDownloadUboot: do: Download UBOOT done')
-            time.sleep(0.2)
-            socid = SocId(self._dev.identify())
+            socid = wait_stage(self._dev, what='download end')
             logging.debug(f'BurnStepDownloadUboot: do: soc state {socid.stage_major} {socid.stage_minor}')
             if socid.stage_minor == SocId.STAGE_MINOR_IPL:
                 self._download_file(self._ddr_img,
@@ -526,6 +573,7 @@ class BurnStepDownloadUboot(BurnStepDownloadBase):
             self._run()
 
         self._dev.disposeDevice()
+        self.next_stage = Stage.TPL
         return True
 
 
@@ -562,6 +610,55 @@ class BurnStepDownloadMedia(BurnStepBase):
         cmd = f'download {media_type} {part_name} {img_type} {img.size()}'
         self._check_tpl_cmd(cmd)
 
+    def _read_media_ack(self, ack_len, length):
+        """Return the ack of a media block, None if none came in time
+
+        The device may pause while it writes its storage: the ack is awaited
+        up to MEDIA_ACK_DEADLINE seconds, as resending the block before a
+        late ack arrives would shift all the following acks. The adaptive
+        timeout only tells when the wait is reported as a stall.
+        """
+        ack_timeout = self._dev.mediaAckTimeout
+        start_time = time.time()
+        ack_start = time.perf_counter()
+        busy_time = None
+        stalled = False
+        while True:
+            exc = None
+            timeout = (ack_timeout.for_length(length)
+                       if busy_time is None and not stalled
+                       else ack_timeout.ceiling_ms)
+            try:
+                received = self._dev.devRead(ack_len, timeout).tobytes()
+            except Exception as e:
+                exc = e
+                if busy_time is None and is_stall(e) and not stalled:
+                    stalled = True
+                    metrics.record('stall:media_ack', length,
+                                   time.perf_counter() - ack_start, True)
+            else:
+                if not received.startswith(b'Continue:32'):
+                    break
+                if busy_time is None:
+                    busy_time = time.perf_counter()
+                time.sleep(3)
+
+            if (time.time() - start_time) > MEDIA_ACK_DEADLINE:
+                if busy_time is None and exc is not None and is_stall(exc):
+                    return None
+                if not exc:
+                    exc = TimeoutError()
+
+                raise exc
+
+        if busy_time is not None:
+            metrics.record('ack_wait:Continue:32', 0,
+                           time.perf_counter() - busy_time)
+        elif not stalled:
+            ack_timeout.record(length, time.perf_counter() - ack_start)
+
+        return received
+
     def _try_write_media(self, data, seq, resend_times=3):
         retry_times = 0
         ack_len = 0x200
@@ -572,33 +669,15 @@ class BurnStepDownloadMedia(BurnStepBase):
                                            seq=seq,
                                            retryTimes=retry_times)
             if success:
-                start_time = time.time()
-                while True:
-                    exc = None
-                    try:
-                        received = self._dev.devRead(ack_len, 1000).tobytes()
-                    except Exception as e:
-                        print(e)
-                        exc = e
-                    else:
-                        if not received.startswith(b'Continue:32'):
-                            break
-                        time.sleep(3)
-
-                    if (time.time() - start_time) > 10.0:
-                        if not exc:
-                            exc = TimeoutError()
-
-                        raise exc
-
-                if received.startswith(b'OK!!'):
+                received = self._read_media_ack(ack_len, len(data))
+                if received is not None and received.startswith(b'OK!!'):
                     break
 
             retry_times += 1
             if retry_times > resend_times:
-                raise Exception()
-            else:
-                time.sleep(0.2)
+                raise Exception(f'Media block {seq} failed after '
+                                f'{resend_times} resends')
+            logging.warning(f'Resending media block {seq}')
 
     def _download_media(self):
         img = self._images[(self._path, self._part)]
@@ -607,8 +686,9 @@ class BurnStepDownloadMedia(BurnStepBase):
 
         logging.info(f'Download media {self._part} {img.size()}...')
 
+        img.advise()
         while True:
-            data = img.read(block_size)
+            data = img.read_view(block_size)
             if not data:
                 break
 
@@ -742,23 +822,24 @@ class SharedData:
         return self._is_secure
 
 
-def do_burn(burn_steps):
+def do_burn(burn_steps, port=None, backend=None):
     reopen_dev = True
+    stage = None
 
     for step in burn_steps:
         if reopen_dev:
             try:
-                dev = wait_device()
+                # Waits for the board to leave the previous stage
+                dev = wait_device(port=port, backend=backend, stage=stage)
             except usb.core.NoBackendError:
                 logging.error('Please install libusb')
                 raise
 
         step.header()
         reopen_dev = step.do(dev)
+        stage = step.next_stage
         step.footer()
 
-        time.sleep(0.2)
-
 
 def get_burn_steps(args, shared_data, aml_img):
     bootloader_items = {
@@ -829,8 +910,8 @@ def get_burn_steps(args, shared_data, aml_img):
     return burn_steps
 
 
-def do_optimus_burn(args, aml_img):
+def do_optimus_burn(args, aml_img, port=None, backend=None):
     shared_data = SharedData()
     burn_steps = get_burn_steps(args, shared_data, aml_img)
 
-    do_burn(burn_steps)
+    do_burn(burn_steps, port=port, backend=backend)
@@ -8,12 +8,27 @@ Amlogic USB Boot Protocol Library
 @author: Neil Armstrong <narmstrong@baylibre.com>
 """
 
+import array
 import string
 import os
 import time
+import weakref
 import usb.core
+from collections import OrderedDict, namedtuple
+import usb.util
 from struct import Struct, unpack, pack
 
+from .autotune import get_profile
+from .capabilities import PROBE_LENGTH, get_capabilities
+from .checksum import addsum
+from .chunks import ChunkRing, is_buffer
+from .hotplug import wait_for
+from .metrics import instrument_ctrl, instrument_endpoint, timed_call
+from .stream import DEFAULT_QUEUE_DEPTH, open_stream
+from .timeouts import AdaptiveTimeout, clear_stall, is_stall, retry_request
+from .topology import port_match
+from .usb_backend import backend_name
+
 REQ_WRITE_MEM = 0x01
 REQ_READ_MEM = 0x02
 REQ_FILL_MEM = 0x03
@@ -40,6 +55,8 @@ REQ_NOP = 0x36
 REQ_GET_AMLC = 0x50
 REQ_WRITE_AMLC = 0x60
 
+REQUEST_NAMES = {v: k for k, v in globals().items() if k.startswith('REQ_')}
+
 FLAG_KEEP_POWER_ON = 0x10
 
 AMLC_AMLS_BLOCK_LENGTH = 0x200
@@ -52,35 +69,572 @@ WRITE_MEDIA_CHEKSUM_ALG_NONE = 0x00ee
 WRITE_MEDIA_CHEKSUM_ALG_ADDSUM = 0x00ef
 WRITE_MEDIA_CHEKSUM_ALG_CRC32 = 0x00f0
 
-class AmlogicSoC(object):
-    """Represents an Amlogic SoC in USB boot Mode"""
+# Bulk commands after which the device drops off the bus and re-enumerates
+REENUMERATING_BULKCMDS = ('reset', 'reboot', 'reboot-romusb')
+
+# Control payload layouts, packed into per-session buffers
+LARGE_MEM_HEADER = Struct('<IIII')
+WRITE_MEDIA_HEADER = Struct('<IIIIHH')
+WRITE_MEDIA_HEADER_LENGTH = 0x20
 
-    def __init__(self, idVendor=0x1b8e, idProduct=0xc003, usb_backend=None, timeout=0):
-        """Init with vendor/product IDs"""
+SIMPLE_MEM_MAX_LENGTH = 64
+STAGE_MINOR_TPL = 16
+
+# Large memory block length when neither given nor autotuned
+DEFAULT_BLOCK_LENGTH = 64
+
+# Block lengths writeMemory/readMemory may use for bulk transfers, when
+# the capabilities of the stage were probed to answer them, on the first
+# large access otherwise
+ROUTED_BLOCK_LENGTHS = (4096, 512, 64)
+
+# Register apertures of the GX and G12 SoCs, between the DRAM and the
+# SRAMs at 0xd9000000 and 0xfffa0000: DeviceMemory never caches them
+MMIO_RANGES = ((0xc0000000, 0xd9000000), (0xd9040000, 0xfffa0000))
+
+# waitForReg() polling interval bounds, in seconds
+POLL_MIN_INTERVAL = 0.0002
+POLL_MAX_INTERVAL = 0.05
+
+RegPoll = namedtuple('RegPoll', 'value polls seconds')
+
+
+class ShortReadError(ValueError):
+    """A large memory read got fewer bytes than requested
+
+    The device answers with short blocks while it is busy, like BL2
+    initialising the DRAM: pollers treat it as not ready yet.
+    """
+
+FILL_MEM_ENTRY = Struct('<II')
+FILL_MEM_MAX_WORDS = SIMPLE_MEM_MAX_LENGTH // FILL_MEM_ENTRY.size
+# writeLargeMemory(fillZeros=True) looks for zero runs with this
+# granularity, and only fills the ones of at least ZERO_RUN_MIN_LENGTH
+ZERO_RUN_GRANULE = 4096
+ZERO_RUN_MIN_LENGTH = 0x10000
+# fillMemory() memcpy requests copy at most this many bytes, each within
+# the control timeout
+FILL_COPY_MAX_LENGTH = 0x400000
+# File objects and iterables are written in chunks of about this length
+STREAM_CHUNK_LENGTH = 0x100000
+
+class TransportCost(object):
+    """Cost model of simple control versus large bulk memory transfers
+
+    Starts from typical USB 2.0 figures, then follows the timings measured
+    by writeMemory/readMemory as exponential moving averages. Bulk costs
+    are kept per block length, each block costing a bus turnaround.
+    """
+
+    SMOOTHING = 0.2
+
+    def __init__(self, ctrlSeconds=250e-6, byteSeconds=1.0 / (20 << 20),
+                 blockSeconds=125e-6):
+        self.ctrlSeconds = ctrlSeconds
+        self.bulkByteSeconds = dict(
+            (blockLength, byteSeconds + blockSeconds / blockLength)
+            for blockLength in ROUTED_BLOCK_LENGTHS)
+
+    def _smooth(self, value, sample):
+        return value + self.SMOOTHING * (sample - value)
+
+    def controlCost(self, length):
+        """Seconds to move length bytes as simple control transfers"""
+        return -(-length // SIMPLE_MEM_MAX_LENGTH) * self.ctrlSeconds
+
+    def bulkCost(self, length, blockLength):
+        """Seconds to move length bytes as one large transfer"""
+        # Setup control request plus the bulk turnaround
+        return 2 * self.ctrlSeconds + length * self.bulkByteSeconds[blockLength]
+
+    def useBulk(self, length, blockLength):
+        return length > 0 and \
+            self.bulkCost(length, blockLength) < self.controlCost(length)
+
+    def recordControl(self, length, seconds):
+        count = -(-length // SIMPLE_MEM_MAX_LENGTH)
+        self.ctrlSeconds = self._smooth(self.ctrlSeconds, seconds / count)
+
+    def recordBulk(self, length, blockLength, seconds):
+        sample = max(seconds - 2 * self.ctrlSeconds, 0) / length
+        self.bulkByteSeconds[blockLength] = self._smooth(
+            self.bulkByteSeconds[blockLength], sample)
+
+class RegisterTransaction(object):
+    """Queue of register operations sent in one burst by flush()
+
+    Operations run in the order they were queued. Writes extending the
+    previous write are merged into a single writeMemory(), isolated word
+    writes are packed 8 per fill request, read-modify-write operations
+    are sent as modify requests in between. Used as a context manager,
+    the queue is flushed on exit unless an exception was raised.
+    """
+
+    def __init__(self, dev):
+        self._dev = dev
+        self._ops = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.flush()
+        else:
+            self._ops = []
 
-        start = time.time()
-        while True:
-            self.dev = usb.core.find(idVendor=idVendor,
-                                    idProduct=idProduct,
-                                    backend=usb_backend)
+    def __len__(self):
+        return len(self._ops)
 
-            if self.dev is not None:
-                break
+    def writeMemory(self, address, data):
+        """Queue a memory write, merged with the previous one if contiguous"""
+        if self._ops:
+            op = self._ops[-1]
+            if op[0] == 'write' and op[1] + len(op[2]) == address:
+                op[2].extend(data)
+                return
+        self._ops.append(('write', address, bytearray(data)))
 
-            if timeout is not None and time.time() > start + timeout:
-                break
+    def writeReg(self, address, value):
+        self.writeMemory(address, pack('<I', value))
+
+    def maskRegAND(self, address, mask):
+        self._ops.append(('modify', 1, address, 0, mask, 0))
+
+    def maskRegOR(self, address, mask):
+        self._ops.append(('modify', 2, address, 0, mask, 0))
+
+    def maskRegNAND(self, address, mask):
+        self._ops.append(('modify', 3, address, 0, mask, 0))
+
+    def writeRegBits(self, address, mask, value):
+        self._ops.append(('modify', 4, address, value, mask, 0))
+
+    def copyReg(self, source, dest):
+        self._ops.append(('modify', 5, dest, 0, 0, source))
 
-            time.sleep(0.1)
+    def copyRegMaskAND(self, source, dest, mask):
+        self._ops.append(('modify', 6, dest, 0, mask, source))
+
+    def memcpy(self, dest, src, n):
+        self._ops.append(('modify', 7, src, n, 0, dest))
+
+    def readReg(self, address):
+        """Flush the queued operations, then read value at address"""
+        self.flush()
+        return self._dev.readReg(address)
+
+    def _sendFill(self, entries):
+        self._dev._ctrlTransfer(bmRequestType = 0x40,
+                                    bRequest = REQ_FILL_MEM,
+                                    wValue = 0, wIndex = 0,
+                                    data_or_wLength = b''.join(entries))
+
+    def flush(self):
+        """Send the queued operations"""
+        ops, self._ops = self._ops, []
+        fill = []
+
+        for op in ops:
+            if op[0] == 'write' and len(op[2]) == 4 and op[1] % 4 == 0:
+                fill.append(FILL_MEM_ENTRY.pack(op[1], unpack('<I', op[2])[0]))
+                if len(fill) == FILL_MEM_MAX_WORDS:
+                    self._sendFill(fill)
+                    fill = []
+                continue
+
+            if fill:
+                self._sendFill(fill)
+                fill = []
+
+            if op[0] == 'write':
+                self._dev.writeMemory(op[1], op[2])
+            else:
+                self._dev.modifyMemory(*op[1:])
+
+        if fill:
+            self._sendFill(fill)
+
+class DeviceMemory(object):
+    """Page cached view of the device memory
+
+    Indexing and slicing with addresses read and write memory, like
+    mem[0xd9000000:0xd9000010]. Reads are kept in a LRU cache of maxPages
+    aligned pages. When the stage was probed to answer multi-block large
+    reads, see AmlogicSoC.capabilities(), a miss fetches the whole page in
+    one large request; otherwise only the missing words asked for are
+    read. Writes go through to the device, or with writeBack are kept in
+    the cached pages until flush(), page eviction, or the next run/command
+    of the device.
+
+    Accesses touching the uncached ranges, MMIO_RANGES by default, always
+    go to the device with only the bytes asked for: registers may change
+    by themselves or be cleared by reads.
+
+    The cache is dropped when the device runs code, executes a U-Boot
+    command or enumerates again. Memory written by other means needs an
+    explicit invalidate().
+    """
+
+    def __init__(self, dev, pageSize=4096, maxPages=256, writeBack=False,
+                 uncached=MMIO_RANGES):
+        if pageSize <= 0 or pageSize & (pageSize - 1) or pageSize % 4:
+            raise ValueError('Page size must be a power of 2, at least 4')
+
+        self._dev = dev
+        self.pageSize = pageSize
+        self.maxPages = maxPages
+        self.writeBack = writeBack
+        self.uncached = tuple(uncached)
+        self.hits = 0
+        self.misses = 0
+        # page address -> [bytearray, dirty start, dirty end, valid words]
+        self._pages = OrderedDict()
+        self._generation = dev.memoryGeneration
+        dev._memoryViews.add(self)
+
+    def __len__(self):
+        return 1 << 32
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.flush()
+
+    def _sync(self):
+        if self._generation != self._dev.memoryGeneration:
+            self._pages.clear()
+            self._generation = self._dev.memoryGeneration
+
+    def _isUncached(self, address, length):
+        return any(address < end and start < address + length
+                   for start, end in self.uncached)
+
+    def _evict(self):
+        while len(self._pages) > self.maxPages:
+            pageAddress, page = self._pages.popitem(last=False)
+            if page[1] < page[2]:
+                self._dev.writeMemory(pageAddress + page[1], page[0][page[1]:page[2]])
+
+    def _page(self, pageAddress):
+        page = self._pages.get(pageAddress)
+        if page is not None:
+            self._pages.move_to_end(pageAddress)
+            return page
+
+        page = self._pages[pageAddress] = [bytearray(self.pageSize),
+                                           self.pageSize, 0,
+                                           bytearray(self.pageSize // 4)]
+        self._evict()
+        return page
+
+    def _missing(self, page, start, end):
+        """Yield the (start, end) byte runs of the words not cached yet"""
+        valid = page[3]
+        word = start // 4
+        last = -(-end // 4)
+        while word < last:
+            if valid[word]:
+                word = word + 1
+                continue
+            run = word
+            while word < last and not valid[word]:
+                word = word + 1
+            yield run * 4, word * 4
+
+    def _pageBlockLength(self):
+        """Block length to fetch whole pages with, 0 to read words"""
+        for blockLength in self._dev._routedBlockLengths():
+            if self.pageSize % blockLength == 0:
+                return blockLength
+        return 0
+
+    def _fill(self, pageAddress, page, start, end):
+        """Read the words of [start, end) of a page not cached yet"""
+        runs = list(self._missing(page, start, end))
+        if not runs:
+            self.hits = self.hits + 1
+            return
+
+        self.misses = self.misses + 1
+        blockLength = self._pageBlockLength()
+        if blockLength:
+            data = bytearray(self.pageSize)
+            self._dev.readLargeMemoryInto(pageAddress, data, blockLength)
+            runs = list(self._missing(page, 0, self.pageSize))
+
+        for runStart, runEnd in runs:
+            if blockLength:
+                page[0][runStart:runEnd] = data[runStart:runEnd]
+            else:
+                page[0][runStart:runEnd] = \
+                    self._dev.readMemory(pageAddress + runStart, runEnd - runStart)
+            page[3][runStart//4:runEnd//4] = b'\1' * ((runEnd - runStart) // 4)
+
+    def _spans(self, address, length):
+        """Yield (page address, page offset, offset, length) of an access"""
+        offset = 0
+        while offset < length:
+            pageOffset = (address + offset) & (self.pageSize - 1)
+            span = min(self.pageSize - pageOffset, length - offset)
+            yield address + offset - pageOffset, pageOffset, offset, span
+            offset = offset + span
+
+    def readinto(self, address, buffer):
+        """Fill buffer with memory at address, returns its length"""
+        view = memoryview(buffer).cast('B')
+        if self._isUncached(address, len(view)):
+            view[:] = self._dev.readMemory(address, len(view))
+            return len(view)
+
+        self._sync()
+        for pageAddress, pageOffset, offset, span in self._spans(address, len(view)):
+            page = self._page(pageAddress)
+            self._fill(pageAddress, page, pageOffset, pageOffset + span)
+            view[offset:offset+span] = page[0][pageOffset:pageOffset+span]
+        return len(view)
+
+    def read(self, address, length):
+        data = bytearray(length)
+        self.readinto(address, data)
+        return bytes(data)
+
+    def write(self, address, data):
+        view = memoryview(data).cast('B')
+        if self._isUncached(address, len(view)):
+            self._dev.writeMemory(address, view)
+            return
+
+        self._sync()
+        if not self.writeBack:
+            self._dev.writeMemory(address, view)
+
+        for pageAddress, pageOffset, offset, span in self._spans(address, len(view)):
+            end = pageOffset + span
+            if self.writeBack:
+                page = self._page(pageAddress)
+                # Words written whole need no read, the dirty range must
+                # otherwise be cached before it can be written back
+                page[3][-(-pageOffset // 4):end // 4] = \
+                    b'\1' * max(end // 4 - -(-pageOffset // 4), 0)
+                page[1] = min(page[1], pageOffset)
+                page[2] = max(page[2], end)
+                self._fill(pageAddress, page, page[1], page[2])
+            else:
+                page = self._pages.get(pageAddress)
+                if page is None:
+                    continue
+            page[0][pageOffset:end] = view[offset:offset+span]
+
+    def readReg(self, address):
+        return unpack('<I', self.read(address, 4))[0]
+
+    def writeReg(self, address, value):
+        self.write(address, pack('<I', value))
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise ValueError('Device memory slices must be contiguous')
+            return self.read(start, max(stop - start, 0))
+        return self.read(key, 1)[0]
+
+    def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1 or len(value) != stop - start:
+                raise ValueError('Device memory slices can not be resized')
+            self.write(start, value)
+        else:
+            self.write(key, bytes((value,)))
+
+    def flush(self):
+        """Write the dirty parts of the cached pages back to the device"""
+        start = None
+        chunks = []
+        for pageAddress in sorted(self._pages):
+            page = self._pages[pageAddress]
+            if page[1] >= page[2]:
+                continue
+            # Dirty parts running across page boundaries are sent together
+            if start is not None and page[1] == 0 and \
+                    start + sum(map(len, chunks)) == pageAddress:
+                chunks.append(page[0][:page[2]])
+            else:
+                if chunks:
+                    self._dev.writeMemory(start, b''.join(chunks))
+                start = pageAddress + page[1]
+                chunks = [page[0][page[1]:page[2]]]
+            page[1], page[2] = self.pageSize, 0
+        if chunks:
+            self._dev.writeMemory(start, b''.join(chunks))
+
+    def invalidate(self, address=None, length=1):
+        """Drop cached pages, all of them or those of an address range
+
+        Dirty data of the dropped pages is lost, flush() first to keep it.
+        """
+        if address is None:
+            self._pages.clear()
+            return
+
+        for pageAddress, _, _, _ in list(self._spans(address, length)):
+            self._pages.pop(pageAddress, None)
+
+class AmlogicSoC(object):
+    """Represents an Amlogic SoC in USB boot Mode"""
+
+    def __init__(self, idVendor=0x1b8e, idProduct=0xc003, usb_backend=None, timeout=0,
+                 streamDepth=DEFAULT_QUEUE_DEPTH, port=None):
+        """Init with vendor/product IDs
+
+        streamDepth is the number of bulk OUT transfers kept in flight when
+        the backend supports asynchronous transfers, 0 disables streaming.
+        port restricts the search to one USB port path (like '1-2.3'), see
+        pyamlboot.topology.
+        """
+        self.streamDepth = streamDepth
+        self.port = port
+        self.transportCost = TransportCost()
+        # Bulk timeouts follow the link, the former fixed values as ceilings
+        self.bulkOutTimeout = AdaptiveTimeout(1000)
+        self.bulkInTimeout = AdaptiveTimeout(100)
+        self.mediaAckTimeout = AdaptiveTimeout(1000, floor_ms=200)
+        self._stream = None
+        # Bumped whenever cached device memory may have changed
+        self.memoryGeneration = 0
+        self._memoryViews = weakref.WeakSet()
+
+        # Woken up by device arrivals rather than polling the bus
+        self.dev = wait_for(lambda: usb.core.find(idVendor=idVendor,
+                                                  idProduct=idProduct,
+                                                  backend=usb_backend,
+                                                  custom_match=port_match(port)),
+                            timeout)
 
         if self.dev is None:
             raise ValueError('Device not found')
 
+        self._resetSession()
+
+    def _resetSession(self):
+        """Drop everything resolved against the current enumeration"""
+        self._intf = None
+        self._epin = None
+        self._epout = None
+        self._epinIO = None
+        self._epoutIO = None
+        # Timed wrappers when metrics are enabled, plain pyusb calls else
+        self._ctrlTransfer = (instrument_ctrl(self.dev.ctrl_transfer, REQUEST_NAMES)
+                              if self.dev is not None else None)
+        # Control payloads are packed in place instead of rebuilt per call
+        self._largeMemHeader = array.array('B', bytes(LARGE_MEM_HEADER.size))
+        self._writeMediaHeader = array.array('B', bytes(WRITE_MEDIA_HEADER_LENGTH))
+        self._amlcAck = array.array('B', pack('<4sIII', b'OKAY', 0, 0, 0))
+        self._readBlock = array.array('B')
+        self._readBlockView = memoryview(self._readBlock)
+        self._writeBlock = array.array('B')
+        self._writeBlockView = memoryview(self._writeBlock)
+        if self._stream:
+            self._stream.close()
+        self._stream = None
+        self._identity = None
+        self._capabilities = {}
+        self._transferProfile = None
+        self.memoryGeneration = self.memoryGeneration + 1
+
+    def _memoryBarrier(self):
+        """Write back DeviceMemory views, then invalidate their pages"""
+        for view in list(self._memoryViews):
+            view.flush()
+        self.memoryGeneration = self.memoryGeneration + 1
+
+    def _endpoints(self):
+        """Return the (IN, OUT) bulk endpoints, resolved once per session"""
+        if self._epout is None:
+            cfg = self.dev.get_active_configuration()
+            self._intf = cfg[(0, 0)]
+            self._epin = usb.util.find_descriptor(
+                self._intf, custom_match=self._endpoint_match_in)
+            self._epout = usb.util.find_descriptor(
+                self._intf, custom_match=self._endpoint_match_out)
+            self._epinIO = instrument_endpoint(self._epin)
+            self._epoutIO = instrument_endpoint(self._epout)
+
+        return self._epinIO, self._epoutIO
+
+    def _outStream(self):
+        """Return the asynchronous OUT transport, or None if unavailable"""
+        if self._stream is None:
+            self._endpoints()
+            self._stream = open_stream(self.dev, self._epout, self.streamDepth) or False
+
+        return self._stream or None
+
+    def backendName(self):
+        """Return the name of the pyusb backend driving the device"""
+        return backend_name(self.dev)
+
+    def transferPath(self):
+        """Return 'stream' when bulk OUT blocks are queued asynchronously,
+        'sync' when they are sent one transfer at a time"""
+        return 'stream' if self._outStream() is not None else 'sync'
+
+    def _iterBlocks(self, view, blockLength, pad):
+        for offset in range(0, len(view), blockLength):
+            block = view[offset:offset+blockLength]
+            if pad and len(block) < blockLength:
+                block = self._stageBlock(block, blockLength)
+            yield block
+
+    def _writeBlocks(self, ep, view, blockLength, pad=True, restart=False,
+                     onBlock=None):
+        """Send view as consecutive bulk transfers of blockLength bytes
+
+        Blocks are queued on the asynchronous transport when available. With
+        pad, a short last block is zero padded up to blockLength, else it is
+        sent as is. A stalled block is not resent: the device may have got
+        part of it, the caller issues a new request, with restart set to get
+        the ceiling timeouts. onBlock(length) is called after each block
+        known to be sent whole.
+        """
+        timeouts = self.bulkOutTimeout
+        stream = self._outStream()
+        if stream is not None:
+            # Queued transfers wait behind the ones in flight
+            timeout = (timeouts.ceiling_ms if restart else
+                       timeouts.for_length(blockLength * self.streamDepth))
+            start = time.perf_counter()
+            timed_call('bulk_out_stream', len(view), stream.write,
+                       self._iterBlocks(view, blockLength, pad), timeout)
+            timeouts.record(len(view), time.perf_counter() - start)
+            if onBlock is not None:
+                onBlock(len(view))
+            return
+
+        for offset in range(0, len(view), blockLength):
+            block = view[offset:offset+blockLength]
+            block = self._stageBlock(block, blockLength if pad else len(block))
+            timeout = (timeouts.ceiling_ms if restart else
+                       timeouts.for_length(len(block)))
+            start = time.perf_counter()
+            ep.write(block, timeout)
+            timeouts.record(len(block), time.perf_counter() - start)
+            if onBlock is not None:
+                onBlock(min(blockLength, len(view) - offset))
+
+    def _packLargeMemHeader(self, address, length):
+        LARGE_MEM_HEADER.pack_into(self._largeMemHeader, 0, address, length, 0, 0)
+        return self._largeMemHeader
+
     def writeSimpleMemory(self, address, data):
         """Write a chunk of data to memory"""
         if len(data) > 64:
             raise ValueError('Maximum size of 64bytes')
 
-        self.dev.ctrl_transfer(bmRequestType = 0x40,
+        self._ctrlTransfer(bmRequestType = 0x40,
                                bRequest = REQ_WRITE_MEM,
                                wValue = address >> 16,
                                wIndex = address & 0xffff,
@@ -92,19 +646,125 @@ class AmlogicSoC(object):
             self.dev = None
         except Exception as e:
             print("Can't release device. {0}: {1}".format(type(e).__name__, e))
+        self._resetSession()
+
+    def capabilities(self, probeAddress=None, cache=True, scratchAddress=None,
+                     probeLength=PROBE_LENGTH):
+        """Return the Capabilities of the current boot stage
+
+        Probed once per stage, see pyamlboot.capabilities. probeAddress is a
+        readable address used to probe memory reads, scratchAddress memory
+        free to be written back to probe multi-block large writes, each
+        with probeLength bytes behind.
+        """
+        key = (probeAddress, scratchAddress, probeLength)
+        caps = self._capabilities.get(key)
+        if caps is None:
+            caps = get_capabilities(self, probeAddress, cache, scratchAddress,
+                                    probeLength)
+            self._capabilities[key] = caps
+        return caps
+
+    def transferProfile(self, refresh=False):
+        """Return the autotuned transfer profile of the current boot stage
+
+        See pyamlboot.autotune, an empty dict when it was never tuned.
+        """
+        if self._transferProfile is None or refresh:
+            self._transferProfile = get_profile(self) or {}
+        return self._transferProfile
+
+    def tunedBlockLength(self, kind, default=DEFAULT_BLOCK_LENGTH):
+        """Return the autotuned block length of a transfer kind, or default
+
+        kind is 'write_large' or 'read_large'.
+        """
+        return self.transferProfile().get('block_lengths', {}).get(kind, default)
+
+    def _inTpl(self):
+        """Return whether U-Boot is answering, cached until the next run"""
+        return ord(self.identify()[3]) == STAGE_MINOR_TPL
+
+    def _routedBlockLengths(self, write=False):
+        """Large memory block lengths the probed capabilities answer
+
+        Only capabilities already probed for the current stage are looked
+        at, fastest first: without a probe, memory accesses stay simple
+        control transfers. Writes also need multi-block writes probed.
+        """
+        lengths = set()
+        for caps in self._capabilities.values():
+            if caps.multi_block_write or not write:
+                lengths.update(caps.block_lengths)
+        return [blockLength for blockLength in ROUTED_BLOCK_LENGTHS
+                if blockLength in lengths]
+
+    def _probeMemory(self, address, length, write):
+        """Probe large memory requests at the first access worth it
+
+        Once per stage, for reads and for writes: a write probes at its
+        own destination, about to be overwritten. Register apertures are
+        never probed.
+        """
+        if any(key[1 if write else 0] is not None for key in self._capabilities):
+            return
+        if any(address < end and start < address + length
+               for start, end in MMIO_RANGES):
+            return
+        if not self.transportCost.useBulk(length - length % SIMPLE_MEM_MAX_LENGTH,
+                                          SIMPLE_MEM_MAX_LENGTH):
+            return
+
+        self.capabilities(address, scratchAddress=address if write else None,
+                          probeLength=min(length, PROBE_LENGTH))
+
+    def _routeMemory(self, address, length, write):
+        """Split a memory access into (length, blockLength) segments
+
+        blockLength is 0 for segments sent as simple control transfers. The
+        bulk path is only taken from a 32-bit aligned address, with block
+        lengths the stage was probed to answer, for the whole blocks where
+        the cost model expects it to be faster. The first such access of a
+        stage probes them, see _probeMemory().
+        """
+        head = min(-address % 4, length)
+        if head:
+            yield head, 0
+
+        remaining = length - head
+        cost = self.transportCost
+        self._probeMemory(address + head, remaining, write)
+        for blockLength in self._routedBlockLengths(write):
+            bulkLength = remaining - remaining % blockLength
+            if cost.useBulk(bulkLength, blockLength):
+                yield bulkLength, blockLength
+                remaining = remaining - bulkLength
+
+        if remaining:
+            yield remaining, 0
 
     def writeMemory(self, address, data):
-        """Write some data to memory"""
-        length = len(data)
+        """Write some data to memory
+
+        Picks simple control or large bulk transfers per segment, see
+        TransportCost.
+        """
+        view = memoryview(data).cast('B')
         offset = 0
 
-        while length:
-            self.writeSimpleMemory(address + offset, data[offset:offset+64])
-            if length > 64:
-                length = length - 64
+        for length, blockLength in self._routeMemory(address, len(view), True):
+            start = time.perf_counter()
+            if blockLength:
+                self.writeLargeMemory(address + offset, view[offset:offset+length],
+                                      blockLength)
+                self.transportCost.recordBulk(length, blockLength,
+                                              time.perf_counter() - start)
             else:
-                break
-            offset = offset + 64
+                for chunk in range(offset, offset + length, SIMPLE_MEM_MAX_LENGTH):
+                    end = min(chunk + SIMPLE_MEM_MAX_LENGTH, offset + length)
+                    self.writeSimpleMemory(address + chunk, view[chunk:end])
+                self.transportCost.recordControl(length, time.perf_counter() - start)
+            offset = offset + length
 
     def readSimpleMemory(self, address, length):
         """Read a chunk of data from memory"""
@@ -114,7 +774,7 @@ class AmlogicSoC(object):
         if length > 64:
             raise ValueError('Maximum size of 64bytes')
 
-        ret = self.dev.ctrl_transfer(bmRequestType = 0xc0,
+        ret = self._ctrlTransfer(bmRequestType = 0xc0,
                                      bRequest = REQ_READ_MEM,
                                      wValue = address >> 16,
                                      wIndex = address & 0xffff,
@@ -123,27 +783,91 @@ class AmlogicSoC(object):
         return ret
 
     def readMemory(self, address, length):
-        """Read some data from memory"""
-        data = bytes()
+        """Read some data from memory
+
+        Picks simple control or large bulk transfers per segment, see
+        TransportCost.
+        """
+        data = bytearray(length)
+        view = memoryview(data)
         offset = 0
 
-        while length:
-            if length >= 64:
-                data = data.append(self.readSimpleMemory(address + offset, 64))
-                length = length - 64
-                offset = offset + 64
+        for segment, blockLength in self._routeMemory(address, length, False):
+            start = time.perf_counter()
+            if blockLength:
+                self.readLargeMemoryInto(address + offset,
+                                         view[offset:offset+segment], blockLength)
+                self.transportCost.recordBulk(segment, blockLength,
+                                              time.perf_counter() - start)
             else:
-                data += self.readSimpleMemory(address + offset, length)
-                break
+                for chunk in range(offset, offset + segment, SIMPLE_MEM_MAX_LENGTH):
+                    end = min(chunk + SIMPLE_MEM_MAX_LENGTH, offset + segment)
+                    view[chunk:end] = self.readSimpleMemory(address + chunk, end - chunk)
+                self.transportCost.recordControl(segment, time.perf_counter() - start)
+            offset = offset + segment
 
         return data
 
-    # fillMemory
+    def fillMemory(self, address, length, value=0):
+        """Fill length bytes of memory with a 32-bit value
+
+        Up to 8 words are set by one fill request, the filled area is then
+        doubled by memcpy requests of at most FILL_COPY_MAX_LENGTH: filling
+        N bytes takes about log2(N / 32) control requests instead of N bytes
+        of bulk data. The fill and memcpy requests are untested on some
+        stages: when either stalls, the area is written by large memory
+        requests instead.
+        """
+        if address % 4 or length % 4:
+            raise ValueError('Fill must be 32-bit aligned')
+
+        try:
+            self._fillMemory(address, length, value)
+        except usb.core.USBError as e:
+            if not is_stall(e):
+                raise
+            self._writeFill(address, length, value)
+
+    def _fillMemory(self, address, length, value):
+        words = length // 4
+        first = min(words, FILL_MEM_MAX_WORDS)
+        controlData = b''.join(FILL_MEM_ENTRY.pack(address + 4 * i, value)
+                               for i in range(first))
+        if controlData:
+            self._ctrlTransfer(bmRequestType = 0x40,
+                                   bRequest = REQ_FILL_MEM,
+                                   wValue = 0, wIndex = 0,
+                                   data_or_wLength = controlData)
+
+        done = first
+        while done < words:
+            count = min(done, words - done, FILL_COPY_MAX_LENGTH // 4)
+            self.memcpy(address + 4 * done, address, count)
+            done = done + count
+
+    def _writeFill(self, address, length, value):
+        """Write a filled area through large memory requests"""
+        blockLength = self.tunedBlockLength('write_large')
+        chunkLength = max(1, STREAM_CHUNK_LENGTH // blockLength) * blockLength
+        chunk = memoryview(pack('<I', value) * (chunkLength // 4))
+        whole = length - length % blockLength
+
+        def chunks():
+            for offset in range(0, whole, chunkLength):
+                yield chunk[:whole - offset]
+
+        if whole:
+            self.writeLargeMemory(address, chunks(), blockLength)
+        # The rest as one shorter block, nothing written past the area
+        if whole < length:
+            self._writeLargeMemory(address + whole, chunk[:length - whole],
+                                   length - whole)
+
     def modifyMemory(self, opcode, address1, data, mask, address2):
         """UNTESTED: Modify memory with a pattern"""
         controlData = pack('<IIII', address1, data, mask, address2)
 
-        self.dev.ctrl_transfer(bmRequestType = 0x40,
+        self._ctrlTransfer(bmRequestType = 0x40,
                                bRequest = REQ_MODIFY_MEM,
                                wValue = opcode,
                                wIndex = 0,
@@ -154,6 +878,37 @@ class AmlogicSoC(object):
         reg = self.readSimpleMemory(address, 4)
         return int.from_bytes(reg, byteorder='little')
 
+    def waitForReg(self, address, mask, value, timeout=1.0,
+                   interval=POLL_MIN_INTERVAL, maxInterval=POLL_MAX_INTERVAL):
+        """Poll the register at address until (reg & mask) == value
+
+        The first poll is immediate, the delay between polls then starts at
+        interval seconds and doubles up to maxInterval. In U-Boot the
+        register is read with 'upload mem'. Returns a RegPoll with the last
+        value read, the number of polls and the seconds waited, raises
+        TimeoutError when the condition is still false after timeout seconds.
+        """
+        if self._inTpl():
+            read = lambda: unpack('<I', self.uploadMemory(address, 4)[:4])[0]
+        else:
+            read = lambda: self.readReg(address)
+
+        start = time.monotonic()
+        deadline = start + timeout
+        polls = 0
+
+        while True:
+            reg = read()
+            polls = polls + 1
+            now = time.monotonic()
+            if reg & mask == value:
+                return RegPoll(reg, polls, now - start)
+            if now >= deadline:
+                raise TimeoutError('Register 0x%x still 0x%x after %d polls' %
+                                   (address, reg, polls))
+            time.sleep(min(interval, deadline - now))
+            interval = min(interval * 2, maxInterval)
+
     def writeReg(self, address, value):
         """UNTESTED: Write value at address"""
         self.modifyMemory(0, address, value, 0, 0)
@@ -186,6 +941,15 @@ class AmlogicSoC(object):
         """UNTESTED: copy n words from src to dest"""
         self.modifyMemory(7, src, n, 0, dest)
 
+    def transaction(self):
+        """Return a RegisterTransaction batching register operations"""
+        return RegisterTransaction(self)
+
+    def memory(self, pageSize=4096, maxPages=256, writeBack=False,
+               uncached=MMIO_RANGES):
+        """Return a page cached DeviceMemory view of the device memory"""
+        return DeviceMemory(self, pageSize, maxPages, writeBack, uncached)
+
     def run(self, address, keep_power=True):
         """Run code from memory"""
         if keep_power:
@@ -193,7 +957,12 @@ class AmlogicSoC(object):
         else:
             data = address
         controlData = pack('<I', data)
-        self.dev.ctrl_transfer(bmRequestType = 0x40,
+        self._memoryBarrier()
+        # The code run may be the next boot stage
+        self._identity = None
+        self._capabilities = {}
+        self._transferProfile = None
+        self._ctrlTransfer(bmRequestType = 0x40,
                                bRequest = REQ_RUN_IN_ADDR,
                                wValue = address >> 16,
                                wIndex = address & 0xffff,
@@ -202,45 +971,140 @@ class AmlogicSoC(object):
     # writeAux
     # readAux
 
-    def _writeLargeMemory(self, address, data, blockLength=64, appendZeros=False):
-        if appendZeros:
-            append = len(data) % blockLength
-            data = data + pack('b', 0) * append
-        elif len(data) % blockLength != 0:
-            raise ValueError('Large Data must be a multiple of block length')
+    def _stageBlock(self, view, blockLength):
+        """Copy a block into the session's bulk OUT buffer
 
-        blockCount = int(len(data) / blockLength)
-        if len(data) % blockLength > 0:
-            blockCount = blockCount + 1
-        controlData = pack('<IIII', address, len(data), 0, 0)
+        pyusb only sends array objects, so every block goes through this one
+        reused buffer. A short block is zero padded up to blockLength.
+        """
+        if len(self._writeBlock) != blockLength:
+            self._writeBlock = array.array('B', bytes(blockLength))
+            self._writeBlockView = memoryview(self._writeBlock)
 
-        offset = 0
+        length = len(view)
+        self._writeBlockView[:length] = view
+        if length < blockLength:
+            self._writeBlockView[length:] = bytes(blockLength - length)
 
-        cfg = self.dev.get_active_configuration()
-        intf = cfg[(0,0)]
-        ep = usb.util.find_descriptor(
-                        intf,
-                        # match the first OUT endpoint
-                        custom_match = \
-                        lambda e: \
-                        usb.util.endpoint_direction(e.bEndpointAddress) == \
-                        usb.util.ENDPOINT_OUT)
-
-        self.dev.ctrl_transfer(bmRequestType = 0x40,
-                               bRequest = REQ_WR_LARGE_MEM,
-                               wValue = blockLength,
-                               wIndex = blockCount,
-                               data_or_wLength = controlData)
+        return self._writeBlock
 
-        while blockCount > 0:
-            ep.write(data[offset:offset+blockLength], 1000)
-            offset = offset + blockLength
-            blockCount = blockCount - 1
+    def _writeLargeMemory(self, address, data, blockLength=64, appendZeros=False):
+        view = memoryview(data).cast('B')
+        length = len(view)
+        if not appendZeros and length % blockLength != 0:
+            raise ValueError('Large Data must be a multiple of block length')
+
+        _, ep = self._endpoints()
+        sent = 0
+
+        def onBlock(blockSent):
+            nonlocal sent
+            sent = sent + blockSent
+
+        def request(restart):
+            # A stalled block may have partly reached the device: a new
+            # request rewrites it whole, at its own address
+            remaining = length - sent
+            blockCount = -(-remaining // blockLength)
+            # With appendZeros the last block is sent zero padded
+            controlData = self._packLargeMemHeader(address + sent,
+                                                   blockCount * blockLength)
+
+            self._ctrlTransfer(bmRequestType = 0x40,
+                                   bRequest = REQ_WR_LARGE_MEM,
+                                   wValue = blockLength,
+                                   wIndex = blockCount,
+                                   data_or_wLength = controlData)
+
+            self._writeBlocks(ep, view[sent:], blockLength, restart=restart,
+                              onBlock=onBlock)
+
+        retry_request(request, lambda e: clear_stall(ep, e), length,
+                      lambda: sent, kind='write_large')
+
+    def _writePaddedTail(self, address, view, blockLength):
+        """Write a short last block, its zero padding through fillMemory"""
+        dataLength = -(-len(view) // 4) * 4
+        self._writeLargeMemory(address, view, dataLength, appendZeros=True)
+        if dataLength < blockLength:
+            self.fillMemory(address + dataLength, blockLength - dataLength)
+
+    def _zeroRuns(self, view, blockLength):
+        """Yield (offset, length, isZero) segments covering view
+
+        Zero runs are made of whole granules, a multiple of blockLength, so
+        the data segments around them keep whole blocks.
+        """
+        granule = -(-ZERO_RUN_GRANULE // blockLength) * blockLength
+        zeros = bytes(granule)
+        length = len(view)
+        start = 0
+        runStart = None
+        offset = 0
 
-    def writeLargeMemory(self, address, data, blockLength=64, appendZeros=False):
-        """Write some data to memory, for large transfers with a programmable block length"""
-        blockCount = int(len(data) / blockLength)
-        if len(data) % blockLength > 0:
+        while offset + granule <= length:
+            if view[offset:offset+granule] == zeros:
+                if runStart is None:
+                    runStart = offset
+            elif runStart is not None:
+                if offset - runStart >= ZERO_RUN_MIN_LENGTH:
+                    if runStart > start:
+                        yield start, runStart - start, False
+                    yield runStart, offset - runStart, True
+                    start = offset
+                runStart = None
+            offset = offset + granule
+
+        if runStart is not None and offset - runStart >= ZERO_RUN_MIN_LENGTH:
+            if runStart > start:
+                yield start, runStart - start, False
+            yield runStart, offset - runStart, True
+            start = offset
+
+        if start < length:
+            yield start, length - start, False
+
+    def writeLargeMemory(self, address, data, blockLength=None, appendZeros=False,
+                         fillZeros=False):
+        """Write some data to memory, for large transfers with a programmable block length
+
+        data can be any object exposing a buffer (bytes, bytearray, mmap...),
+        it is sliced through a memoryview and never copied as a whole. It
+        can also be a file object or an iterable of chunks, streamed through
+        a ring of buffers of about STREAM_CHUNK_LENGTH, see pyamlboot.chunks.
+        With fillZeros, runs of zeros, and the zero padding of appendZeros,
+        are written by fillMemory instead.
+        Without blockLength, the autotuned one is used, see tunedBlockLength.
+        Returns the number of bytes written.
+        """
+        if blockLength is None:
+            blockLength = self.tunedBlockLength('write_large')
+        if not is_buffer(data):
+            chunkLength = max(1, STREAM_CHUNK_LENGTH // blockLength) * blockLength
+            ring = ChunkRing(data, chunkLength)
+            for chunk in ring:
+                self.writeLargeMemory(address + ring.length - len(chunk), chunk,
+                                      blockLength, appendZeros, fillZeros)
+            return ring.length
+
+        view = memoryview(data).cast('B')
+        if fillZeros and address % 4 == 0:
+            tail = len(view) % blockLength if appendZeros else 0
+            whole = len(view) - tail
+            for offset, length, isZero in self._zeroRuns(view[:whole], blockLength):
+                if isZero:
+                    self.fillMemory(address + offset, length)
+                else:
+                    self.writeLargeMemory(address + offset,
+                                          view[offset:offset+length],
+                                          blockLength)
+            if tail:
+                self._writePaddedTail(address + whole, view[whole:], blockLength)
+            return len(view)
+
+        length = len(view)
+        blockCount = int(length / blockLength)
+        if length % blockLength > 0:
             blockCount = blockCount + 1
         transferCount = int(blockCount / MAX_LARGE_BLOCK_COUNT)
         if blockCount % MAX_LARGE_BLOCK_COUNT > 0:
@@ -248,81 +1112,158 @@ class AmlogicSoC(object):
         offset = 0
 
         while transferCount > 0:
-            if (offset + (MAX_LARGE_BLOCK_COUNT * blockLength)) > len(data):
-                writeLength = len(data) - offset
+            if (offset + (MAX_LARGE_BLOCK_COUNT * blockLength)) > length:
+                writeLength = length - offset
             else:
                 writeLength = (MAX_LARGE_BLOCK_COUNT * blockLength)
-            self._writeLargeMemory(address+offset, data[offset:offset+writeLength], \
+            self._writeLargeMemory(address+offset, view[offset:offset+writeLength], \
                                    blockLength, appendZeros)
             offset = offset + writeLength
             transferCount = transferCount - 1
 
-    def _readLargeMemory(self, address, length, blockLength=64, appendZeros=False):
-        """Read some data from memory, for large transfers with a programmable block length"""
-        if appendZeros:
-            length = length + (length % blockLength)
-        elif length % blockLength != 0:
-            raise ValueError('Large Data must be a multiple of block length')
+        return length
 
-        blockCount = int(length / blockLength)
-        if length % blockLength > 0:
-            blockCount = blockCount + 1
-        controlData = pack('<IIII', address, length, 0, 0)
-        data = bytes()
-
-        cfg = self.dev.get_active_configuration()
-        intf = cfg[(0,0)]
-        ep = usb.util.find_descriptor(
-                        intf,
-                        # match the first OUT endpoint
-                        custom_match = \
-                        lambda e: \
-                        usb.util.endpoint_direction(e.bEndpointAddress) == \
-                        usb.util.ENDPOINT_IN)
-
-        self.dev.ctrl_transfer(bmRequestType = 0x40,
-                               bRequest = REQ_RD_LARGE_MEM,
-                               wValue = blockLength,
-                               wIndex = blockCount,
-                               data_or_wLength = controlData)
+    def _readBlockBuffer(self, blockLength):
+        """Return the session's bulk IN buffer, sized to exactly one block"""
+        if len(self._readBlock) != blockLength:
+            self._readBlock = array.array('B', bytes(blockLength))
+            self._readBlockView = memoryview(self._readBlock)
+        return self._readBlock, self._readBlockView
 
-        while blockCount > 0:
-            data += ep.read(blockLength, 100)
-            blockCount = blockCount - 1
+    def _readLargeMemoryInto(self, address, view, blockLength=64, timeout=None):
+        """Read one large transfer into a writable byte memoryview
 
-        return data
+        Without timeout, a stalled block is read again through a new request
+        starting at its address, after dropping any late data.
+        """
+        length = len(view)
+        block, blockView = self._readBlockBuffer(blockLength)
+        ep, _ = self._endpoints()
+        timeouts = self.bulkInTimeout
+        offset = 0
 
-    def readLargeMemory(self, address, length, blockLength=64, appendZeros=False):
-        """Read some data from memory, for large transfers with a programmable block length"""
-        blockCount = int(length / blockLength)
-        if length % blockLength > 0:
-            blockCount = blockCount + 1
-        transferCount = int(blockCount / MAX_LARGE_BLOCK_COUNT)
-        if blockCount % MAX_LARGE_BLOCK_COUNT > 0:
-            transferCount = transferCount + 1
+        def request(restart):
+            nonlocal offset
+            blockCount = -(-(length - offset) // blockLength)
+            # The device always sends whole blocks, the padding of the last
+            # one is dropped
+            controlData = self._packLargeMemHeader(address + offset,
+                                                   blockCount * blockLength)
+
+            self._ctrlTransfer(bmRequestType = 0x40,
+                                   bRequest = REQ_RD_LARGE_MEM,
+                                   wValue = blockLength,
+                                   wIndex = blockCount,
+                                   data_or_wLength = controlData)
+
+            for _ in range(blockCount):
+                if timeout is not None:
+                    read = ep.read(block, timeout)
+                else:
+                    blockTimeout = (timeouts.ceiling_ms if restart else
+                                    timeouts.for_length(blockLength))
+                    start = time.perf_counter()
+                    read = ep.read(block, blockTimeout)
+                    timeouts.record(blockLength, time.perf_counter() - start)
+                read = min(read, length - offset)
+                view[offset:offset+read] = blockView[:read]
+                offset = offset + read
+
+        def recover(e):
+            # A late block would be read as the first one of the new request
+            clear_stall(ep, e)
+            self._drainIn(ep, block, -(-(length - offset) // blockLength))
+
+        if timeout is None:
+            retry_request(request, recover, length, lambda: offset,
+                          kind='read_large')
+        else:
+            request(False)
+
+        if offset != length:
+            raise ShortReadError('Short Large Data read: %d of %d bytes' % (offset, length))
+
+    def _drainIn(self, ep, block, count):
+        """Read and drop up to count blocks left pending on a bulk IN endpoint"""
+        for _ in range(count):
+            try:
+                ep.read(block, self.bulkInTimeout.ceiling_ms)
+            except usb.core.USBError:
+                return
+
+    def readLargeMemoryInto(self, address, buffer, blockLength=None, timeout=None):
+        """Read memory straight into a caller supplied writable buffer
+
+        buffer can be anything exposing a writable buffer (bytearray,
+        memoryview, mmap, array). Its whole length is filled, only one
+        block of temporary memory is used. Returns the number of bytes read.
+        Without timeout, in ms, blocks get adaptive timeouts and a stall
+        restarts the request from the first block not read yet. Without
+        blockLength, the autotuned one is used.
+        """
+        if blockLength is None:
+            blockLength = self.tunedBlockLength('read_large')
+        view = memoryview(buffer).cast('B')
+        length = len(view)
+        maxLength = MAX_LARGE_BLOCK_COUNT * blockLength
         offset = 0
-        data = bytes()
 
-        while transferCount > 0:
-            if (offset + (MAX_LARGE_BLOCK_COUNT * blockLength)) > length:
-                readLength = length - offset
-            else:
-                readLength = (MAX_LARGE_BLOCK_COUNT * blockLength)
-            data += self._readLargeMemory(address+offset, readLength, \
-                                                blockLength, appendZeros)
+        while offset < length:
+            readLength = min(length - offset, maxLength)
+            self._readLargeMemoryInto(address + offset,
+                                      view[offset:offset+readLength],
+                                      blockLength, timeout)
             offset = offset + readLength
-            transferCount = transferCount - 1
+
+        return length
+
+    def iterLargeMemory(self, address, length, blockLength=None,
+                        chunkLength=0x10000, timeout=None):
+        """Read memory as a sequence of chunks with bounded memory
+
+        Yields memoryviews over a single reused buffer, a chunk is only valid
+        until the next one is requested.
+        """
+        if blockLength is None:
+            blockLength = self.tunedBlockLength('read_large')
+        chunkLength = max(blockLength, chunkLength - chunkLength % blockLength)
+        chunk = memoryview(bytearray(min(chunkLength, length)))
+        offset = 0
+
+        while offset < length:
+            readLength = min(length - offset, chunkLength)
+            view = chunk[:readLength]
+            self.readLargeMemoryInto(address + offset, view, blockLength, timeout)
+            yield view
+            offset = offset + readLength
+
+    def readLargeMemory(self, address, length, blockLength=None, appendZeros=False):
+        """Read some data from memory, for large transfers with a programmable block length"""
+        if blockLength is None:
+            blockLength = self.tunedBlockLength('read_large')
+        if not appendZeros and length % blockLength != 0:
+            raise ValueError('Large Data must be a multiple of block length')
+
+        data = bytearray(length)
+        self.readLargeMemoryInto(address, data, blockLength)
 
         return data
 
-    def identify(self):
-        """Identify the ROM Protocol"""
-        ret = self.dev.ctrl_transfer(bmRequestType = 0xc0,
-                                     bRequest = REQ_IDENTIFY_HOST,
-                                     wValue = 0, wIndex = 0,
-                                     data_or_wLength = 8)
+    def identify(self, refresh=False):
+        """Identify the ROM Protocol
+
+        The answer is cached for the session until something may change
+        it: run(), tplCommand(), sendPassword(), a re-enumerating bulk
+        command or a new enumeration. refresh asks the device again.
+        """
+        if self._identity is None or refresh:
+            ret = self._ctrlTransfer(bmRequestType = 0xc0,
+                                         bRequest = REQ_IDENTIFY_HOST,
+                                         wValue = 0, wIndex = 0,
+                                         data_or_wLength = 8)
+            self._identity = ''.join([chr(x) for x in ret])
 
-        return ''.join([chr(x) for x in ret])
+        return self._identity
 
     def tplCommand(self, subcode, command):
         terminated_cmd = command + '\0'
@@ -332,14 +1273,17 @@ class AmlogicSoC(object):
         if len(terminated_cmd) >= 128:
             raise ValueError("TPL command must be shorter than 127 characters")
 
-        self.dev.ctrl_transfer(bmRequestType = 0x40,
+        self._memoryBarrier()
+        # U-Boot commands may boot something else
+        self._identity = None
+        self._ctrlTransfer(bmRequestType = 0x40,
                                bRequest = REQ_TPL_CMD,
                                wValue = 0, wIndex = subcode,
                                data_or_wLength = terminated_cmd)
 
     # tplStat
     def tplStat(self, timeout=None):
-        return self.dev.ctrl_transfer(bmRequestType=0xc0,
+        return self._ctrlTransfer(bmRequestType=0xc0,
                                       bRequest=REQ_TPL_STAT,
                                       wValue=0,
                                       wIndex=0,
@@ -352,14 +1296,16 @@ class AmlogicSoC(object):
         else:
             controlData = password
 
-        self.dev.ctrl_transfer(bmRequestType = 0x40,
+        # identify() reports whether the password was accepted
+        self._identity = None
+        self._ctrlTransfer(bmRequestType = 0x40,
                                bRequest = REQ_PASSWORD,
                                wValue = 0, wIndex = 0,
                                data_or_wLength = controlData)
 
     def nop(self):
         """No-Operation, for testing purposes"""
-        self.dev.ctrl_transfer(bmRequestType = 0x40,
+        self._ctrlTransfer(bmRequestType = 0x40,
                                bRequest = REQ_NOP,
                                wValue = 0, wIndex = 0,
                                data_or_wLength = None)
@@ -367,24 +1313,9 @@ class AmlogicSoC(object):
     def getBootAMLC(self):
         """Read BL2 Boot AMLC Data Request"""
 
-        cfg = self.dev.get_active_configuration()
-        intf = cfg[(0,0)]
-        epout = usb.util.find_descriptor(
-                        intf,
-                        # match the first OUT endpoint
-                        custom_match = \
-                        lambda e: \
-                        usb.util.endpoint_direction(e.bEndpointAddress) == \
-                        usb.util.ENDPOINT_OUT)
-        epin = usb.util.find_descriptor(
-                        intf,
-                        # match the first OUT endpoint
-                        custom_match = \
-                        lambda e: \
-                        usb.util.endpoint_direction(e.bEndpointAddress) == \
-                        usb.util.ENDPOINT_IN)
-
-        self.dev.ctrl_transfer(bmRequestType = 0x40,
+        epin, epout = self._endpoints()
+
+        self._ctrlTransfer(bmRequestType = 0x40,
                                bRequest = REQ_GET_AMLC,
                                wValue = AMLC_AMLS_BLOCK_LENGTH,
                                wIndex = 0,
@@ -397,51 +1328,29 @@ class AmlogicSoC(object):
             raise ValueError('Invalid AMLC Request %s' % data[0:16])
 
         # Ack the request
-        okay = pack('<4sIII', bytes("OKAY", 'ascii'), 0, 0, 0)
-        epout.write(okay, 1000)
+        epout.write(self._amlcAck, 1000)
 
         return (length, offset)
 
     def _writeAMLCData(self, offset, data):
         """Write AMLC data block, or final AMLS"""
-        dataOffset = 0
-        writeLength = len(data)
-        blockCount = int(writeLength / AMLC_MAX_BLOCK_LENGTH)
-        if len(data) % AMLC_MAX_BLOCK_LENGTH > 0:
-            blockCount = blockCount + 1
+        view = memoryview(data).cast('B')
+        writeLength = len(view)
 
-        cfg = self.dev.get_active_configuration()
-        intf = cfg[(0,0)]
-        epout = usb.util.find_descriptor(
-                        intf,
-                        # match the first OUT endpoint
-                        custom_match = \
-                        lambda e: \
-                        usb.util.endpoint_direction(e.bEndpointAddress) == \
-                        usb.util.ENDPOINT_OUT)
-        epin = usb.util.find_descriptor(
-                        intf,
-                        # match the first OUT endpoint
-                        custom_match = \
-                        lambda e: \
-                        usb.util.endpoint_direction(e.bEndpointAddress) == \
-                        usb.util.ENDPOINT_IN)
-
-        self.dev.ctrl_transfer(bmRequestType = 0x40,
-                               bRequest = REQ_WRITE_AMLC,
-                               wValue = int(offset / AMLC_AMLS_BLOCK_LENGTH),
-                               wIndex = writeLength - 1,
-                               data_or_wLength = None)
+        epin, epout = self._endpoints()
 
-        while blockCount > 0:
-            remain = writeLength - dataOffset
-            if remain > AMLC_MAX_BLOCK_LENGTH:
-                blockLength = AMLC_MAX_BLOCK_LENGTH
-            else:
-                blockLength = remain
-            epout.write(data[dataOffset:dataOffset+blockLength], 1000)
-            dataOffset = dataOffset + blockLength
-            blockCount = blockCount - 1
+        def request(restart):
+            self._ctrlTransfer(bmRequestType = 0x40,
+                                   bRequest = REQ_WRITE_AMLC,
+                                   wValue = int(offset / AMLC_AMLS_BLOCK_LENGTH),
+                                   wIndex = writeLength - 1,
+                                   data_or_wLength = None)
+
+            self._writeBlocks(epout, view, AMLC_MAX_BLOCK_LENGTH, pad=False,
+                              restart=restart)
+
+        retry_request(request, lambda e: clear_stall(epout, e), writeLength,
+                      kind='write_amlc')
 
         # Wait for Ack
         data = epin.read(16, 1000)
@@ -449,47 +1358,34 @@ class AmlogicSoC(object):
         if not "OKAY" in ''.join(map(chr,data[0:4])):
             raise ValueError('Invalid AMLC Data Write Ack %s' % data)
 
-    def _amlsChecksum(self, data):
-        """Calculate data checksum for AMLS"""
-        checksum = 0
-        offset = 0
-        uint32_max = (1 << 32)
-
-        while offset < len(data):
-            left = len(data) - offset
-            if left >= 4:
-                val = unpack('<I', data[offset:offset+4])[0]
-            elif left >= 3:
-                val = unpack('<I', data[offset:offset+4].ljust(4, b'\x00'))[0] & 0xffffff
-            elif left >= 2:
-                val = unpack('<H', data[offset:offset+2])[0]
-            else:
-                val = unpack('<B', data[offset])[0]
-            offset = offset + 4
-            checksum = (checksum + abs(val)) % uint32_max
-
-        return checksum
-
     def writeAMLCData(self, seq, amlcOffset, data):
-        """Write Request AMLC Data"""
-        dataLen = len(data)
-        transferCount = int(dataLen / AMLC_MAX_TRANSFERT_LENGTH)
-        if dataLen % AMLC_MAX_TRANSFERT_LENGTH > 0:
-            transferCount = transferCount + 1
+        """Write Request AMLC Data
+
+        data can be any object exposing a buffer, it is sliced through a
+        memoryview and never copied as a whole. It can also be a file
+        object or an iterable of chunks, streamed through a ring of
+        AMLC_MAX_TRANSFERT_LENGTH buffers.
+        """
+        if is_buffer(data):
+            view = memoryview(data).cast('B')
+            chunks = (view[offset:offset+AMLC_MAX_TRANSFERT_LENGTH]
+                      for offset in range(0, len(view), AMLC_MAX_TRANSFERT_LENGTH))
+        else:
+            chunks = ChunkRing(data, AMLC_MAX_TRANSFERT_LENGTH)
+        checksum = 0
+        head = b''
         offset = 0
 
-        while transferCount > 0:
-            if (offset + AMLC_MAX_TRANSFERT_LENGTH) > dataLen:
-                writeLength = dataLen - offset
-            else:
-                writeLength = AMLC_MAX_TRANSFERT_LENGTH
-            self._writeAMLCData(offset, data[offset:offset+writeLength])
-            offset = offset + writeLength
-            transferCount = transferCount - 1
+        for chunk in chunks:
+            if not offset:
+                head = bytes(chunk[:512])
+            self._writeAMLCData(offset, chunk)
+            # Chunks are whole words but the last, the sums add up
+            checksum = (checksum + addsum(chunk)) & 0xffffffff
+            offset = offset + len(chunk)
 
         # Write AMLS with checksum over full block, while transferring part of the first 512 bytes
-        checksum = self._amlsChecksum(data)
-        amls = pack('<4sBBBBII', bytes("AMLS", 'ascii'), seq, 0, 0, 0, checksum, 0) + data[16:512]
+        amls = pack('<4sBBBBII', bytes("AMLS", 'ascii'), seq, 0, 0, 0, checksum, 0) + head[16:512]
         self._writeAMLCData(amlcOffset, amls)
 
     @staticmethod
@@ -512,16 +1408,12 @@ class AmlogicSoC(object):
         For that need to use Bulk command 'upload'
         """
         block_length = 0x1000
-        cfg = self.dev.get_active_configuration()
-        intf = cfg[(0, 0)]
-
-        epin = usb.util.find_descriptor(intf,
-                                        custom_match=self._endpoint_match_in)
+        epin, _ = self._endpoints()
 
-        controlData = pack('<IIII', 0, size, 0, 0)
+        controlData = self._packLargeMemHeader(0, size)
         blocks = (block_length + size - 1) // block_length
 
-        self.dev.ctrl_transfer(bmRequestType=0xc0,
+        self._ctrlTransfer(bmRequestType=0xc0,
                                bRequest=REQ_READ_MEDIA,
                                wValue=size,
                                wIndex=blocks,
@@ -538,29 +1430,35 @@ class AmlogicSoC(object):
             - size of data
         For that need to use Bulk command 'download'
         """
-        checksum = self._amlsChecksum(data)
-        cfg = self.dev.get_active_configuration()
-        intf = cfg[(0, 0)]
-
-        epout = usb.util.find_descriptor(intf,
-                                         custom_match=self._endpoint_match_out)
+        checksum = timed_call('checksum', len(data), addsum, data)
+        _, epout = self._endpoints()
 
-        controlData = pack('<IIIIHH', retryTimes, len(data), seq, checksum,
-                           WRITE_MEDIA_CHEKSUM_ALG_ADDSUM, ackLen)
-        controlData = controlData.ljust(0x20, b'\x00')
+        controlData = self._writeMediaHeader
+        WRITE_MEDIA_HEADER.pack_into(controlData, 0, retryTimes, len(data),
+                                     seq, checksum,
+                                     WRITE_MEDIA_CHEKSUM_ALG_ADDSUM, ackLen)
 
-        self.dev.ctrl_transfer(bmRequestType=0x40,
+        self._ctrlTransfer(bmRequestType=0x40,
                                bRequest=REQ_WRITE_MEDIA,
                                wValue=1,
                                wIndex=0xffff,
                                data_or_wLength=controlData)
 
-        nbytes = epout.write(data, 1000)
+        # Views of a mapped image are only copied once, into the bulk buffer
+        block = self._stageBlock(memoryview(data).cast('B'), len(data))
+        try:
+            nbytes = epout.write(block, self.bulkOutTimeout.for_length(len(data)))
+        except usb.core.USBError as e:
+            # The caller resends the block with the same seq
+            if not is_stall(e):
+                raise
+            return False
         return nbytes == len(data)
 
     def devRead(self, size, timeout=None):
         """Read answer from USB"""
-        return self.dev.read(usb.util.ENDPOINT_IN | 1, size, timeout=timeout)
+        epin, _ = self._endpoints()
+        return epin.read(size, timeout=timeout)
 
     def bulkCmd(self, command, read_status=True, timeout=None):
         """Send a textual command
@@ -580,17 +1478,36 @@ class AmlogicSoC(object):
         if len(terminated_cmd) >= 128:
             raise ValueError("Bulk command must be shorter than 127 characters")
 
-        self.dev.ctrl_transfer(bmRequestType = request_type,
+        self._memoryBarrier()
+        self._ctrlTransfer(bmRequestType = request_type,
                                bRequest = REQ_BULKCMD,
                                wValue = 0, # Ignored
                                wIndex = 2, # Ignored
                                data_or_wLength = command + '\0')
 
+        if command.strip() in REENUMERATING_BULKCMDS:
+            # Endpoints resolved so far belong to the old enumeration
+            self._resetSession()
+
         if read_status:
             return self.bulkCmdStat(timeout)
 
+    def uploadMemory(self, address, length, timeout=None):
+        """Read memory through U-Boot's 'upload mem' bulk command"""
+        self.bulkCmd('upload mem 0x%x normal 0x%x' % (address, length),
+                     read_status=False)
+        while True:
+            status = self.bulkCmdStat(timeout).tobytes()
+            if not status.startswith(b'Continue:34'):
+                break
+        if not status.startswith(b'success'):
+            raise IOError('upload mem failed: %s' %
+                          status.rstrip(b'\0').decode(errors='replace'))
+
+        return self.readMedia(length, timeout)
+
     def bulkCmdStat(self, timeout=None):
         """Read bulk command status"""
         BULK_REPLY_LEN = 512
-        return self.dev.read(usb.util.ENDPOINT_IN | 1, BULK_REPLY_LEN,
-                             timeout=timeout)
+        epin, _ = self._endpoints()
+        return epin.read(BULK_REPLY_LEN, timeout=timeout)
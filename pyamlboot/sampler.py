@@ -0,0 +1,161 @@
+# SPDX-License-Identifier: GPL-2.0 OR MIT
+# -*- coding: utf-8 -*-
+"""
+Register sampling
+
+RegisterSampler reads a set of 32-bit registers in as few requests as
+possible: adjacent registers are read together as one span through
+readMemory(), which uses simple or large memory requests depending on
+the span length. Registers a few bytes apart can also be merged, with an
+explicit gap: the words in between are then read too, so only for areas
+without read-to-clear registers. sample_registers() samples them as fast as
+possible or at a fixed rate and streams timestamped samples to a trace
+writer:
+  * CsvTraceWriter: one line per sample, time in ns then hex values
+  * BinaryTraceWriter: a header listing the addresses, then records of
+    a uint64 time in ns followed by the uint32 values, little endian
+"""
+
+import csv
+import logging
+import time
+from collections import namedtuple
+from struct import Struct
+
+__all__ = ['RegisterSampler', 'CsvTraceWriter', 'BinaryTraceWriter',
+           'SampleStats', 'open_trace', 'sample_registers']
+
+TRACE_MAGIC = b'AMLREGS\0'
+TRACE_HEADER = Struct('<8sII')
+TRACE_VERSION = 1
+
+_logger = logging.getLogger(__name__)
+
+SampleStats = namedtuple('SampleStats', 'samples seconds rate dropped')
+
+
+class RegisterSampler:
+    """Reads a fixed set of registers, grouped into spans
+
+    Registers up to gap bytes apart share a span, only adjacent ones by
+    default.
+    """
+
+    def __init__(self, dev, addresses, gap=0):
+        if any(address % 4 for address in addresses):
+            raise ValueError('Register addresses must be 32-bit aligned')
+        if gap < 0 or gap % 4:
+            raise ValueError('Span gap must be a multiple of 4 bytes')
+
+        self._dev = dev
+        self.addresses = list(addresses)
+        self.spans = []
+        for address in sorted(set(self.addresses)):
+            if self.spans and address - self.spans[-1][1] <= gap:
+                self.spans[-1][1] = address + 4
+            else:
+                self.spans.append([address, address + 4])
+
+        # Position of each register in the concatenated spans
+        offsets = {}
+        base = 0
+        for start, end in self.spans:
+            for address in range(start, end, 4):
+                offsets[address] = base + address - start
+            base = base + end - start
+        self._words = Struct('<%dI' % (base // 4))
+        self._index = [offsets[address] // 4 for address in self.addresses]
+
+    def sample(self):
+        """Return the register values, in the order of the addresses"""
+        data = b''.join(bytes(self._dev.readMemory(start, end - start))
+                        for start, end in self.spans)
+        words = self._words.unpack(data)
+        return tuple(words[i] for i in self._index)
+
+
+class CsvTraceWriter:
+    def __init__(self, f, addresses):
+        self._f = f
+        self._writer = csv.writer(f)
+        self._writer.writerow(['t_ns'] + ['0x%08x' % a for a in addresses])
+
+    def write(self, t_ns, values):
+        self._writer.writerow([t_ns] + ['0x%08x' % v for v in values])
+
+    def close(self):
+        self._f.close()
+
+
+class BinaryTraceWriter:
+    def __init__(self, f, addresses):
+        self._f = f
+        self._record = Struct('<Q%dI' % len(addresses))
+        f.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, len(addresses)))
+        f.write(Struct('<%dI' % len(addresses)).pack(*addresses))
+
+    def write(self, t_ns, values):
+        self._f.write(self._record.pack(t_ns, *values))
+
+    def close(self):
+        self._f.close()
+
+
+def open_trace(path, addresses, fmt=None):
+    """Return a trace writer, fmt is 'csv' or 'bin', guessed from path"""
+    if fmt is None:
+        fmt = 'csv' if path.endswith('.csv') else 'bin'
+
+    if fmt == 'csv':
+        return CsvTraceWriter(open(path, 'w', newline=''), addresses)
+    if fmt == 'bin':
+        return BinaryTraceWriter(open(path, 'wb'), addresses)
+
+    raise ValueError('Unknown trace format: {}'.format(fmt))
+
+
+def sample_registers(dev, addresses, writer, duration=None, count=None,
+                     rate=None, gap=0):
+    """Sample registers into writer until duration seconds or count samples
+
+    Without rate, samples are taken back to back. With a rate in Hz, a
+    sample starts at every period: when reading falls behind, the missed
+    periods are skipped and counted as dropped. Samples are timestamped in
+    ns from the start, with the monotonic clock, when their read starts.
+    A KeyboardInterrupt ends the sampling like the end of duration. gap is
+    passed to RegisterSampler.
+    """
+    sampler = RegisterSampler(dev, addresses, gap)
+    period = int(1e9 / rate) if rate else 0
+    start = time.monotonic_ns()
+    end = start + int(duration * 1e9) if duration is not None else None
+    samples = 0
+    dropped = 0
+    slot = start
+
+    _logger.info('Sampling %d registers in %d spans', len(sampler.addresses),
+                 len(sampler.spans))
+
+    try:
+        while count is None or samples < count:
+            now = time.monotonic_ns()
+            if period:
+                if now < slot:
+                    time.sleep((slot - now) / 1e9)
+                    now = time.monotonic_ns()
+                elif now - slot >= period:
+                    missed = (now - slot) // period
+                    dropped = dropped + missed
+                    slot = slot + missed * period
+            if end is not None and now >= end:
+                break
+
+            writer.write(now - start, sampler.sample())
+            samples = samples + 1
+            slot = slot + period
+    except KeyboardInterrupt:
+        pass
+
+    seconds = (time.monotonic_ns() - start) / 1e9
+    return SampleStats(samples, seconds,
+                       samples / seconds if seconds else 0.0, dropped)
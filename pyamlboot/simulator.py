@@ -0,0 +1,938 @@
+# SPDX-License-Identifier: GPL-2.0 OR MIT
+# -*- coding: utf-8 -*-
+"""
+In-process Amlogic USB device simulator
+
+SimulatorBackend is a pyusb backend exposing one or more SimulatedDevice
+boards, so the host side can be exercised and profiled without hardware:
+
+    backend = SimulatorBackend(SimulatedDevice(bandwidth=40 << 20))
+    dev = pyamlboot.AmlogicSoC(usb_backend=backend)
+
+A SimulatedDevice speaks, depending on its protocol:
+  * 'optimus' (c003): the ROM requests of PROTOCOL.md (memory access,
+    large memory transfers, identify, run, password, AMLC/AMLS) and, once
+    U-Boot was started through a 0xc0e1 BL2 parameter block, the Optimus
+    TPL requests (TPL commands, bulk commands, writeMedia, readMedia)
+  * 'adnl' (c004): the ADNL ROM, BL2 (CBW) and TPL (mwrite) exchanges
+
+Stage changes make the device leave the bus and come back later with a
+new address, as real boards do. Every transfer costs `latency` seconds
+plus its length over `bandwidth` bytes per second, and a FaultInjector
+can make bulk transfers time out, corrupt their payload or have the
+device report itself busy.
+
+Received partitions are checked against their addsum and SHA1 but not
+stored, device RAM is kept in sparse pages. With verify=False the device
+skips its own checksums and with keep_memory=False it drops bulk memory
+writes, keeping it out of host CPU and memory measurements.
+"""
+
+import collections
+import errno
+import hashlib
+import random
+import threading
+import time
+import types
+from struct import Struct, pack, unpack_from
+
+import usb.backend
+import usb.core
+
+from .checksum import addsum
+from .hotplug import get_watcher
+from .stages import PARA_DONE_MAGIC
+from .topology import AMLOGIC_VENDOR_ID
+
+__all__ = ['SimulatorBackend', 'SimulatedDevice', 'FaultInjector',
+           'for_image']
+
+OPTIMUS_PRODUCT_ID = 0xc003
+ADNL_PRODUCT_ID = 0xc004
+
+STAGE_IPL = 0
+STAGE_SPL = 8
+STAGE_TPL = 16
+
+BULK_OUT_ENDPOINT = 0x01
+BULK_IN_ENDPOINT = 0x82
+BULK_MAX_PACKET = 512
+
+# ROM and Optimus requests, see pyamlboot.pyamlboot
+REQ_WRITE_MEM = 0x01
+REQ_READ_MEM = 0x02
+REQ_FILL_MEM = 0x03
+REQ_MODIFY_MEM = 0x04
+REQ_RUN_IN_ADDR = 0x05
+REQ_WR_LARGE_MEM = 0x11
+REQ_RD_LARGE_MEM = 0x12
+REQ_IDENTIFY_HOST = 0x20
+REQ_TPL_CMD = 0x30
+REQ_TPL_STAT = 0x31
+REQ_WRITE_MEDIA = 0x32
+REQ_READ_MEDIA = 0x33
+REQ_BULKCMD = 0x34
+REQ_PASSWORD = 0x35
+REQ_NOP = 0x36
+REQ_GET_AMLC = 0x50
+REQ_WRITE_AMLC = 0x60
+
+WRITE_MEDIA_CHEKSUM_ALG_ADDSUM = 0x00ef
+
+# BL2 parameter block magics and commands, see pyamlboot.optimus
+PARA_MAGIC = 0x3412cdab
+PARA_CMD_RUN_UBOOT = 0xc0e1
+
+LARGE_MEM_HEADER = Struct('<II')
+WRITE_MEDIA_HEADER = Struct('<IIIIHH')
+
+AMLC_REQUEST_LENGTH = 0x200
+AMLC_CHUNK_LENGTH = 0x100000
+ADNL_DOWNLOAD_SIZE = 0x10000
+ADNL_CBW_LENGTH = 0x10000
+ADNL_DATAOUT_LENGTH = 0x100000
+
+FAULT_KINDS = ('timeout', 'corrupt', 'busy')
+
+# Transfers shorter than this are accounted for, slept off later
+SLEEP_GRANULARITY = 0.001
+
+LIBUSB_ERROR_TIMEOUT = -7
+LIBUSB_ERROR_PIPE = -9
+LIBUSB_ERROR_NO_DEVICE = -4
+
+_SocProfile = collections.namedtuple('_SocProfile',
+                                     'rom_version amlc family')
+
+SOC_PROFILES = {
+    # Optimus boards, G12 and later load U-Boot through AMLC requests
+    'gxl': _SocProfile((0, 9), False, 0),
+    'axg': _SocProfile((0, 10), False, 0),
+    'g12': _SocProfile((0, 11), True, 0),
+    # ADNL boards, family as in chipinfo page 1
+    'a1': _SocProfile((0, 0), False, 0x2c),
+    'c1': _SocProfile((0, 0), False, 0x30),
+    'c2': _SocProfile((0, 0), False, 0x33),
+}
+
+
+def _no_device():
+    return usb.core.USBError('No such device (it may have been disconnected)',
+                             LIBUSB_ERROR_NO_DEVICE, errno.ENODEV)
+
+
+def _stall():
+    return usb.core.USBError('Pipe error', LIBUSB_ERROR_PIPE, errno.EPIPE)
+
+
+def _timeout():
+    return usb.core.USBTimeoutError('Operation timed out',
+                                    LIBUSB_ERROR_TIMEOUT, errno.ETIMEDOUT)
+
+
+def _string(data):
+    return bytes(data).split(b'\0', 1)[0].decode(errors='replace').strip()
+
+
+class FaultInjector:
+    """Randomly injects faults into bulk transfers
+
+    Each opportunity for a fault of one of `kinds` triggers it with
+    probability `rate`:
+      * timeout: the bulk transfer fails after its timeout, its data lost
+      * corrupt: one byte of a bulk OUT data payload is flipped
+      * busy: the device first answers a status request as busy
+    """
+
+    def __init__(self, rate=0.0, kinds=FAULT_KINDS, seed=None):
+        unknown = set(kinds) - set(FAULT_KINDS)
+        if unknown:
+            raise ValueError(f'Unknown fault kinds: {", ".join(unknown)}')
+
+        self.rate = rate
+        self.kinds = frozenset(kinds)
+        self.injected = collections.Counter()
+        self._random = random.Random(seed)
+
+    def draw(self, kind):
+        """Return True if a fault of kind must be injected now"""
+        if kind not in self.kinds or self._random.random() >= self.rate:
+            return False
+
+        self.injected[kind] += 1
+        return True
+
+    def corrupt(self, data):
+        """Return a copy of data with one byte flipped"""
+        data = bytearray(data)
+        if data:
+            data[self._random.randrange(len(data))] ^= 0xff
+        return data
+
+
+class _Link:
+    """Serializes transfer costs on a simulated wire"""
+
+    def __init__(self, bandwidth, latency):
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self._busy_until = 0.0
+
+    def transfer(self, nbytes):
+        cost = self.latency
+        if self.bandwidth:
+            cost += nbytes / self.bandwidth
+        if not cost:
+            return
+
+        now = time.perf_counter()
+        self._busy_until = max(self._busy_until, now) + cost
+        delay = self._busy_until - now
+        if delay >= SLEEP_GRANULARITY:
+            time.sleep(delay)
+
+
+class _Memory:
+    """Sparse device address space, zero filled"""
+
+    PAGE_SIZE = 0x10000
+
+    def __init__(self):
+        self._pages = {}
+
+    def write(self, address, data):
+        view = memoryview(data).cast('B')
+        offset = 0
+        while offset < len(view):
+            page, start = divmod(address + offset, self.PAGE_SIZE)
+            length = min(len(view) - offset, self.PAGE_SIZE - start)
+            buf = self._pages.get(page)
+            if buf is None:
+                buf = self._pages[page] = bytearray(self.PAGE_SIZE)
+            buf[start:start+length] = view[offset:offset+length]
+            offset += length
+
+    def read(self, address, length):
+        data = bytearray(length)
+        offset = 0
+        while offset < length:
+            page, start = divmod(address + offset, self.PAGE_SIZE)
+            chunk = min(length - offset, self.PAGE_SIZE - start)
+            buf = self._pages.get(page)
+            if buf is not None:
+                data[offset:offset+chunk] = buf[start:start+chunk]
+            offset += chunk
+        return data
+
+    def read_word(self, address):
+        return int.from_bytes(self.read(address, 4), 'little')
+
+    def write_word(self, address, value):
+        self.write(address, (value & 0xffffffff).to_bytes(4, 'little'))
+
+
+class _Partition:
+    """Download target, tracking received length, addsums and SHA1"""
+
+    def __init__(self, name, size, verify):
+        self.name = name
+        self.size = size
+        self.received = 0
+        self._sha1 = hashlib.sha1() if verify else None
+
+    def add(self, data):
+        if self._sha1 is not None:
+            self._sha1.update(data)
+        self.received += len(data)
+
+    def complete(self):
+        return self.received >= self.size
+
+    def check(self, digest):
+        if self._sha1 is None:
+            return True
+        return self.complete() and self._sha1.hexdigest() == digest.lower()
+
+
+class SimulatedDevice:
+    """One simulated Amlogic board
+
+    protocol is 'optimus' or 'adnl', soc a key of SOC_PROFILES and stage
+    the boot stage it starts in (STAGE_IPL or STAGE_TPL). port is the USB
+    port path it is attached to. bandwidth is in bytes per second, None
+    meaning unlimited, latency in seconds per transfer. tpl_size is the
+    length of the U-Boot image BL2 requests from the host, over AMLC or
+    CBW. reenumerate_delay is how long the board stays off the bus on a
+    stage change. keep_memory=False drops the data of large memory writes,
+    BL2 parameter blocks included.
+    """
+
+    def __init__(self, protocol='optimus', soc=None, stage=STAGE_IPL,
+                 port='1-1', bandwidth=None, latency=0.0, faults=None,
+                 tpl_size=0x100000, verify=True, keep_memory=True,
+                 password=None, reenumerate_delay=0.1,
+                 serial='1234567890ABCDEF'):
+        if protocol not in ('optimus', 'adnl'):
+            raise ValueError(f'Unknown protocol {protocol}')
+        if soc is None:
+            soc = 'gxl' if protocol == 'optimus' else 'a1'
+
+        self.protocol = protocol
+        self.profile = SOC_PROFILES[soc]
+        self.idProduct = (OPTIMUS_PRODUCT_ID if protocol == 'optimus'
+                          else ADNL_PRODUCT_ID)
+        bus, ports = port.split('-', 1)
+        self.bus = int(bus)
+        self.port_numbers = tuple(int(p) for p in ports.split('.'))
+        self.port = port
+        self.link = _Link(bandwidth, latency)
+        self.faults = faults or FaultInjector()
+        self.tpl_size = tpl_size
+        self.verify = verify
+        self.keep_memory = keep_memory
+        self.password = password
+        self.reenumerate_delay = reenumerate_delay
+        self.serial = serial
+
+        self.memory = _Memory()
+        self.address = 1
+        self.generation = 0
+        self.attached = True
+        self._present_at = 0.0
+        self._enter_stage(stage)
+
+    # Bus presence
+
+    def present(self):
+        return self.attached and time.monotonic() >= self._present_at
+
+    def _enter_stage(self, stage, stage_major=0):
+        """Reset the protocol state for a fresh enumeration in stage"""
+        self.stage = stage
+        self.stage_major = stage_major
+        self.password_ok = self.password is None
+        self._replies = collections.deque()
+        self._sink = None
+        self._status = b'success'
+        self._partition = None
+        self._media_seq = 0
+        self._upload = b''
+        self._paras = set()
+        self._amlc_requests = None
+        self._amlc_chunk = None
+        self._cbw_offset = 0
+        self._cbw_seq = 0
+        self._cbw_size = 0
+        self._cbw_sum = 0
+
+    def reenumerate(self, stage):
+        """Drop off the bus and come back in stage with a new address"""
+        self.generation += 1
+        self.address = self.address % 127 + 1
+        self._present_at = time.monotonic() + self.reenumerate_delay
+        self._enter_stage(stage)
+
+        timer = threading.Timer(self.reenumerate_delay, self._notify_arrival)
+        timer.daemon = True
+        timer.start()
+
+    @staticmethod
+    def _notify_arrival():
+        # Nobody waits for the board unless the watcher was started
+        watcher = get_watcher(start=False)
+        if watcher is not None:
+            watcher.notify()
+
+    def detach(self):
+        """Leave the bus for good, like a board booting its firmware"""
+        self.generation += 1
+        self.attached = False
+
+    # Transfers, called by SimulatorBackend
+
+    def control(self, bmRequestType, bRequest, wValue, wIndex, data):
+        """Handle a control transfer, returns the IN payload or None"""
+        self.link.transfer(len(data))
+
+        if self.protocol == 'adnl':
+            raise _stall()
+
+        handler = self._CONTROL.get(bRequest)
+        if handler is None or (bRequest in self._TPL_REQUESTS and
+                               self.stage != STAGE_TPL):
+            raise _stall()
+
+        return handler(self, wValue, wIndex, data)
+
+    def bulk_out(self, data, timeout):
+        self.link.transfer(len(data))
+
+        if self.faults.draw('timeout'):
+            time.sleep(timeout / 1000)
+            raise _timeout()
+
+        if self._sink is not None:
+            self._sink(data)
+        elif self.protocol == 'adnl':
+            self._adnl_command(_string(data))
+        else:
+            # Optimus only sends data the device asked for
+            raise _stall()
+
+    def reset_out(self):
+        """Drop the bulk OUT data still expected, on an endpoint reset"""
+        self._sink = None
+
+    def bulk_in(self, length, timeout):
+        if not self._replies or self.faults.draw('timeout'):
+            time.sleep(timeout / 1000)
+            raise _timeout()
+
+        reply = self._replies[0]
+        if callable(reply):
+            reply = reply(length)
+        else:
+            self._replies.popleft()
+        reply = reply[:length]
+
+        self.link.transfer(len(reply))
+        return reply
+
+    def _reply(self, data, busy=None, then=None):
+        """Queue a bulk IN reply
+
+        With busy, the reply may be preceded by that busy status. then()
+        is called once the reply was read, for stage changes.
+        """
+        if busy is not None and self.faults.draw('busy'):
+            self._replies.append(busy)
+
+        data = bytes(data)
+        if then is None:
+            self._replies.append(data)
+            return
+
+        def reply(length):
+            self._replies.popleft()
+            then()
+            return data
+
+        self._replies.append(reply)
+
+    def _expect(self, length, done, block=None):
+        """Route the next length bytes of bulk OUT data to done(data)
+
+        block(offset, data), if given, is called with each transfer as it
+        arrives, for requests the device processes block by block.
+        """
+        received = bytearray()
+
+        def sink(data):
+            if self.faults.draw('corrupt'):
+                data = self.faults.corrupt(data)
+            if block is not None:
+                block(len(received), data)
+            received.extend(data)
+            if len(received) >= length:
+                self._sink = None
+                done(received)
+
+        self._sink = sink
+
+    # ROM requests
+
+    def _identify(self, wValue, wIndex, data):
+        major, minor = self.profile.rom_version
+        return bytes([major, minor, self.stage_major, self.stage,
+                      self.password is not None, self.password_ok, 0, 0])
+
+    def _write_mem(self, wValue, wIndex, data):
+        self.memory.write(wValue << 16 | wIndex, data)
+
+    def _read_mem(self, wValue, wIndex, data):
+        return self.memory.read(wValue << 16 | wIndex, len(data))
+
+    def _fill_mem(self, wValue, wIndex, data):
+        for address, value in Struct('<II').iter_unpack(bytes(data)):
+            self.memory.write_word(address, value)
+
+    def _modify_mem(self, wValue, wIndex, data):
+        address1, value, mask, address2 = unpack_from('<IIII', data)
+        mem = self.memory
+        if wValue == 0:
+            mem.write_word(address1, value)
+        elif wValue == 1:
+            mem.write_word(address1, mem.read_word(address1) & mask)
+        elif wValue == 2:
+            mem.write_word(address1, mem.read_word(address1) | mask)
+        elif wValue == 3:
+            mem.write_word(address1, mem.read_word(address1) & ~mask)
+        elif wValue == 4:
+            mem.write_word(address1, (mem.read_word(address1) & ~mask) |
+                           (value & mask))
+        elif wValue == 5:
+            mem.write_word(address1, mem.read_word(address2))
+        elif wValue == 6:
+            mem.write_word(address1, mem.read_word(address2) & mask)
+        elif wValue == 7:
+            # memcpy of value words from address1 to address2
+            mem.write(address2, mem.read(address1, value * 4))
+        else:
+            raise _stall()
+
+    def _run(self, wValue, wIndex, data):
+        # BL2 processes the parameter blocks it was given
+        for address in sorted(self._paras):
+            if self.memory.read_word(address) != PARA_MAGIC:
+                continue
+            if self.memory.read_word(address + 8) == PARA_CMD_RUN_UBOOT:
+                self.reenumerate(STAGE_TPL)
+                return
+            self.memory.write_word(address, PARA_DONE_MAGIC)
+
+        if self.profile.amlc and self.stage == STAGE_IPL:
+            self.stage, self.stage_major = STAGE_SPL, 1
+            self._amlc_requests = collections.deque(
+                (min(AMLC_CHUNK_LENGTH, self.tpl_size - offset), offset)
+                for offset in range(0x10000, self.tpl_size, AMLC_CHUNK_LENGTH))
+
+    def _large_mem_header(self, wValue, wIndex, data):
+        address, length = LARGE_MEM_HEADER.unpack_from(data)
+        if wValue * wIndex < length:
+            raise _stall()
+        return address, length
+
+    def _wr_large_mem(self, wValue, wIndex, data):
+        address, length = self._large_mem_header(wValue, wIndex, data)
+
+        def block(offset, data):
+            # Blocks land in memory as they arrive, even when the request
+            # is abandoned for a new one
+            if self.keep_memory and offset < length:
+                self.memory.write(address + offset, data[:length - offset])
+
+        def done(received):
+            if (self.keep_memory and length >= 4 and
+                    unpack_from('<I', received)[0] == PARA_MAGIC):
+                self._paras.add(address)
+
+        self._expect(length, done, block)
+
+    def _rd_large_mem(self, wValue, wIndex, data):
+        address, length = self._large_mem_header(wValue, wIndex, data)
+        blocks = collections.deque(range(wIndex))
+        # A new request abandons the blocks left of the previous one
+        while self._replies and getattr(self._replies[0], 'large_read', False):
+            self._replies.popleft()
+
+        def block(size):
+            offset = blocks.popleft() * wValue
+            if not blocks:
+                self._replies.popleft()
+            return self.memory.read(address + offset, wValue)
+
+        block.large_read = True
+        self._replies.append(block)
+
+    def _password(self, wValue, wIndex, data):
+        self.password_ok = bytes(data) == self.password
+
+    def _nop(self, wValue, wIndex, data):
+        pass
+
+    def _get_amlc(self, wValue, wIndex, data):
+        if not self._amlc_requests:
+            raise _stall()
+
+        length, offset = self._amlc_requests[0]
+        self._reply(pack('<4s4xII', b'AMLC', length, offset).ljust(
+            AMLC_REQUEST_LENGTH, b'\0'))
+
+        # The last request is repeated once everything was loaded, BL2
+        # then starts U-Boot as soon as the host acked it
+        if self._amlc_chunk == (length, offset, None):
+            self._expect(16, lambda ack: self.reenumerate(STAGE_TPL))
+            return
+
+        if len(self._amlc_requests) > 1:
+            self._amlc_requests.popleft()
+        self._amlc_chunk = (length, offset, bytearray())
+        self._expect(16, lambda ack: None)
+
+    def _write_amlc(self, wValue, wIndex, data):
+        if self._amlc_chunk is None:
+            raise _stall()
+
+        def done(received):
+            length, offset, chunk = self._amlc_chunk
+            if received[:4] != b'AMLS':
+                if self.verify:
+                    chunk.extend(received)
+                self._reply(b'OKAY'.ljust(16, b'\0'))
+                return
+
+            # AMLS carries the addsum of the whole chunk
+            checksum = unpack_from('<I', received, 8)[0]
+            ok = not self.verify or addsum(chunk) == checksum
+            self._amlc_chunk = (length, offset, None)
+            self._reply((b'OKAY' if ok else b'FAIL').ljust(16, b'\0'))
+
+        self._expect(wIndex + 1, done)
+
+    # Optimus TPL requests
+
+    def _tpl_cmd(self, wValue, wIndex, data):
+        cmd = _string(data).split()
+        self._status = b'success'
+        if cmd[:1] == ['download'] and len(cmd) == 5:
+            self._partition = _Partition(cmd[2], int(cmd[4], 0), self.verify)
+            self._media_seq = 0
+
+    def _tpl_stat(self, wValue, wIndex, data):
+        return self._status
+
+    def _bulkcmd(self, wValue, wIndex, data):
+        cmd = _string(data)
+        args = cmd.split()
+        status = b'success'
+
+        if cmd == 'bootloader_is_old':
+            status = b'failed'
+        elif cmd == 'download get_status':
+            if self._partition is None or not self._partition.complete():
+                status = b'failed'
+        elif args[:1] == ['verify'] and len(args) == 3:
+            if self._partition is None or not self._partition.check(args[2]):
+                status = b'failed'
+        elif args[:2] == ['upload', 'mem'] and len(args) == 5:
+            self._upload = self.memory.read(int(args[2], 0), int(args[4], 0))
+        elif cmd in ('reset', 'reboot-romusb'):
+            self._reply(status, then=lambda: self.reenumerate(STAGE_IPL))
+            return
+        elif cmd == 'reboot':
+            self._reply(status, then=self.detach)
+            return
+
+        self._reply(status, busy=b'Continue:34')
+
+    def _write_media(self, wValue, wIndex, data):
+        _, length, seq, checksum, alg, ack_len = \
+            WRITE_MEDIA_HEADER.unpack_from(data)
+
+        def done(received):
+            partition = self._partition
+            ok = partition is not None and seq in (self._media_seq,
+                                                   self._media_seq - 1)
+            if ok and self.verify and alg == WRITE_MEDIA_CHEKSUM_ALG_ADDSUM:
+                ok = addsum(received) == checksum
+            # A retried block whose ack was lost is acked again only
+            if ok and seq == self._media_seq:
+                partition.add(received)
+                self._media_seq += 1
+
+            self._reply(b'OK!!' if ok else b'ERR!', busy=b'Continue:32')
+
+        self._expect(length, done)
+
+    def _read_media(self, wValue, wIndex, data):
+        self._reply(self._upload)
+        return b''
+
+    _CONTROL = {
+        REQ_WRITE_MEM: _write_mem,
+        REQ_READ_MEM: _read_mem,
+        REQ_FILL_MEM: _fill_mem,
+        REQ_MODIFY_MEM: _modify_mem,
+        REQ_RUN_IN_ADDR: _run,
+        REQ_WR_LARGE_MEM: _wr_large_mem,
+        REQ_RD_LARGE_MEM: _rd_large_mem,
+        REQ_IDENTIFY_HOST: _identify,
+        REQ_TPL_CMD: _tpl_cmd,
+        REQ_TPL_STAT: _tpl_stat,
+        REQ_WRITE_MEDIA: _write_media,
+        REQ_READ_MEDIA: _read_media,
+        REQ_BULKCMD: _bulkcmd,
+        REQ_PASSWORD: _password,
+        REQ_NOP: _nop,
+        REQ_GET_AMLC: _get_amlc,
+        REQ_WRITE_AMLC: _write_amlc,
+    }
+
+    _TPL_REQUESTS = (REQ_TPL_CMD, REQ_TPL_STAT, REQ_WRITE_MEDIA,
+                     REQ_READ_MEDIA, REQ_BULKCMD)
+
+    # ADNL
+
+    def _adnl_okay(self, payload=b'', then=None):
+        self._reply(b'OKAY' + payload, then=then)
+
+    def _adnl_data(self, length, done):
+        self._reply(b'DATA')
+        self._expect(length, done)
+
+    def _adnl_chipinfo(self, page):
+        info = bytearray(64)
+        info[:4] = (b'INDX', b'CHIP', b'OTPS', b'ROMV')[page % 4]
+        if page == 1:
+            info[4:8] = self.profile.family.to_bytes(4, 'little')
+        return info
+
+    def _adnl_command(self, cmd):
+        if cmd == 'getvar:identify':
+            self._adnl_okay(bytes([5, 0, 0, self.stage, 0, 0, 0, 0]))
+        elif cmd == 'getvar:serialno':
+            self._adnl_okay(self.serial.encode())
+        elif cmd.startswith('getvar:getchipinfo-'):
+            self._adnl_okay(self._adnl_chipinfo(int(cmd[19:])))
+        elif cmd == 'getvar:downloadsize':
+            self._adnl_okay(f'0x{ADNL_DOWNLOAD_SIZE:x}\0'.encode())
+        elif cmd == 'setvar:burnsteps':
+            self._adnl_data(4, lambda data: self._adnl_okay())
+        elif cmd.startswith('download:'):
+            self._adnl_download(int(cmd[9:], 16))
+        elif cmd == 'boot' and self.stage == STAGE_IPL:
+            self.stage = STAGE_SPL
+            self._adnl_okay()
+        elif cmd == 'getvar:cbw' and self.stage == STAGE_SPL:
+            self._adnl_cbw()
+        elif cmd == 'setvar:checksum' and self.stage == STAGE_SPL:
+            self._adnl_data(4, self._adnl_cbw_checksum)
+        elif cmd.startswith('oem setvar burnsteps') or \
+                cmd.startswith('oem disk_initial'):
+            self._adnl_okay()
+        elif cmd.startswith('oem mwrite'):
+            size, _, _, name = cmd.split()[2:6]
+            self._partition = _Partition(name, int(size, 0), self.verify)
+            self._adnl_okay()
+        elif cmd == 'mwrite:verify=addsum' and self._partition is not None:
+            self._adnl_dataout()
+        elif cmd.startswith('oem verify sha1sum '):
+            ok = (self._partition is not None and
+                  self._partition.check(cmd.split()[3]))
+            self._reply(b'OKAY' if ok else b'FAIL', busy=b'INFO')
+        elif cmd == 'reboot-romusb' and self.stage == STAGE_TPL:
+            self._adnl_okay(then=lambda: self.reenumerate(STAGE_IPL))
+        elif cmd == 'reboot':
+            self._adnl_okay(then=self.detach)
+        else:
+            self._reply(b'FAIL' + f'unknown command {cmd}'.encode())
+
+    def _adnl_download(self, length):
+        def done(data):
+            if self.stage == STAGE_SPL and self._cbw_offset < self.tpl_size:
+                self._cbw_sum += addsum(data) if self.verify else 0
+            self._adnl_okay()
+
+        # The ROM takes the whole BL2 image in a single transfer
+        if self.stage == STAGE_IPL:
+            length = 1
+        self._adnl_data(length, done)
+
+    def _adnl_cbw(self):
+        if self._cbw_offset >= self.tpl_size:
+            cbw = pack('<4sIIIBB', b'AMLC', self._cbw_seq, 0, 0, 0, 1)
+            self._adnl_okay(cbw, then=lambda: self.reenumerate(STAGE_TPL))
+            return
+
+        size = min(ADNL_CBW_LENGTH, self.tpl_size - self._cbw_offset)
+        cbw = pack('<4sIIIBB', b'AMLC', self._cbw_seq, size,
+                   self._cbw_offset, 0, 0)
+        self._cbw_size = size
+        self._cbw_sum = 0
+        self._adnl_okay(cbw)
+
+    def _adnl_cbw_checksum(self, data):
+        checksum = int.from_bytes(data[:4], 'little')
+        if self.verify and checksum != self._cbw_sum & 0xffffffff:
+            self._reply(b'FAIL')
+            return
+
+        self._cbw_offset += self._cbw_size
+        self._cbw_seq += 1
+        self._adnl_okay()
+
+    def _adnl_dataout(self):
+        partition = self._partition
+        if partition.complete():
+            self._adnl_okay()
+            return
+
+        size = min(ADNL_DATAOUT_LENGTH, partition.size - partition.received)
+
+        def checksum(data, chunk):
+            if (self.verify and
+                    int.from_bytes(data[:4], 'little') != addsum(chunk)):
+                self._reply(b'FAIL')
+                return
+
+            partition.add(chunk)
+            self._adnl_okay()
+
+        def received(chunk):
+            # The chunk is followed by its 4 bytes addsum
+            self._expect(4, lambda data: checksum(data, chunk))
+
+        self._reply(f'DATAOUT{size:x}:{partition.received:x}'.encode())
+        self._expect(size, received)
+
+
+class _Enumeration:
+    """A device as listed by one bus enumeration"""
+
+    def __init__(self, device):
+        self.device = device
+        self.generation = device.generation
+        self.address = device.address
+
+
+class _Handle:
+    def __init__(self, enumeration):
+        self.device = enumeration.device
+        self.generation = enumeration.generation
+
+    def check(self):
+        device = self.device
+        if device.generation != self.generation or not device.present():
+            raise _no_device()
+        return device
+
+
+class SimulatorBackend(usb.backend.IBackend):
+    """pyusb backend over a set of SimulatedDevice"""
+
+    def __init__(self, *devices):
+        usb.backend.IBackend.__init__(self)
+        self.devices = list(devices) or [SimulatedDevice()]
+
+    def enumerate_devices(self):
+        return [_Enumeration(d) for d in self.devices if d.present()]
+
+    def get_parent(self, dev):
+        return None
+
+    def get_device_descriptor(self, dev):
+        device = dev.device
+        return types.SimpleNamespace(
+            bLength=18, bDescriptorType=1, bcdUSB=0x0200, bDeviceClass=0,
+            bDeviceSubClass=0, bDeviceProtocol=0, bMaxPacketSize0=64,
+            idVendor=AMLOGIC_VENDOR_ID, idProduct=device.idProduct,
+            bcdDevice=0x0007, iManufacturer=0, iProduct=0, iSerialNumber=0,
+            bNumConfigurations=1, address=dev.address, bus=device.bus,
+            port_number=device.port_numbers[-1],
+            port_numbers=device.port_numbers, speed=3)
+
+    def get_configuration_descriptor(self, dev, config):
+        if config != 0:
+            raise IndexError('Invalid configuration index ' + str(config))
+
+        return types.SimpleNamespace(
+            bLength=9, bDescriptorType=2, wTotalLength=32, bNumInterfaces=1,
+            bConfigurationValue=1, iConfiguration=0, bmAttributes=0x80,
+            bMaxPower=250, extra_descriptors=[])
+
+    def get_interface_descriptor(self, dev, intf, alt, config):
+        if (config, intf, alt) != (0, 0, 0):
+            raise IndexError('Invalid interface index ' + str(intf))
+
+        return types.SimpleNamespace(
+            bLength=9, bDescriptorType=4, bInterfaceNumber=0,
+            bAlternateSetting=0, bNumEndpoints=2, bInterfaceClass=0xff,
+            bInterfaceSubClass=0, bInterfaceProtocol=0, iInterface=0,
+            extra_descriptors=[])
+
+    def get_endpoint_descriptor(self, dev, ep, intf, alt, config):
+        if (config, intf, alt) != (0, 0, 0) or ep not in (0, 1):
+            raise IndexError('Invalid endpoint index ' + str(ep))
+
+        return types.SimpleNamespace(
+            bLength=7, bDescriptorType=5,
+            bEndpointAddress=(BULK_OUT_ENDPOINT, BULK_IN_ENDPOINT)[ep],
+            bmAttributes=2, wMaxPacketSize=BULK_MAX_PACKET, bInterval=0,
+            bRefresh=0, bSynchAddress=0, extra_descriptors=[])
+
+    def open_device(self, dev):
+        handle = _Handle(dev)
+        handle.check()
+        return handle
+
+    def close_device(self, dev_handle):
+        pass
+
+    def set_configuration(self, dev_handle, config_value):
+        dev_handle.check()
+
+    def get_configuration(self, dev_handle):
+        dev_handle.check()
+        return 1
+
+    def set_interface_altsetting(self, dev_handle, intf, altsetting):
+        dev_handle.check()
+
+    def claim_interface(self, dev_handle, intf):
+        dev_handle.check()
+
+    def release_interface(self, dev_handle, intf):
+        pass
+
+    def bulk_write(self, dev_handle, ep, intf, data, timeout):
+        dev_handle.check().bulk_out(data, timeout)
+        return len(data)
+
+    def bulk_read(self, dev_handle, ep, intf, buff, timeout):
+        data = dev_handle.check().bulk_in(len(buff), timeout)
+        memoryview(buff).cast('B')[:len(data)] = data
+        return len(data)
+
+    def ctrl_transfer(self, dev_handle, bmRequestType, bRequest, wValue,
+                      wIndex, data, timeout):
+        device = dev_handle.check()
+        ret = device.control(bmRequestType, bRequest, wValue, wIndex, data)
+
+        if bmRequestType & 0x80 == 0:
+            return len(data)
+
+        ret = ret or b''
+        length = min(len(ret), len(data))
+        memoryview(data).cast('B')[:length] = memoryview(ret)[:length]
+        return length
+
+    def clear_halt(self, dev_handle, ep):
+        device = dev_handle.check()
+        if not ep & 0x80:
+            device.reset_out()
+
+    def reset_device(self, dev_handle):
+        dev_handle.check()
+
+    def is_kernel_driver_active(self, dev_handle, intf):
+        return False
+
+    def detach_kernel_driver(self, dev_handle, intf):
+        pass
+
+    def attach_kernel_driver(self, dev_handle, intf):
+        pass
+
+
+def for_image(aml_img, count=1, **kwargs):
+    """Return a SimulatorBackend of count boards able to burn aml_img
+
+    The protocol and the U-Boot length BL2 requests are taken from the
+    image, boards are attached on ports 1-1, 1-2... Other arguments are
+    passed to SimulatedDevice.
+    """
+    try:
+        aml_img.item_get('aml', 'usb_flow')
+    except ValueError:
+        kwargs.setdefault('protocol', 'optimus')
+    else:
+        kwargs.setdefault('protocol', 'adnl')
+
+    try:
+        kwargs.setdefault('tpl_size', aml_img.item_get('USB', 'UBOOT').size())
+    except ValueError:
+        pass
+
+    return SimulatorBackend(*(SimulatedDevice(port=f'1-{i + 1}', **kwargs)
+                              for i in range(count)))
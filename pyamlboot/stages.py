@@ -0,0 +1,123 @@
+# SPDX-License-Identifier: GPL-2.0 OR MIT
+# -*- coding: utf-8 -*-
+"""
+Boot stage transitions
+
+A board in USB boot mode answers in one of three stages: the ROM, BL2
+(SPL) or U-Boot (TPL), reported by identify() and by the ADNL identify
+reply. Running code makes it move between them, or keep its stage while
+BL2 processes a parameter block, after a delay depending on the SoC, the
+DRAM and the firmware.
+
+Instead of sleeping for the worst case delay, wait_stage() polls the
+board with a growing interval until it is observed in the expected
+state, and gives up at a deadline. While the board runs code it may not
+answer at all: USB errors and short reads only count as not ready yet.
+"""
+
+import logging
+import time
+from enum import IntEnum
+from types import DynamicClassAttribute
+
+import usb.core
+
+from .pyamlboot import ShortReadError
+from .socid import SocId
+
+__all__ = ['PARA_DONE_MAGIC', 'Stage', 'StageTimeout', 'stage_of', 'in_stage',
+           'wait_stage']
+
+# Written by BL2 over its parameter block once it processed it
+PARA_DONE_MAGIC = 0x7856efab
+
+# Polling interval bounds, in seconds
+POLL_MIN_INTERVAL = 0.01
+POLL_MAX_INTERVAL = 0.1
+
+_logger = logging.getLogger(__name__)
+
+
+class Stage(IntEnum):
+    """
+    Enum with boot stages of Amlogic SoC.
+    """
+    ROM = SocId.STAGE_MINOR_IPL
+    SPL = SocId.STAGE_MINOR_SPL
+    TPL = SocId.STAGE_MINOR_TPL
+
+    @DynamicClassAttribute
+    def name(self):
+        """
+        Method provides custom mapping between Enum member and
+        user-friendly name of the boot stage in terms of Amlogic.
+        """
+        name = {
+            self.ROM: "BootROM",
+            self.SPL: "BL2",
+            self.TPL: "U-Boot",
+        }.get(self)
+
+        if name:
+            return name
+
+        # If self (i.e. Enum member) is not found in the dict, then
+        # get() would return None by default. Hence return default name
+        # of Enum member in such case.
+        return super().name
+
+
+class StageTimeout(TimeoutError):
+    """The board was not observed in the expected state before the deadline
+
+    socid is the last SocId the board answered with, None if it never did.
+    """
+
+    def __init__(self, msg, socid=None):
+        super().__init__(msg)
+        self.socid = socid
+
+
+def stage_of(socid):
+    """Return the Stage of a SocId"""
+    return Stage(socid.stage_minor)
+
+
+def in_stage(*stages):
+    """Return a wait_stage() condition true in any of stages"""
+    return lambda socid: socid.stage_minor in stages
+
+
+def wait_stage(dev, ready=None, timeout=10.0, what='board'):
+    """Poll dev until ready(socid) is true, return that SocId
+
+    dev is a pyamlboot.AmlogicSoC, asked past its identify() cache, which
+    then holds the last answer. Without ready, any answer will do.
+    ready may itself talk to the board, USB errors and short large memory
+    reads it raises count as not ready. The interval between polls doubles from POLL_MIN_INTERVAL up to
+    POLL_MAX_INTERVAL. Raises StageTimeout after timeout seconds, what
+    names the awaited state in its message.
+    """
+    start = time.monotonic()
+    deadline = start + timeout
+    interval = POLL_MIN_INTERVAL
+    socid = None
+    polls = 0
+
+    while True:
+        polls = polls + 1
+        try:
+            socid = SocId(dev.identify(refresh=True))
+            if ready is None or ready(socid):
+                _logger.debug('%s ready after %.3fs, %d polls: %s', what,
+                              time.monotonic() - start, polls, socid)
+                return socid
+        except (usb.core.USBError, ShortReadError) as e:
+            _logger.debug('Waiting for %s: %s', what, e)
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise StageTimeout(f'Timeout waiting for {what} after '
+                               f'{timeout}s, last seen: {socid}', socid)
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, POLL_MAX_INTERVAL)
@@ -0,0 +1,185 @@
+# SPDX-License-Identifier: GPL-2.0 OR MIT
+# -*- coding: utf-8 -*-
+"""
+Asynchronous bulk OUT streaming
+
+A synchronous endpoint write leaves the bus idle while the host prepares
+the next block. BulkStream keeps up to `depth` bulk transfers in flight on
+one endpoint through the libusb 1.0 asynchronous API, each block being
+copied into a ring of transfer buffers before submission.
+
+It is only available when the device was opened through pyusb's libusb1
+backend: open_stream() returns None otherwise, and callers keep using
+synchronous endpoint writes.
+"""
+
+import collections
+import ctypes
+import logging
+
+import usb.core
+
+try:
+    import usb.backend.libusb1 as libusb1
+except ImportError:
+    libusb1 = None
+
+__all__ = ['BulkStream', 'open_stream', 'DEFAULT_QUEUE_DEPTH']
+
+DEFAULT_QUEUE_DEPTH = 8
+
+LIBUSB_TRANSFER_TYPE_BULK = 2
+
+_logger = logging.getLogger(__name__)
+
+
+def _libusb1_backend(dev):
+    """Return the pyusb libusb1 backend driving dev, or None"""
+    if libusb1 is None:
+        return None
+
+    backend = getattr(getattr(dev, '_ctx', None), 'backend', None)
+    # pyamlboot.usb_backend wraps the pyusb backend object
+    backend = getattr(backend, '_backend', backend)
+    if not isinstance(backend, libusb1._LibUSB):
+        return None
+
+    return backend
+
+
+class BulkStream:
+    """Queue of asynchronous bulk OUT transfers on one endpoint"""
+
+    def __init__(self, dev, endpoint, depth=DEFAULT_QUEUE_DEPTH):
+        backend = _libusb1_backend(dev)
+        if backend is None:
+            raise NotImplementedError('Asynchronous transfers need libusb1')
+
+        self._lib = backend.lib
+        self._ctx = backend.ctx
+
+        dev._ctx.managed_open()
+        _, ep = dev._ctx.setup_request(dev, endpoint)
+        self._handle = dev._ctx.handle.handle.value
+        self._endpoint = ep.bEndpointAddress
+
+        self._lib.libusb_cancel_transfer.argtypes = [libusb1._libusb_transfer_p]
+        self._callback = libusb1._libusb_transfer_cb_fn_p(self._complete)
+
+        self._transfers = []
+        self._buffers = []
+        self._done = []
+        self._slot_of = {}
+        for slot in range(depth):
+            transfer = self._lib.libusb_alloc_transfer(0)
+            if not transfer:
+                self.close()
+                raise MemoryError('libusb_alloc_transfer failed')
+            self._transfers.append(transfer)
+            self._buffers.append(None)
+            self._done.append(True)
+            self._slot_of[ctypes.addressof(transfer.contents)] = slot
+
+    def _complete(self, transfer):
+        self._done[self._slot_of[ctypes.addressof(transfer.contents)]] = True
+
+    def _submit(self, slot, block, timeout):
+        view = memoryview(block).cast('B')
+        length = len(view)
+
+        buf = self._buffers[slot]
+        if buf is None or len(buf) < length:
+            buf = (ctypes.c_ubyte * length)()
+            self._buffers[slot] = buf
+        memoryview(buf).cast('B')[:length] = view
+
+        t = self._transfers[slot].contents
+        t.dev_handle = self._handle
+        t.flags = 0
+        t.endpoint = self._endpoint
+        t.type = LIBUSB_TRANSFER_TYPE_BULK
+        t.timeout = timeout
+        t.length = length
+        t.actual_length = 0
+        t.callback = self._callback
+        t.buffer = ctypes.addressof(buf)
+        t.num_iso_packets = 0
+
+        self._done[slot] = False
+        libusb1._check(self._lib.libusb_submit_transfer(self._transfers[slot]))
+
+    def _wait(self, slot):
+        while not self._done[slot]:
+            libusb1._check(self._lib.libusb_handle_events(self._ctx))
+
+        t = self._transfers[slot].contents
+        status = int(t.status)
+        if status == libusb1.LIBUSB_TRANSFER_TIMED_OUT:
+            raise usb.core.USBTimeoutError(libusb1._str_transfer_error[status],
+                                           status,
+                                           libusb1._transfer_errno[status])
+        if status != libusb1.LIBUSB_TRANSFER_COMPLETED:
+            raise usb.core.USBError(libusb1._str_transfer_error[status],
+                                    status,
+                                    libusb1._transfer_errno[status])
+        if t.actual_length != t.length:
+            raise usb.core.USBError(
+                f'Short bulk write: {t.actual_length} of {t.length} bytes')
+
+        return t.actual_length
+
+    def _cancel(self, pending):
+        for slot in pending:
+            self._lib.libusb_cancel_transfer(self._transfers[slot])
+        for slot in pending:
+            while not self._done[slot]:
+                self._lib.libusb_handle_events(self._ctx)
+
+    def write(self, blocks, timeout=1000):
+        """Send an iterable of buffers, one bulk transfer each, in order
+
+        Each block is copied into a transfer buffer on submission, so the
+        caller may reuse its buffer as soon as the next block is requested.
+        Returns the number of bytes sent.
+        """
+        free = collections.deque(range(len(self._transfers)))
+        pending = collections.deque()
+        sent = 0
+
+        try:
+            for block in blocks:
+                if not free:
+                    slot = pending.popleft()
+                    sent += self._wait(slot)
+                    free.append(slot)
+
+                slot = free.popleft()
+                self._submit(slot, block, timeout)
+                pending.append(slot)
+
+            while pending:
+                sent += self._wait(pending[0])
+                pending.popleft()
+        except BaseException:
+            self._cancel(pending)
+            raise
+
+        return sent
+
+    def close(self):
+        for transfer in self._transfers:
+            self._lib.libusb_free_transfer(transfer)
+        self._transfers = []
+        self._buffers = []
+
+
+def open_stream(dev, endpoint, depth=DEFAULT_QUEUE_DEPTH):
+    """Return a BulkStream on endpoint, or None if streaming is unavailable"""
+    if not depth or _libusb1_backend(dev) is None:
+        return None
+
+    try:
+        return BulkStream(dev, endpoint, depth)
+    except Exception as e:
+        _logger.debug('Bulk streaming unavailable: %s', e)
+        return None
@@ -0,0 +1,153 @@
+# SPDX-License-Identifier: GPL-2.0 OR MIT
+# -*- coding: utf-8 -*-
+"""
+Adaptive transfer timeouts
+
+A fixed timeout has to cover the slowest link and busiest device, so a
+stalled transfer on a good link is only noticed after seconds. Instead,
+AdaptiveTimeout models a transfer as a fixed overhead plus a per byte
+cost, both followed as moving averages of the transfers actually done,
+and derives the timeout for a given length from that model with a safety
+margin. Until enough transfers were measured, it returns the ceiling:
+the timeout that used to be hard-coded.
+
+A transfer timing out well before the ceiling is then treated as a stall.
+Only transfers which can be repeated as a whole, a single packet command
+or a reply read, are retried in place with retry_transfer(). A data block
+which timed out may have partly reached the device, and the large memory
+and AMLC requests have no sequence number nor checksum to catch a block
+sent twice: retry_request() issues those again from their header.
+"""
+
+import errno
+import logging
+import time
+
+import usb.core
+
+from . import metrics
+
+__all__ = ['AdaptiveTimeout', 'is_stall', 'clear_stall', 'retry_transfer',
+           'retry_request']
+
+SMOOTHING = 0.2
+# Transfers measured before timeouts get shorter than the ceiling
+MIN_SAMPLES = 8
+# Transfers shorter than this only measure the fixed overhead
+SMALL_TRANSFER = 512
+# In place retries of a stalled command or reply
+BLOCK_RETRIES = 3
+# Restarts of a request whose data transfer stalled
+REQUEST_RETRIES = 3
+
+_logger = logging.getLogger(__name__)
+
+
+class AdaptiveTimeout:
+    """Timeouts in ms derived from the measured transfer times"""
+
+    def __init__(self, ceiling_ms, floor_ms=50, margin=4.0):
+        self.ceiling_ms = ceiling_ms
+        self.floor_ms = floor_ms
+        self.margin = margin
+        self.samples = 0
+        self.overhead = 0.0
+        self.byte_seconds = 0.0
+
+    def _smooth(self, value, sample):
+        if self.samples <= 1:
+            return sample
+        return value + SMOOTHING * (sample - value)
+
+    def record(self, nbytes, seconds):
+        """Account a transfer of nbytes which completed in seconds"""
+        self.samples += 1
+        if nbytes < SMALL_TRANSFER:
+            self.overhead = self._smooth(self.overhead, seconds)
+        else:
+            self.byte_seconds = self._smooth(
+                self.byte_seconds, max(seconds - self.overhead, 0) / nbytes)
+
+    def for_length(self, nbytes):
+        """Return the timeout in ms for a transfer of nbytes"""
+        if self.samples < MIN_SAMPLES:
+            return self.ceiling_ms
+
+        expected = self.overhead + nbytes * self.byte_seconds
+        timeout = int(expected * self.margin * 1000)
+        return max(self.floor_ms, min(timeout, self.ceiling_ms))
+
+
+def is_stall(e):
+    """Return whether a pyusb error is a timeout or endpoint stall"""
+    return (isinstance(e, usb.core.USBTimeoutError) or
+            getattr(e, 'errno', None) in (errno.ETIMEDOUT, errno.EPIPE))
+
+
+def clear_stall(ep, e):
+    """Clear the halt of ep if e reports a stalled endpoint"""
+    if getattr(e, 'errno', None) == errno.EPIPE:
+        ep.clear_halt()
+
+
+def retry_transfer(transfer, ep, nbytes, timeouts, retries=BLOCK_RETRIES,
+                   kind='transfer'):
+    """Return transfer(timeout), retried in place when it stalls
+
+    Only for transfers which the device takes or sends whole, like a
+    single packet command. The first attempt gets the adaptive timeout for
+    nbytes, retries the ceiling one. A stalled endpoint is cleared before
+    retrying. Retries are recorded in the transfer metrics as
+    'retry:<kind>'.
+    """
+    for attempt in range(retries + 1):
+        timeout = (timeouts.for_length(nbytes) if attempt == 0
+                   else timeouts.ceiling_ms)
+        start = time.perf_counter()
+        try:
+            ret = transfer(timeout)
+        except usb.core.USBError as e:
+            if not is_stall(e) or attempt == retries:
+                raise
+            elapsed = time.perf_counter() - start
+            _logger.warning('%s of %d bytes stalled after %d ms, retrying',
+                            kind, nbytes, elapsed * 1000)
+            metrics.record('retry:' + kind, nbytes, elapsed, True)
+            clear_stall(ep, e)
+            continue
+
+        timeouts.record(nbytes, time.perf_counter() - start)
+        return ret
+
+
+def retry_request(request, recover, nbytes, progress=None,
+                  retries=REQUEST_RETRIES, kind='request'):
+    """Return request(restart), issued again when one of its transfers stalls
+
+    request sends the request, header and data, with the adaptive
+    timeouts, or with the ceiling ones when restart is true. A request
+    able to resume after its last whole block reports the bytes done so far
+    through progress(): retries then only count the stalls in a row
+    without progress. recover(e) is called before each new request, to
+    clear a stalled endpoint or drain late data. Restarts are recorded in
+    the transfer metrics as 'retry:<kind>'.
+    """
+    stalls = 0
+    done = None
+    while True:
+        start = time.perf_counter()
+        try:
+            return request(done is not None)
+        except usb.core.USBError as e:
+            if not is_stall(e):
+                raise
+            now = progress() if progress is not None else 0
+            stalls = 1 if done is not None and now > done else stalls + 1
+            if stalls > retries:
+                raise
+            done = now
+            elapsed = time.perf_counter() - start
+            _logger.warning('%s of %d bytes stalled after %d ms at %d, '
+                            'restarting', kind, nbytes, elapsed * 1000, done)
+            metrics.record('retry:' + kind, nbytes, elapsed, True)
+            recover(e)
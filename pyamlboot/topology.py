@@ -0,0 +1,81 @@
+# SPDX-License-Identifier: GPL-2.0 OR MIT
+# -*- coding: utf-8 -*-
+"""
+USB topology helpers
+
+A board keeps its physical port across the ROM -> SPL -> TPL
+re-enumerations while its device address changes every time. Devices are
+therefore pinned by port path, written the Linux sysfs way:
+<bus>-<port>[.<port>...], e.g. '1-2.3'.
+"""
+
+import glob
+import os
+import sys
+
+import usb.core
+
+__all__ = ['AMLOGIC_IDS', 'port_path', 'port_match', 'find_devices']
+
+AMLOGIC_VENDOR_ID = 0x1b8e
+
+# Optimus/ROM (c003) and ADNL (c004) products
+AMLOGIC_IDS = ((AMLOGIC_VENDOR_ID, 0xc003), (AMLOGIC_VENDOR_ID, 0xc004))
+
+
+def _sysfs_port_path(bus, address):
+    for devdir in glob.glob('/sys/bus/usb/devices/*-*'):
+        if ':' in os.path.basename(devdir):
+            continue
+        try:
+            with open(os.path.join(devdir, 'busnum')) as f:
+                busnum = int(f.read())
+            with open(os.path.join(devdir, 'devnum')) as f:
+                devnum = int(f.read())
+        except (OSError, ValueError):
+            continue
+
+        if (busnum, devnum) == (bus, address):
+            return os.path.basename(devdir)
+
+    return None
+
+
+def port_path(dev):
+    """Return the port path of a pyusb device, or None if unknown"""
+    if dev.bus is None:
+        return None
+
+    if dev.port_numbers:
+        return f'{dev.bus}-' + '.'.join(str(p) for p in dev.port_numbers)
+
+    # libusb0 does not report port numbers, ask sysfs
+    if sys.platform == 'linux' and dev.address is not None:
+        return _sysfs_port_path(dev.bus, dev.address)
+
+    return None
+
+
+def port_match(port):
+    """Return a usb.core.find() custom_match selecting port, any if None"""
+    if port is None:
+        return None
+
+    return lambda dev: port_path(dev) == port
+
+
+def find_devices(backend=None, ids=AMLOGIC_IDS):
+    """Return {port path: device} for every connected Amlogic device"""
+    devices = {}
+
+    for dev in usb.core.find(find_all=True, backend=backend,
+                             custom_match=lambda d: (d.idVendor,
+                                                     d.idProduct) in ids):
+        path = port_path(dev)
+        if path is None:
+            raise RuntimeError(f'Cannot get the port of device '
+                               f'{dev.bus}:{dev.address}, the USB backend '
+                               f'does not report port numbers')
+        devices[path] = dev
+
+    return devices
@@ -1,33 +1,67 @@
 # -*- coding: utf-8 -*-
 # SPDX-License-Identifier: GPL-2.0 OR MIT
+"""
+pyusb backend selection
+
+get_backend() returns a pyusb backend wrapped to stub out the requests
+the Amlogic USB boot stages do not handle. libusb0 is preferred on Linux
+and libusb1 on Windows, another one can be requested by name or through
+the PYAMLBOOT_USB_BACKEND environment variable. Only libusb1 supports the
+asynchronous bulk OUT streaming of pyamlboot.stream, see
+AmlogicSoC.transferPath(): on Linux, streaming is opt-in.
+
+Run as a module to compare the available backends on the connected
+device:
+
+    python3 -m pyamlboot.usb_backend [--address ADDR]
+"""
 
 __license__ = "GPL-2.0"
 __copyright__ = "Copyright (c) 2024, SaluteDevices"
 
 import logging
+import os
 import sys
+import time
 
 import usb.backend.libusb1 as libusb1
 import usb.backend.libusb0 as libusb0
 
-__all__ = ['get_backend']
+__all__ = ['get_backend', 'backend_name', 'available_backends', 'measure',
+           'BACKENDS', 'ENV_BACKEND']
+
+BACKENDS = {'libusb1': libusb1, 'libusb0': libusb0}
+ENV_BACKEND = 'PYAMLBOOT_USB_BACKEND'
 
 _logger = logging.getLogger('usb.backend')
 
 
+def _default_order():
+    if sys.platform == 'win32':
+        return ('libusb1', 'libusb0')
+    return ('libusb0', 'libusb1')
+
+
 class _LibUSB:
-    def __init__(self, backend):
+    def __init__(self, backend, name):
         self._backend = backend
-        self._stub_func = {
-            'get_configuration': self._get_configuration
-        }
+        self.name = name
+
+        # Bound once here: calls on the hot paths, like bulk_write, are then
+        # plain attribute lookups instead of going through __getattr__
+        for attr in dir(backend):
+            if attr.startswith('_'):
+                continue
+            value = getattr(backend, attr)
+            if callable(value):
+                setattr(self, attr, value)
+
+        self.get_configuration = self._get_configuration
 
         if sys.platform == 'linux':
-            self._stub_func.update({
-                'set_interface_altsetting': self._stub,
-                'claim_interface': self._stub,
-                'release_interface': self._stub,
-            })
+            self.set_interface_altsetting = self._stub
+            self.claim_interface = self._stub
+            self.release_interface = self._stub
 
     def _stub(self, *args, **kwargs):
         pass
@@ -36,23 +70,121 @@ class _LibUSB:
         return 1
 
     def __getattr__(self, item):
-        if item in self._stub_func:
-            return self._stub_func[item]
-
+        # Backend data attributes, like the libusb1 lib and ctx
         return getattr(self._backend, item)
 
 
-def get_backend(find_library=None):
-    backends = [libusb0]
-    if sys.platform == 'win32':
-        backends.insert(0, libusb1)
+def get_backend(find_library=None, name=None):
+    """Return the wrapped pyusb backend, or None if none can be loaded
 
-    for m in backends:
-        backend = m.get_backend()
-        if backend is not None:
-            _logger.info('find(): using backend "%s"', m.__name__)
-            break
-    else:
-        return None
+    name is one of BACKENDS, defaults to $PYAMLBOOT_USB_BACKEND, else the
+    first backend available in the platform order.
+    """
+    name = name or os.environ.get(ENV_BACKEND)
+    if name and name not in BACKENDS:
+        raise ValueError(f'Unknown USB backend {name}, '
+                         f'expected one of {", ".join(BACKENDS)}')
 
-    return _LibUSB(backend)
+    for n in (name,) if name else _default_order():
+        backend = BACKENDS[n].get_backend(find_library=find_library)
+        if backend is not None:
+            _logger.info('find(): using backend "%s"', BACKENDS[n].__name__)
+            return _LibUSB(backend, n)
+
+    return None
+
+
+def available_backends():
+    """Return the names of the backends which can be loaded"""
+    return [n for n, m in BACKENDS.items() if m.get_backend() is not None]
+
+
+def backend_name(dev):
+    """Return the name of the backend driving a pyusb Device"""
+    backend = dev._ctx.backend
+    name = getattr(backend, 'name', None)
+    if name is None:
+        name = type(backend).__module__.rsplit('.', 1)[-1]
+    return name
+
+
+def _rate(nbytes, fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return nbytes / (time.perf_counter() - start) / (1 << 20)
+
+
+def measure(address=None, length=0x400000, block_length=4096, count=200,
+            names=None):
+    """Time the backends and transfer paths on the connected device
+
+    Returns a dict of '<backend>/<path>' to results: the identify() round
+    trip in us and, with a writable address, the large memory write and
+    read rates in MiB/s. Each backend is timed with synchronous bulk
+    transfers, then with streaming when it supports it.
+    """
+    from .pyamlboot import AmlogicSoC
+
+    data = bytes(range(256)) * (length // 256)
+    results = {}
+
+    for name in names or available_backends():
+        for depth in (0, None):
+            kwargs = {} if depth is None else {'streamDepth': depth}
+            dev = AmlogicSoC(usb_backend=get_backend(name=name), **kwargs)
+            try:
+                path = dev.transferPath()
+                key = f'{name}/{path}'
+                if depth is None and key in results:
+                    continue
+
+                start = time.perf_counter()
+                for _ in range(count):
+                    dev.identify(refresh=True)
+                result = {'identify_us':
+                          (time.perf_counter() - start) / count * 1e6}
+
+                if address is not None:
+                    result['write_mib_s'] = _rate(
+                        len(data), dev.writeLargeMemory, address, data,
+                        block_length)
+                    result['read_mib_s'] = _rate(
+                        len(data), dev.readLargeMemoryInto, address,
+                        bytearray(len(data)), block_length)
+
+                results[key] = result
+            finally:
+                dev.disposeDevice()
+
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Compare the USB backends on the connected device")
+    parser.add_argument('--address', type=lambda v: int(v, 0),
+                        help="writable memory address for the bulk rates, "
+                             "in a ROM or BL2 stage")
+    parser.add_argument('--length', type=lambda v: int(v, 0),
+                        default=0x400000, help="bulk transfer length")
+    parser.add_argument('--block-length', type=lambda v: int(v, 0),
+                        default=4096, help="large memory block length")
+    parser.add_argument('--backend', dest='names', action='append',
+                        choices=list(BACKENDS), help="backend to time")
+    args = parser.parse_args()
+
+    results = measure(args.address, args.length, args.block_length,
+                      names=args.names)
+    best = max(results, key=lambda k: (results[k].get('write_mib_s', 0),
+                                       -results[k]['identify_us']))
+    for key, result in results.items():
+        marker = '*' if key == best else ' '
+        print(f'{marker} {key:<18} {result["identify_us"]:8.0f} us',
+              end='')
+        if 'write_mib_s' in result:
+            print(f' {result["write_mib_s"]:8.1f} MiB/s write'
+                  f' {result["read_mib_s"]:8.1f} MiB/s read', end='')
+        print()
+    print(f'{ENV_BACKEND}={best.split("/")[0]}')
@@ -48,14 +48,14 @@ if __name__ == '__main__':
     dev = pyamlboot.AmlogicSoC()
 
     print("Writing kernel...")
-    dev.writeLargeMemory(UBOOT_IMAGEADDR, args.kernel.read(), 512, True)
+    dev.writeLargeMemory(UBOOT_IMAGEADDR, args.kernel, 512, True)
 
     print("Writing dtb...")
-    dev.writeLargeMemory(UBOOT_DTBADDR, args.dtb.read(), 512, True)
+    dev.writeLargeMemory(UBOOT_DTBADDR, args.dtb, 512, True)
 
     if args.ramdisk is not None:
         print("Writing ramdisk...")
-        dev.writeLargeMemory(UBOOT_INITRDADDR, args.ramdisk.read(), 512, True)
+        dev.writeLargeMemory(UBOOT_INITRDADDR, args.ramdisk, 512, True)
 
     if args.plain_image:
         bootcmd = "booti"
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: Apache-2.0 OR MIT
+# -*- coding: utf-8 -*-
+
+#
+# Command to sample a set of registers over time into a CSV or binary trace
+#
+
+import argparse
+
+from pyamlboot import pyamlboot, sampler
+
+def parse_int(value):
+    return int(value, 0)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Sample Amlogic SoC registers into a trace file")
+    parser.add_argument('output',
+                        help="trace file, CSV when ending with .csv, binary otherwise")
+    parser.add_argument('registers', type=parse_int, nargs='+',
+                        help="register addresses")
+    parser.add_argument('--rate', type=float,
+                        help="sampling rate in Hz, as fast as possible by default")
+    parser.add_argument('--duration', type=float,
+                        help="stop after this many seconds")
+    parser.add_argument('--count', type=int,
+                        help="stop after this many samples")
+    parser.add_argument('--format', dest='fmt', choices=['csv', 'bin'],
+                        help="trace format, overrides the output extension")
+    parser.add_argument('--gap', type=int, default=0,
+                        help="also read registers up to this many bytes apart "
+                             "together, with the words in between: not for "
+                             "read-to-clear registers (default: 0)")
+
+    args = parser.parse_args()
+
+    dev = pyamlboot.AmlogicSoC()
+    writer = sampler.open_trace(args.output, args.registers, args.fmt)
+
+    if args.duration is None and args.count is None:
+        print("Sampling, press Ctrl-C to stop...")
+    try:
+        stats = sampler.sample_registers(dev, args.registers, writer,
+                                         args.duration, args.count, args.rate,
+                                         args.gap)
+    finally:
+        writer.close()
+
+    print("%d samples in %.2fs: %.1f samples/s, %d dropped intervals" %
+          (stats.samples, stats.seconds, stats.rate, stats.dropped))
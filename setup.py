@@ -12,7 +12,7 @@ setuptools.setup(name="pyamlboot",
     description="Amlogic SoC USB Boot utility",
     url='https://github.com/superna9999/pyamlboot',
     packages=['pyamlboot'],
-    scripts=['boot.py', 'boot-g12.py', 'runKernel.py', 'socid.py'],
+    scripts=['boot.py', 'boot-g12.py', 'runKernel.py', 'socid.py', 'dumpMemory.py', 'sampleRegs.py'],
     license="Apache 2.0 OR MIT",
     install_requires=['pyusb', 'setuptools'],
     package_data = {'pyamlboot': files},
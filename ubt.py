@@ -8,12 +8,21 @@ __version__ = '0.0.1'
 
 import argparse
 import logging
+import multiprocessing
+import os
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
 
 from adnl import do_adnl_burn
+from pyamlboot import metrics, simulator
 from pyamlboot.amlimage import AmlImagePack
-from pyamlboot.optimus import do_optimus_burn
+from pyamlboot.optimus import USB_BACKEND, do_optimus_burn
+from pyamlboot.topology import find_devices
+
+LOG_FORMAT = '[%(asctime)s] [%(levelname)-8s]: %(message)s'
+LOG_DATEFMT = '%Y-%m-%d %H:%M:%S'
 
 
 class WipeFormat(Enum):
@@ -25,16 +34,112 @@ class WipeFormat(Enum):
         return self.name
 
 
+def is_adnl_image(aml_img):
+    # If image contains 'usb_flow', it is ADNL
+    try:
+        aml_img.item_get('aml', 'usb_flow')
+    except ValueError:
+        return False
+
+    return True
+
+
+def burn(args, aml_img, port=None, backend=None):
+    if args.metrics:
+        metrics.enable()
+
+    try:
+        if is_adnl_image(aml_img):
+            do_adnl_burn(args.reset, args.wipe.value, aml_img, port=port,
+                         backend=backend, restart_data=args.adnl_restart_data)
+        else:
+            do_optimus_burn(args, aml_img, port=port, backend=backend)
+    finally:
+        if args.metrics:
+            metrics.collector.dump(args.metrics)
+            logging.info(f'Transfer metrics written to {args.metrics}')
+
+
+def farm_worker(port, args):
+    """Burn the board on one port, in its own process and log file"""
+    log_name = os.path.join(args.farm_logs, f'ubt-{port}.log')
+    logging.basicConfig(level=logging.DEBUG, format=LOG_FORMAT,
+                        datefmt=LOG_DATEFMT, filename=log_name, force=True)
+    logging.info(f'Farm worker for port {port}')
+
+    # Opened files do not survive the trip to the worker process
+    args.img = open(args.img, 'rb')
+    if args.password:
+        args.password = open(args.password, 'rb')
+
+    if args.metrics:
+        root, ext = os.path.splitext(args.metrics)
+        args.metrics = f'{root}-{port}{ext}'
+
+    start = time.monotonic()
+    try:
+        burn(args, AmlImagePack(args.img, use_mmap=not args.no_mmap),
+             port=port)
+    except Exception as e:
+        logging.exception(f'Burn failed on port {port}')
+        result = f'FAIL ({type(e).__name__}: {e})'
+    else:
+        result = 'OK'
+
+    return result, time.monotonic() - start, log_name
+
+
+def do_farm_burn(args):
+    devices = find_devices(USB_BACKEND)
+    if not devices:
+        logging.error('No Amlogic device found')
+        return 1
+
+    ports = sorted(devices)
+    logging.info(f'Burning {len(ports)} devices on ports: {" ".join(ports)}')
+
+    os.makedirs(args.farm_logs, exist_ok=True)
+    args.img = args.img.name
+    args.password = args.password.name if args.password else None
+
+    # Workers are spawned: forked ones would inherit the libusb state of
+    # find_devices()
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=len(ports), mp_context=ctx) as pool:
+        futures = {port: pool.submit(farm_worker, port, args) for port in ports}
+        results = {}
+        for port, future in futures.items():
+            try:
+                results[port] = future.result()
+            except Exception as e:
+                results[port] = (f'FAIL ({type(e).__name__}: {e})', 0.0, '')
+
+    port_len = max(len('PORT'), *(len(p) for p in ports))
+    print(f'{"PORT":<{port_len}}  {"TIME":>8}  RESULT')
+    for port in ports:
+        result, elapsed, log_name = results[port]
+        print(f'{port:<{port_len}}  {elapsed:7.1f}s  {result}  [{log_name}]')
+
+    failed = sum(1 for r in results.values() if r[0] != 'OK')
+    print(f'{len(ports) - failed}/{len(ports)} devices burned')
+
+    return 1 if failed else 0
+
+
 def main():
     logging.basicConfig(level=logging.DEBUG,
-                        format='[%(asctime)s] [%(levelname)-8s]: %(message)s',
-                        datefmt='%Y-%m-%d %H:%M:%S')
+                        format=LOG_FORMAT,
+                        datefmt=LOG_DATEFMT)
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--img',
                         required=True,
                         type=argparse.FileType('rb'),
                         help='Specify location path to aml_upgrade_package.img')
+    parser.add_argument('--no-mmap',
+                        action='store_true',
+                        default=False,
+                        help='Read the image instead of mapping it in memory')
     parser.add_argument('--reset',
                         action='store_true',
                         default=False,
@@ -51,22 +156,62 @@ def main():
     parser.add_argument('--password',
                         type=argparse.FileType('rb'),
                         help='Unlock usb mode using password file provided')
+    parser.add_argument('--port',
+                        help='Only burn the device on this USB port path '
+                             '(e.g. 1-2.3)')
+    parser.add_argument('--adnl-restart-data',
+                        action='store_true',
+                        default=False,
+                        help='Restart ADNL data steps whose transfer stalled '
+                             'instead of failing (not checked on hardware)')
+    parser.add_argument('--farm',
+                        action='store_true',
+                        default=False,
+                        help='Burn every connected Amlogic device in parallel')
+    parser.add_argument('--farm-logs',
+                        default='.',
+                        help='Directory for the per-device farm logs')
+    parser.add_argument('--metrics',
+                        metavar='FILE',
+                        help='Dump transfer metrics as JSON to FILE')
+    parser.add_argument('--simulate',
+                        action='store_true',
+                        default=False,
+                        help='Burn a simulated device instead of real hardware')
+    parser.add_argument('--sim-bandwidth',
+                        type=float,
+                        metavar='MIBS',
+                        help='Simulated link bandwidth in MiB/s (default: '
+                             'unlimited)')
+    parser.add_argument('--sim-latency',
+                        type=float,
+                        default=0.0,
+                        metavar='MS',
+                        help='Simulated latency per transfer in milliseconds')
+    parser.add_argument('--sim-fault-rate',
+                        type=float,
+                        default=0.0,
+                        metavar='RATE',
+                        help='Probability of a simulated transfer fault')
     parser.add_argument('--version', action='version', version=__version__)
 
     args = parser.parse_args()
-    aml_img = AmlImagePack(args.img)
-    adnl = True
 
-    # If image contains 'usb_flow', it is ADNL
-    try:
-        aml_img.item_get('aml', 'usb_flow')
-    except ValueError:
-        adnl = False
+    if args.farm:
+        if args.simulate:
+            parser.error('--simulate cannot be used with --farm')
+        return do_farm_burn(args)
 
-    if adnl:
-        do_adnl_burn(args.reset, args.wipe.value, aml_img)
-    else:
-        do_optimus_burn(args, aml_img)
+    aml_img = AmlImagePack(args.img, use_mmap=not args.no_mmap)
+
+    backend = None
+    if args.simulate:
+        bandwidth = args.sim_bandwidth and int(args.sim_bandwidth * (1 << 20))
+        backend = simulator.for_image(
+            aml_img, bandwidth=bandwidth, latency=args.sim_latency / 1000,
+            faults=simulator.FaultInjector(args.sim_fault_rate))
+
+    burn(args, aml_img, port=args.port, backend=backend)
 
 
 if __name__ == '__main__':